@@ -47,12 +47,15 @@ you can also note this using a `(level, count)` tuple as shorthand, e.g. `('vali
 
 """
 
-exp_factors = FactorSet({
+# The factor levels are also read by the experiment when it compiles the session plan
+trial_factors = {
     "cuing_task_type": ["gaze", "exogenous"],
     "cue_location": ["left", "right", "neutral"],
     "target_location": ["left", "right"],
     "task_requirement": ["leftward real line motion rating", "rightward real line motion rating", "illusory line motion rating", "detection", "detection", "detection", "detection", "detection", "detection"]
-})
+}
+
+exp_factors = FactorSet(trial_factors)
 
 
 
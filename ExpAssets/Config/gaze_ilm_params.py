@@ -67,3 +67,36 @@ append_hostname = False
 #########################################
 # PROJECT-SPECIFIC VARS
 #########################################
+raster_cache = True # keep rasterised stimuli and messages in ExpAssets/RasterCache between launches
+demo_resume = True # after an interrupted session, let the experimenter choose (R) to resume the demo from the last slide reached
+line_motion_segments = 8 # segments making up the real moving line
+line_motion_segment_length = 0.59 # degrees (segments overlap slightly to avoid gaps)
+line_motion_duration = 28 # ms from the first segment appearing to the full line
+line_motion_hold = 1000 # ms the full line stays on screen after the motion ends
+wait_spin_threshold = 1.0 # ms before a frame deadline at which to stop sleeping and start spinning
+frame_draw_lead = 3.0 # ms before each expected refresh at which to start drawing the next frame
+
+# Headless simulation (run with 'python tools/simulate_session.py')
+simulate_session = False
+simulated_refresh_rate = 60 # Hz
+simulated_frame_drop_rate = 0.0 # probability of missing each refresh deadline
+simulated_detection_rt = (380, 60) # mean and SD, in ms
+simulated_error_rate = 0.05
+simulated_rating_rt = (1800, 500) # mean and SD, in ms
+simulated_ratings = { # mean and SD of scale ratings (0 = left, 1 = right)
+    "illusory line motion rating": (0.5, 0.15),
+    "leftward real line motion rating": (0.25, 0.1),
+    "rightward real line motion rating": (0.75, 0.1),
+}
+
+# Rendering benchmarks (run with 'python tools/benchmark_rendering.py')
+benchmark_frames = 120 # timed calls of each display routine
+
+# Gaze sampling and fixation monitoring
+gaze_tracker = "mouse" # "eyelink" (needs eye_tracking = True), "mouse", or the path of a scripted gaze trace
+gaze_sample_rate = 1000 # Hz, requested (limited by sleep granularity: 500-1000 Hz on Windows; the achieved rate is printed at the end of a session)
+gaze_buffer_size = 16384 # samples (must hold a whole trial if record_gaze_samples is on)
+fixation_monitoring = False # abort (and recycle) trials if gaze leaves the fixation region during the trial display
+fixation_window = 2.0 # radius of the fixation region around the screen centre, in degrees
+fixation_break_samples = 5 # consecutive samples outside the region that count as a break
+record_gaze_samples = False # save each trial's gaze samples to ExpAssets/Data/gaze
@@ -61,5 +61,29 @@ CREATE TABLE trials (
     response text not null,
     block_num integer not null,
     trial_num integer not null,
-    reaction_time integer not null
+    reaction_time real not null,
+    target_onset real not null,
+    dropped_frames integer not null
+);
+
+CREATE TABLE frames (
+    id integer primary key autoincrement not null,
+    participant_id integer not null references participants(id),
+    block_num integer not null,
+    trial_num integer not null,
+    frame integer not null,
+    state text not null,
+    flip_time real not null,
+    missed integer not null,
+    wake_error real
+);
+
+CREATE TABLE gaze_index (
+    id integer primary key autoincrement not null,
+    participant_id integer not null references participants(id),
+    block_num integer not null,
+    trial_num integer not null,
+    file text not null,
+    byte_offset integer not null,
+    sample_count integer not null
 );
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Journaled, batched writes to the project database from a background thread.
+
+Trial and frame rows are journaled to disk as soon as they're written and committed
+in batches, so a session that crashes loses nothing: the journal is replayed into
+the database on the next launch. This uses only the standard library, so crash
+recovery can be tested against a scratch database.
+
+"""
+
+import os
+import json
+import queue
+import sqlite3
+import threading
+
+
+class DataWriter(threading.Thread):
+    """A background thread that persists database rows off the presentation thread.
+
+    Rows passed to :meth:`write` are queued and immediately returned from. The
+    writer thread appends each batch to an append-only journal file next to the
+    database, fsyncing once for everything queued at the same time, and then loads
+    the journal into the database in a single transaction whenever a flush is
+    requested or ``batch_size`` rows have accumulated. The journal is truncated
+    once everything in it has been committed.
+
+    When the thread starts, any entries left in the journal by a session that
+    crashed are replayed into the database first, skipping rows whose natural key
+    shows they were already committed. The database is put in WAL journaling mode,
+    so commits append to the write-ahead log instead of rewriting the database file,
+    with ``synchronous=FULL`` so the log is synced on every commit: the journal is
+    only truncated once its rows are durable in the database, and can't be lost to
+    a power cut or OS crash that rolls back a commit.
+
+    Args:
+        db_path (str): The path of the project database.
+        batch_size (int, optional): The number of journaled rows at which to load
+            the journal into the database without waiting for a flush.
+
+    """
+    NATURAL_KEYS = {
+        "trials": ["participant_id", "block_num", "trial_num"],
+        "frames": ["participant_id", "block_num", "trial_num", "frame"],
+        "gaze_index": ["participant_id", "block_num", "trial_num"],
+    }
+    _FLUSH = "flush"
+    _CLOSE = "close"
+
+    def __init__(self, db_path, batch_size=5000):
+        super(DataWriter, self).__init__(name="DataWriter")
+        self.daemon = True
+        self.db_path = db_path
+        self.journal_path = db_path + ".journal.jsonl"
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+
+    def write(self, table, columns, rows):
+        """Queues a batch of rows to be written to the database.
+
+        Args:
+            table (str): The name of the table to insert the rows into.
+            columns (list): The names of the columns provided for each row.
+            rows (list): A list of rows, each a sequence of values in the same
+                order as ``columns``.
+
+        """
+        if len(rows):
+            self._queue.put({"table": table, "columns": list(columns), "rows": [list(r) for r in rows]})
+
+    def flush(self):
+        """Requests that everything written so far be committed to the database."""
+        self._queue.put(self._FLUSH)
+
+    def close(self):
+        """Commits everything written so far and waits for the writer thread to exit."""
+        self._queue.put(self._CLOSE)
+        self.join()
+
+    def _load(self, records, skip_existing=False):
+        loaded = 0
+        with self.db:
+            for record in records:
+                table, columns, rows = record["table"], record["columns"], record["rows"]
+                key = self.NATURAL_KEYS.get(table, []) if skip_existing else []
+                if key:
+                    key_idx = [columns.index(col) for col in key]
+                    q = "SELECT 1 FROM {0} WHERE {1}".format(
+                        table, " AND ".join(["{0} = ?".format(col) for col in key])
+                    )
+                    rows = [r for r in rows if not self.db.execute(q, [r[i] for i in key_idx]).fetchone()]
+                q = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+                    table, ", ".join(columns), ", ".join(["?"] * len(columns))
+                )
+                self.db.executemany(q, rows)
+                loaded += len(rows)
+        return loaded
+
+    def _replay(self):
+        # Commit any journal entries left behind by a session that didn't shut down cleanly
+        if not os.path.exists(self.journal_path):
+            return
+        records = []
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break # Incomplete final entry from a crash mid-write
+        recovered = self._load(records, skip_existing=True)
+        if recovered:
+            print("Recovered {0} unsaved rows from {1}".format(recovered, self.journal_path))
+
+    def run(self):
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Commits happen off the presentation thread, so syncing each one costs nothing in
+        # the render loop (NORMAL would only sync the log at checkpoints)
+        self.db.execute("PRAGMA synchronous=FULL")
+        try:
+            self._replay()
+            journal = open(self.journal_path, "w")
+        except sqlite3.Error as e:
+            # Keep the old entries and append to them, so they can be retried next launch
+            print("Error replaying {0}: {1}".format(self.journal_path, e))
+            journal = open(self.journal_path, "a")
+
+        pending = []
+        pending_rows = 0
+        closing = False
+        while not closing:
+            # Drain everything already queued so that it shares a single fsync
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            load = False
+            for item in batch:
+                if item == self._FLUSH:
+                    load = True
+                elif item == self._CLOSE:
+                    load = closing = True
+                else:
+                    journal.write(json.dumps(item) + "\n")
+                    pending.append(item)
+                    pending_rows += len(item["rows"])
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            if pending and (load or pending_rows >= self.batch_size):
+                try:
+                    self._load(pending)
+                except sqlite3.Error as e:
+                    # Keep the journal so the rows can be recovered on the next launch
+                    print("Error writing to database, rows kept in journal: {0}".format(e))
+                    continue
+                pending = []
+                pending_rows = 0
+                journal.seek(0)
+                journal.truncate()
+                journal.flush()
+                os.fsync(journal.fileno())
+
+        journal.close()
+        self.db.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Frame-by-frame presentation plans for trials on a fixed-refresh display.
+
+A trial's display events are given as requested onsets in milliseconds, and are
+turned into the display state to show on each refresh of the screen. Real line
+motion is likewise scheduled as the number of segments to show on each refresh.
+
+Nothing here needs klibs or a window, so the rounding of trial timings can be
+checked at any refresh rate without running the experiment.
+
+"""
+
+import itertools
+
+
+def line_motion_schedule(segments, duration, refresh_rate):
+    """Returns the number of line segments to show on each frame of real line motion.
+
+    Segments are added at a constant rate over the motion duration, and each frame
+    shows every segment due by the time it starts, so the motion has the same speed
+    at any refresh rate. The last frame of the schedule shows the full line.
+
+    Args:
+        segments (int): The number of segments making up the full line.
+        duration (float): The time (in ms) from the first segment to the last.
+        refresh_rate (float): The refresh rate of the display (in Hz).
+
+    """
+    if duration <= 0 or segments <= 1:
+        return [segments]
+    frame_duration = 1000.0 / refresh_rate
+    segment_interval = duration / float(segments - 1)
+    schedule = []
+    while not schedule or schedule[-1] < segments:
+        elapsed = len(schedule) * frame_duration
+        schedule.append(min(int(elapsed / segment_interval) + 1, segments))
+    return schedule
+
+
+class FramePlan(object):
+    """A frame-by-frame presentation plan for the display events of a trial.
+
+    Each display state's duration is rounded to the nearest whole number of
+    refreshes, and event onsets are the running total of those frame counts, so
+    that equal requested durations are always shown for the same number of frames
+    (rounding absolute onsets instead can make, e.g., a 50 ms cue and a 50 ms
+    target 7 and 8 frames long at 144 Hz). Any requested timing
+    that can't be honoured at the given refresh rate (e.g. a state shorter than
+    a single refresh, or a duration that isn't a whole number of frames) is
+    described in :attr:`warnings`.
+
+    Args:
+        events (list): A chronological list of ``(onset, label, state)`` tuples,
+            where ``onset`` is the event time in milliseconds from the start of the
+            trial and ``state`` is the display state shown from that event onward.
+            The final event should have a state of None to mark the end of the plan.
+        refresh_rate (float): The refresh rate of the display (in Hz).
+        initial_state (str): The display state to show from the start of the trial
+            until the first event.
+        tolerance (float, optional): The largest difference (in ms) between the
+            requested and presented duration of a state that won't be reported
+            as a warning. Defaults to 1 ms.
+
+    Attributes:
+        states (list): The display state to show on each frame of the plan.
+        event_frames (dict): The index of the first frame of each event, by label.
+        frame_duration (float): The duration of a single frame (in ms).
+        warnings (list): Descriptions of any timings that couldn't be honoured.
+
+    """
+    def __init__(self, events, refresh_rate, initial_state, tolerance=1.0):
+        self.frame_duration = 1000.0 / refresh_rate
+        self.states = []
+        self.event_frames = {}
+        self.warnings = []
+
+        onsets = [0] + [onset for onset, label, state in events]
+        labels = ["trial_start"] + [label for onset, label, state in events]
+        states = [initial_state] + [state for onset, label, state in events]
+        counts = [int(round((end - start) / self.frame_duration)) for start, end in zip(onsets, onsets[1:])]
+        frames = [0] + list(itertools.accumulate(counts))
+        for i in range(len(onsets) - 1):
+            self.event_frames[labels[i]] = frames[i]
+            requested = onsets[i + 1] - onsets[i]
+            presented = (frames[i + 1] - frames[i]) * self.frame_duration
+            if frames[i + 1] == frames[i]:
+                self.warnings.append(
+                    "'{0}' ({1} ms) is shorter than one refresh at {2:.1f} Hz and won't "
+                    "be shown.".format(labels[i], requested, refresh_rate)
+                )
+            elif abs(presented - requested) > tolerance:
+                self.warnings.append(
+                    "'{0}' will be shown for {1:.1f} ms instead of {2} ms at {3:.1f} "
+                    "Hz.".format(labels[i], presented, requested, refresh_rate)
+                )
+            self.states += [states[i]] * (frames[i + 1] - frames[i])
+        self.event_frames[labels[-1]] = frames[-1]
+
+    def __len__(self):
+        return len(self.states)
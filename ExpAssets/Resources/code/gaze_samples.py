@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Compact binary storage for per-trial gaze samples.
+
+Each session's samples are appended, trial by trial, to a single flat binary file of
+:data:`GAZE_SAMPLE` records, with a small JSON header alongside it describing the
+record layout and display geometry. The byte offset and sample count of each trial
+are stored in the 'gaze_index' table of the project database, so any trial's samples
+can be mapped straight from the file without copying.
+
+This module only depends on NumPy, so it can be used by the offline analysis tools
+as well as the experiment.
+
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+GAZE_SAMPLE = np.dtype([
+    ("time", "<f8"), # ms, on the experiment's perf_counter clock
+    ("x", "<f4"), # px
+    ("y", "<f4"), # px
+    ("pupil", "<f4"), # tracker units, or NaN if not reported
+    ("flags", "<u2"),
+])
+
+# Sample flags
+MISSING = 1 # No gaze position was available (e.g. during a blink)
+
+
+def header_path(path):
+    """Returns the path of the JSON header for a gaze sample file."""
+    return os.path.splitext(path)[0] + ".json"
+
+
+class GazeSampleFile(object):
+    """An append-only binary file of gaze samples for a single session.
+
+    Args:
+        path (str): The path of the sample file. It's created if it doesn't exist,
+            and appended to if it does.
+        **header: Values to record in the session header (e.g. 'ppd',
+            'screen_c', 'sample_rate'), written if the file is new.
+
+    """
+    def __init__(self, path, **header):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if not os.path.exists(header_path(path)):
+            header["dtype"] = GAZE_SAMPLE.descr
+            with open(header_path(path), "w") as f:
+                json.dump(header, f, indent=2, sort_keys=True)
+        self._file = open(path, "ab")
+
+    def append(self, samples):
+        """Appends an array of samples, returning their ``(byte_offset, count)`` in the file."""
+        samples = np.ascontiguousarray(samples, dtype=GAZE_SAMPLE)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(samples.tobytes())
+        self._file.flush()
+        return (offset, len(samples))
+
+    def close(self):
+        self._file.close()
+
+
+def read_header(path):
+    """Returns the session header of a gaze sample file as a dict."""
+    with open(header_path(path)) as f:
+        return json.load(f)
+
+
+def map_samples(path, offset=0, count=None):
+    """Maps samples from a gaze sample file into a read-only array without copying them.
+
+    Args:
+        path (str): The path of the sample file.
+        offset (int, optional): The byte offset of the first sample to map.
+        count (int, optional): The number of samples to map. Defaults to every sample
+            from the offset to the end of the file.
+
+    Returns:
+        :obj:`numpy.memmap`: A structured array of :data:`GAZE_SAMPLE` records.
+
+    """
+    if count is None:
+        count = (os.path.getsize(path) - offset) // GAZE_SAMPLE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=GAZE_SAMPLE)
+    return np.memmap(path, dtype=GAZE_SAMPLE, mode="r", offset=offset, shape=(count,))
+
+
+def load_trial_samples(db, participant_id, block_num, trial_num, data_dir):
+    """Maps the gaze samples of a single trial, using the 'gaze_index' table.
+
+    Args:
+        db (:obj:`sqlite3.Connection`): A connection to the project database.
+        participant_id (int): The database id of the participant.
+        block_num (int): The block number of the trial.
+        trial_num (int): The trial number of the trial.
+        data_dir (str): The folder that sample file names are relative to.
+
+    Returns:
+        :obj:`numpy.memmap`: The trial's samples, or None if it has none.
+
+    """
+    row = db.execute(
+        "SELECT file, byte_offset, sample_count FROM gaze_index "
+        "WHERE participant_id = ? AND block_num = ? AND trial_num = ?",
+        (participant_id, block_num, trial_num)
+    ).fetchone()
+    if row is None:
+        return None
+    filename, offset, count = row
+    return map_samples(os.path.join(data_dir, filename), offset, count)
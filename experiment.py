@@ -5,19 +5,33 @@ __author__ = "Nicholas Murray"
 import klibs
 from klibs import P
 from klibs.KLGraphics import KLDraw as kld # To draw shapes
-from klibs.KLUserInterface import any_key, mouse_pos, smart_sleep # So participants can press any key to continue; convert mouse presses to mouse position coordinates
-from klibs.KLGraphics import fill, blit, flip # To actually make drawn shapes appear on the screen
+from klibs.KLUserInterface import any_key, mouse_pos, smart_sleep, ui_request # So participants can press any key to continue; convert mouse presses to mouse position coordinates
+from klibs.KLGraphics import fill, flip # To actually make drawn shapes appear on the screen
 from klibs.KLUtilities import deg_to_px # Convert stimulus sizes according to degrees of visual angle
-from klibs.KLResponseCollectors import KeyPressResponse # To take in key presses as a response to a trial
 from klibs.KLResponseListeners import KeypressListener, BaseResponseListener # To record key press responses at the end of a trial
-from klibs.KLConstants import TK_MS, RECT_BOUNDARY # to specify milliseconds as the unit of time to measure response times in, and the rectangle boundary for the line motion rating scale
-from klibs.KLEventInterface import TrialEventTicket as ET # to define the events of a trial according to stimulus timings
-from klibs.KLKeyMap import KeyMap # To map keys to responses and have them recorded in the database
+from klibs.KLConstants import NO_RESPONSE # The response recorded when no key is pressed before the timeout
+from klibs.KLExceptions import TrialException # To abort and recycle trials where fixation is broken
 import sdl2 # To generate keyboard button names upon pressing them as a response
+import ctypes # To read the mouse position from the gaze sampling thread
+import sqlite3 # To write trial data and per-flip frame logs to the database in bulk
+import json # To journal unsaved rows for crash recovery
+import hashlib # To key the on-disk cache of rasterised stimuli
+import os
+import itertools
+import runpy # To read the FactorSet when compiling the session plan
+import platform # To label rendering benchmark results with the machine they came from
+import random # For synthetic responses in simulated sessions
+import threading # To write data to the database off the presentation thread
+import time # For high-resolution flip timestamps
+import numpy as np # To composite scenes into pre-rendered full-screen frames
+from OpenGL import GL # To keep pre-rendered frames on the GPU as persistent textures
 from klibs.KLCommunication import message # To write messages on the screen to participants
 from klibs.KLBoundary import RectangleBoundary, BoundaryInspector # To create a boundary within which participants can rate line motion
 from klibs.KLEventQueue import pump, flush # Everything below recommended by Austin for drawing rating scale
 from klibs.KLBoundary import RectangleBoundary
+from gaze_samples import GAZE_SAMPLE, MISSING, GazeSampleFile # Shared with the offline analysis tools (ExpAssets/Resources/code)
+from frame_plan import FramePlan, line_motion_schedule # Shared with the tests (ExpAssets/Resources/code)
+from data_writer import DataWriter # Shared with the tests (ExpAssets/Resources/code)
 
 # Defining some useful constants
 WHITE = (255, 255, 255)
@@ -28,18 +42,33 @@ class gaze_ilm(klibs.Experiment):
 
     def setup(self):
 
+        # Time each stage of startup, up to the first frame of the demo
+        self.startup_profile = StartupProfile()
+        self.profiling_startup = os.environ.get("GAZE_ILM_PROFILE_STARTUP") == "1"
+
+        # Rasterised stimuli and messages are cached on disk between launches, keyed by the
+        # display geometry they were drawn for
+        cache_path = os.path.join(os.path.dirname(P.data_dir), "RasterCache") if P.raster_cache else None
+        geometry = (P.screen_x, P.screen_y, P.ppi, P.view_distance, klibs.__version__)
+        self.raster_cache = RasterCache(cache_path, geometry)
+
+        # Frames, messages and the scale mark are uploaded to the GPU once and redrawn
+        # from their textures, instead of being re-uploaded on every blit
+        self.textures = TextureCache()
+
         if P.run_practice_blocks:
             self.insert_practice_block(1, trial_counts = P.trials_per_practice_block)
 
         # Block and trial start messages
-        self.practice_block_message = message("Press space to begin the practice trials", "default", blit_txt = False)
-        self.block_start_message = message("Press space to begin the experiment", "default", blit_txt = False)
+        self.practice_block_message = self.cached_message("Press space to begin the practice trials")
+        self.block_start_message = self.cached_message("Press space to begin the experiment")
         block_start_message_vertical_offset = deg_to_px(3)
         self.block_start_message_position = (P.screen_c[0], P.screen_c[1]-block_start_message_vertical_offset)
-        self.next_block_message = message("You have completed a block of trials! Press space to start the next block", "default", blit_txt = False)
-        self.next_trial_message = message("Press space to continue", "default", blit_txt = False)
+        self.next_block_message = self.cached_message("You have completed a block of trials! Press space to start the next block")
+        self.next_trial_message = self.cached_message("Press space to continue")
         next_trial_message_vertical_offset = deg_to_px(3)
         self.next_trial_message_posiition = (P.screen_c[0], P.screen_c[1]-next_trial_message_vertical_offset)
+        self.startup_profile.mark("block messages")
 
         # Fixation Cross
         crosslinesize = deg_to_px(.57)
@@ -98,20 +127,16 @@ class gaze_ilm(klibs.Experiment):
         self.static_line = kld.Line(length = linelength, color = WHITE, thickness = 3, rotation = 90)
         self.static_line_position = (P.screen_c[0], P.screen_c[1]-probe_vertical_offset)
 
-        # Real line motion stimuli
-        linelength_shorterline = deg_to_px(.56)
-        linelength_longerline = deg_to_px(.59)
-        lineoffset_shorterlines = deg_to_px(2.485)
-        self.shorter_moving_line = kld.Line(length = linelength_shorterline, color = WHITE, thickness = 3, rotation = 90)
-        self.longer_moving_line = kld.Line(length = linelength_longerline, color = WHITE, thickness = 3, rotation = 90)
-        self.real_line_1_position = (P.screen_c[0]-deg_to_px(1.94), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_2_position = (P.screen_c[0]-deg_to_px(1.39), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_3_position = (P.screen_c[0]-deg_to_px(.84), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_4_position = (P.screen_c[0]-deg_to_px(.29), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_5_position = (P.screen_c[0]+deg_to_px(.26), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_6_position = (P.screen_c[0]+deg_to_px(.81), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_7_position = (P.screen_c[0]+deg_to_px(1.36), P.screen_c[1]-probe_vertical_offset)
-        self.real_line_8_position = (P.screen_c[0]+deg_to_px(1.91), P.screen_c[1]-probe_vertical_offset)
+        # Real line motion stimuli: equal segments spanning the static line, added one at a time
+        segment_length = deg_to_px(P.line_motion_segment_length)
+        segment_count = P.line_motion_segments
+        self.moving_line_segment = kld.Line(length = segment_length, color = WHITE, thickness = 3, rotation = 90)
+        segment_spacing = (linelength - segment_length) / float(max(segment_count - 1, 1))
+        first_segment_x = P.screen_c[0] - (linelength - segment_length) / 2.0
+        self.line_segment_positions = [
+            (int(round(first_segment_x + i * segment_spacing)), P.screen_c[1]-probe_vertical_offset)
+            for i in range(segment_count)
+        ]
 
         # Line motion rating scale stimuli
         scale_vertical_offset = deg_to_px(1.1)
@@ -122,275 +147,164 @@ class gaze_ilm(klibs.Experiment):
         self.scale = kld.Rectangle(scale_w, scale_h, stroke=scale_stroke)
         self.scale_mark = kld.Rectangle(int(scale_h * 0.1), scale_h, fill=BLACK)
         self.scale_bounds = bounds_from_blit(self.scale, self.scale_loc)
+        self.scale_mark_y = self.scale_bounds.center[1]
 
         left_right_motion_rating_message_horizontal_offset = deg_to_px(3)
         left_right_motion_rating_message_vertical_offset = deg_to_px(1.1)
         no_motion_rating_message_vertical_offset = deg_to_px(2.2)
-        self.motion_rating_message = message("Rate the how much and what direction the line may have moved:")
+        self.motion_rating_message = self.cached_message("Rate the how much and what direction the line may have moved:")
         self.motion_rating_message_position = (P.screen_c[0], P.screen_c[1])
-        self.left_motion_rating_message = message("Left")
+        self.left_motion_rating_message = self.cached_message("Left")
         self.left_motion_rating_message_position = (P.screen_c[0]-left_right_motion_rating_message_horizontal_offset, P.screen_c[1]+left_right_motion_rating_message_vertical_offset)
-        self.right_motion_rating_message = message("Right")
+        self.right_motion_rating_message = self.cached_message("Right")
         self.right_motion_rating_message_position = (P.screen_c[0]+left_right_motion_rating_message_horizontal_offset, P.screen_c[1]+left_right_motion_rating_message_vertical_offset)
-        self.no_motion_rating_message = message("No motion")
+        self.no_motion_rating_message = self.cached_message("No motion")
         self.no_motion_rating_message_position = (P.screen_c[0], P.screen_c[1]+no_motion_rating_message_vertical_offset)
         no_motion_line_length = deg_to_px(1)
         self.no_motion_rating_line = kld.Line(length = no_motion_line_length, color = WHITE, thickness = 3)
+        self.startup_profile.mark("stimuli")
+
+        # Responses are timed from when their input events are pumped (see EventClock)
+        self.event_clock = EventClock()
         self.scale_listener = ScaleListener(
-            self.scale_bounds, loop_callback=self.scale_callback
+            self.scale_bounds, loop_callback=self.scale_callback, event_clock=self.event_clock
+
+        )
 
+        # Detection responses: 'z' for left, '/' for right, ending collection after 1700 ms
+        response_keys = {sdl2.SDLK_z: "left", sdl2.SDLK_SLASH: "right", sdl2.SDLK_b: "no motion"}
+        self.keypress_listener = TimedKeypressListener(
+            response_keys, timeout = 1.7, loop_callback = self.poll_input, event_clock = self.event_clock
         )
 
-        self.task_demo()
+        # In a simulated session, time is kept by a virtual clock that jumps straight to each
+        # deadline, flips are simulated, and responses come from a synthetic participant
+        self.simulating = P.simulate_session or os.environ.get("GAZE_ILM_SIMULATE") == "1"
+        if self.simulating:
+            self.clock = VirtualClock()
+            self.refresh_rate = P.simulated_refresh_rate
+            self.simulated_display = SimulatedDisplay(self.clock, self.refresh_rate, P.simulated_frame_drop_rate)
+            self.responder = SyntheticResponder(
+                P.simulated_detection_rt, P.simulated_error_rate, P.simulated_rating_rt,
+                P.simulated_ratings, timeout = 1700
+            )
+            # Keep simulated trials out of the real project database by writing them to a
+            # fresh copy of it (which includes the participant record for this session).
+            # The copy is made with SQLite's backup API, so rows committed to the write-ahead
+            # log but not yet checkpointed into the database file are included.
+            database_path = P.database_path.replace(".db", "_simulation.db")
+            source = sqlite3.connect(P.database_path)
+            copy = sqlite3.connect(database_path)
+            source.backup(copy)
+            copy.close()
+            source.close()
+        else:
+            self.clock = precise_time
+            self.refresh_rate = P.refresh_rate
+            database_path = P.database_path
+
+        # Trial rows and frame logs are handed to a writer thread that journals them and
+        # commits them to the database in batches, replaying any rows left in the journal
+        # by a session that crashed
+        self.data_writer = DataWriter(database_path)
+        self.data_writer.start()
+        self.defer_trial_writes()
+
+        # Per-flip timestamps for each trial, queued for the 'frames' table after the trial
+        self.frame_log = FrameLog(self.refresh_rate, clock = self.clock)
+
+        # Sleeps until shortly before each frame deadline, then spins for the remainder
+        if self.simulating:
+            self.waiter = self.clock
+        else:
+            self.waiter = HybridWaiter(P.wait_spin_threshold)
+
+        # Gaze is sampled into a ring buffer on a background thread. Trials can be aborted as
+        # soon as it leaves the fixation region, and each trial's samples can be saved to a
+        # binary file for the session (simulated sessions have no gaze to sample).
+        self.gaze_source = None
+        self.fixation_monitor = None
+        self.gaze_file = None
+        if (P.fixation_monitoring or P.record_gaze_samples) and not self.simulating:
+            if P.gaze_tracker == "eyelink":
+                self.gaze_source = self.el.gaze
+            elif P.gaze_tracker == "mouse":
+                self.gaze_source = MouseGazeSource(scale = (P.screen_scale_x, P.screen_scale_y))
+            else:
+                self.gaze_source = TraceGazeSource(P.gaze_tracker, P.ppd, P.screen_c)
+            self.gaze_buffer = GazeRingBuffer(P.gaze_buffer_size)
+            self.gaze_sampler = GazeSampler(self.gaze_source, self.gaze_buffer, P.gaze_sample_rate)
+            self.gaze_sampler.start()
+        if P.fixation_monitoring and self.gaze_source:
+            self.fixation_monitor = FixationMonitor(
+                self.gaze_buffer, P.screen_c, deg_to_px(P.fixation_window), P.fixation_break_samples
+            )
+        if P.record_gaze_samples and self.gaze_source:
+            self.gaze_filename = os.path.join("gaze", "{0}_p{1}_gaze.bin".format(P.project_name, P.participant_id))
+            self.gaze_file = GazeSampleFile(
+                os.path.join(P.data_dir, self.gaze_filename), participant_id = P.participant_id,
+                ppd = P.ppd, screen_c = list(P.screen_c), screen_size = [P.screen_x, P.screen_y],
+                view_distance = P.view_distance, sample_rate = P.gaze_sample_rate,
+                tracker = P.gaze_tracker
+            )
+        self.fixation_break_latencies = []
+
+        self.startup_profile.mark("listeners and data writer")
+
+        # Pre-composite every trial display so each frame is drawn with a single blit. The
+        # frames are built in the background while the demo is shown.
+        self.build_frame_cache()
+
+        # Compile the frame-by-frame timeline of every trial the factors can produce, so
+        # trial preparation and per-frame dispatch are table lookups
+        self.compile_session_plan()
+
+        # Where the last demo slide reached is saved, so the experimenter can choose to skip
+        # ahead when a session is relaunched
+        self.demo_resume_path = os.path.join(P.data_dir, ".demo_resume.json")
+
+        self.startup_profile.mark("session plan")
+
+        # Time each display routine and exit instead of running the session
+        if os.environ.get("GAZE_ILM_BENCHMARK") == "1":
+            self.finish_frame_cache()
+            self.run_benchmarks()
+            self.quit()
+
+        if not self.simulating:
+            self.task_demo()
+        self.finish_frame_cache()
 
     def task_demo(self):
-        #def show_demo_text(msg, stim_set = []):
-         #   msg_x = int(P.screen_x / 2)
-          #  msg_y = int(P.screen_y * .5)
-           # text = message(msg, "default", blit_txt = False)
-
-           # fill()
-            #blit(text, registration = 5, location = (msg_x, msg_y))
-            #stim_set
-            #flip()
-
-        def show_demo_text(msg):
-            message_vertical_offset = deg_to_px(6)
-            self.message_position = (P.screen_c[0], P.screen_c[1]-message_vertical_offset)
-            text = message(msg, "default", blit_txt = False, align = "center")
-
-            #fill()
-            blit(text, registration = 5, location = self.message_position)
-            #stim_set
-            #flip()
-
-        def generate_stimuli(stimuli_type):
-            
-            # Valid exo trial
-                # Start by fixating
-            if stimuli_type == "fixation": 
-                # Fixation cross
-                blit(self.horizontal_cross, registration = 5, location = P.screen_c)
-                blit(self.vertical_cross, registration = 5, location = P.screen_c)
-
-                # Probes
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-                # Go to an x-cross 
-            if stimuli_type == "x-cross":
-                # Fixation cross
-                blit(self.x_cross1, registration = 5, location = P.screen_c)
-                blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-                # Probes
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-            # Go to a no-pupil gaze face
-            if stimuli_type == "no_pupil_gaze_face":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-
-                # Probes
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-            # Go to a leftwards exogenous cue
-            if stimuli_type == "left_exogenous_cue":
-                blit(self.x_cross1, registration = 5, location = P.screen_c)
-                blit(self.x_cross2, registration = 5, location = P.screen_c)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-                blit(self.cue, registration = 5, location = self.left_probe_position)
-
-            # Go to a right detection target
-            if stimuli_type == "right_detection_target":
-                blit(self.x_cross1, registration = 5, location = P.screen_c)
-                blit(self.x_cross2, registration = 5, location = P.screen_c)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-                blit(self.target, registration = 5, location = self.right_probe_position)
-
-            # Go to a right looking gaze face
-            if stimuli_type == "right_gaze_face":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.lefteye_right_pupilcue_position)
-                blit(self.pupilcircle, registration = 5, location = self.righteye_right_pupilcue_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-            # Go to left invalid gaze target
-            if stimuli_type == "left_gaze_target":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.lefteye_right_pupilcue_position)
-                blit(self.pupilcircle, registration = 5, location = self.righteye_right_pupilcue_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-                blit(self.target, registration = 5, location = self.left_probe_position)
-
-            # Go to a right valid gaze target
-            if stimuli_type == "right_gaze_target":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.lefteye_right_pupilcue_position)
-                blit(self.pupilcircle, registration = 5, location = self.righteye_right_pupilcue_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-                blit(self.target, registration = 5, location = self.right_probe_position)
-
-            # Go to a neutral looking gaze face
-            if stimuli_type == "neutral_gaze_face":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.left_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.right_eye_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-            # Draw a line for an exo trial
-            if stimuli_type == "exo_line_draw":
-                blit(self.x_cross1, registration = 5, location = P.screen_c)
-                blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-                # Probes
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-
-            # Draw a line for a gaze trial
-            if stimuli_type == "right_gaze_line_draw":
-                blit(self.facecircle, registration = 5, location = P.screen_c)
-                blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-                blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-                blit(self.pupilcircle, registration = 5, location = self.lefteye_right_pupilcue_position)
-                blit(self.pupilcircle, registration = 5, location = self.righteye_right_pupilcue_position)
-                blit(self.nose, registration = 5, location = P.screen_c)
-                blit(self.mouth, registration = 5, location = self.mouth_position)
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-
-            # Draw line rating scale
-            if stimuli_type == "line_rating_scale":
-                blit(self.motion_rating_message, registration = 5, location = self.motion_rating_message_position)
-                blit(self.left_motion_rating_message, registration = 5, location = self.left_motion_rating_message_position)
-                blit(self.right_motion_rating_message, registration = 5, location = self.right_motion_rating_message_position)
-                blit(self.no_motion_rating_message, registration = 5, location = self.no_motion_rating_message_position)
-                blit(self.no_motion_rating_line, registration = 5, location = self.scale_loc)
-                blit(self.scale, 5, self.scale_loc)
-                # Draw the cue
-            # if x_cross == "x-cross" and cue_type == "exogenous" and cue_loc == "left":
-            #     # X-cross
-            #     fill()
-            #     blit(self.x_cross1, registration = 5, location = P.screen_c)
-            #     blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            #     # Probes
-            #     blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-            #     # Left exogenous cues
-            #     blit(self.cue, registration = 5, location = self.left_probe_position)                
-            #     flip()
-
-            #     # Draw the valid target
-            # if x_cross == "x-cross" and cue_type == "exogenous" and cue_loc == None and target_loc == "left":
-            #     # X-cross
-            #     fill()
-            #     blit(self.x_cross1, registration = 5, location = P.screen_c)
-            #     blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            #     # Probes
-            #     blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-            #      # Right detection target
-            #     blit(self.target, registration = 5, location = self.left_probe_position)
-            #     flip()
-            #     # Subtract the valid target for response
-            # if x_cross == "x-cross" and cue_type == "exogenous" and cue_loc == None and target_loc == None:
-            #     # X-cross
-            #     fill()
-            #     blit(self.x_cross1, registration = 5, location = P.screen_c)
-            #     blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            #     # Probes
-            #     blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            #     blit(self.innercircle, registration = 5, location = self.right_probe_position)
-            #     flip()
-
-        def demo_message_stimuli(message = "", stimuli_condition = []):
-            fill()
-            show_demo_text(message)
-            generate_stimuli(stimuli_condition)
-            flip()
-            any_key()
+        message_vertical_offset = deg_to_px(6)
+        self.message_position = (P.screen_c[0], P.screen_c[1]-message_vertical_offset)
+
+        # Demo screens are built from the same scenes as the trial displays
+        demo_scenes = {
+            "fixation": self.scenes["fixation"],
+            "x-cross": self.scenes["exogenous_pre_cue"],
+            "no_pupil_gaze_face": self.scenes["gaze_pre_cue"],
+            "left_exogenous_cue": self.scenes["exogenous_left_cue"],
+            "right_detection_target": self.scenes["right_target"],
+            "right_gaze_face": self.scenes["gaze_right_cue"],
+            "left_gaze_target": self.scenes["gaze_right_cue"].with_layers(
+                target = self.scenes["left_target"].layers["target"]
+            ),
+            "right_gaze_target": self.scenes["gaze_right_cue"].with_layers(
+                target = self.scenes["right_target"].layers["target"]
+            ),
+            "neutral_gaze_face": self.scenes["gaze_neutral_cue"],
+            "exo_line_draw": self.scenes["exogenous_static_line"],
+            "right_gaze_line_draw": self.scenes["gaze_right_cue"].with_layers(
+                line = self.scenes["gaze_static_line"].layers["line"]
+            ),
+            "line_rating_scale": self.scenes["rating_scale"],
+        }
+        slides = []
+
+        def demo_message_stimuli(msg = "", stimuli_condition = None):
+            # Slides are collected here and shown as a deck once they've all been added
+            slides.append((msg, stimuli_condition))
 
         # Creating the actual demo    
         demo_message_stimuli("Welcome to the experiment! This tutorial will help explain the task. \n (Press space to continue)",
@@ -497,814 +411,567 @@ class gaze_ilm(klibs.Experiment):
                              )   
 
         demo_message_stimuli("Next, you will get to practice a bit before doing the experiment. \n If you have any questions, please ask them now. \n And if you have any more questions later, you can stop and ask them at any time. \n (Press space to continue to practice trials)",
-                             )     #######################################################################################
-        # FUNCTIONS DEFINING THE EXOGENOUS CUING TASK STIMULI
-    #######################################################################################
-
-    def trial_start_stimuli(self):
-        # Fixation cross
-        fill()
-        blit(self.horizontal_cross, registration = 5, location = P.screen_c)
-        blit(self.vertical_cross, registration = 5, location = P.screen_c)
-
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-        flip()
-
-    def exo_trial_pre_cue_stimuli(self):
+                             )
 
-        if self.task_requirement == "detection":
-            # X-cross
-            fill()
-            blit(self.x_cross1, registration = 5, location = P.screen_c)
-            blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-            flip()
-        else:
-            # X-cross
-            fill()
-            blit(self.x_cross1, registration = 5, location = P.screen_c)
-            blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
+        # Scene frames are shared between slides, reusing the trial frame cache where possible
+        cached_states = {id(scene): state for state, scene in self.scenes.items()}
+        renderer = SceneRenderer(self.raster_cache)
+        scene_frames = {}
+
+        def build_slide(i):
+            msg, stimuli_condition = slides[i]
+            if stimuli_condition not in scene_frames:
+                scene = demo_scenes.get(stimuli_condition, Scene())
+                if id(scene) in cached_states:
+                    state_id = self.state_ids[cached_states[id(scene)]]
+                    frame = self.frame_builder.item(state_id)
+                    scene_frames[stimuli_condition] = (("frame", state_id), frame)
+                else:
+                    # Demo-only scenes share stimuli with the trial frames, so wait for
+                    # those to finish rendering first
+                    self.frame_builder.join()
+                    frame = renderer.render(scene).copy()
+                    scene_frames[stimuli_condition] = (("demo", stimuli_condition), frame)
+            text = self.cached_message(msg, align = "center")
+            return scene_frames[stimuli_condition] + (text,)
+
+        # If the session was relaunched after a crash, ask whether to pick up from the last
+        # slide reached. This is asked before the deck starts building, since the deck renders
+        # text on its own thread and text rendering isn't thread-safe.
+        start = self.demo_resume_point(len(slides))
+
+        # Build the slides in the background, showing each one as soon as it's ready
+        deck = BackgroundBuilder(build_slide, len(slides))
+        deck.start()
+        self.show_demo_deck(deck, start = start)
+
+        # Free the textures only the demo used
+        for i in range(len(slides)):
+            self.textures.release(("slide", i))
+        for stimuli_condition in scene_frames:
+            self.textures.release(("demo", stimuli_condition))
+
+    def show_demo_deck(self, deck, start = 0):
+        # Space, return, the right arrow or a click go forward; backspace or the left arrow go back
+        i = start
+        while i < len(deck):
+            frame_key, frame, text = deck.item(i)
+            self.textures.draw(frame_key, frame)
+            self.textures.draw(("slide", i), text, registration = 5, location = self.message_position)
             flip()
-
-    def exo_trial_left_cue_stimuli(self):
-        # X-cross
-        fill()
-        blit(self.x_cross1, registration = 5, location = P.screen_c)
-        blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-        # Left exogenous cues
-        blit(self.cue, registration = 5, location = self.left_probe_position)
-
-        flip()
-
-    def exo_trial_right_cue_stimuli(self):
-        # X-cross
+            self.startup_profile.mark_first_frame()
+            if self.profiling_startup:
+                # Only startup is being profiled, so stop once everything is built
+                self.finish_frame_cache()
+                self.quit()
+            self.save_demo_resume_point(i, len(deck))
+            i = max(0, i + self.demo_navigation())
+
+    def demo_navigation(self):
+        # Wait for a key press or click, returning which way to move through the demo
+        forward = [sdl2.SDLK_SPACE, sdl2.SDLK_RETURN, sdl2.SDLK_KP_ENTER, sdl2.SDLK_RIGHT]
+        back = [sdl2.SDLK_BACKSPACE, sdl2.SDLK_LEFT]
+        while True:
+            for event in pump(True):
+                if event.type == sdl2.SDL_KEYDOWN:
+                    ui_request(event.key.keysym)
+                    if event.key.keysym.sym in forward:
+                        return 1
+                    if event.key.keysym.sym in back:
+                        return -1
+                elif event.type == sdl2.SDL_MOUSEBUTTONUP:
+                    return 1
+            time.sleep(0.005)
+
+    def demo_resume_point(self, slide_count):
+        # The station's last session stopped partway through the demo, so ask the experimenter
+        # whether this is the same participant relaunching (and resuming) or a new one
+        if not P.demo_resume or self.profiling_startup or not os.path.exists(self.demo_resume_path):
+            return 0
+        try:
+            with open(self.demo_resume_path) as f:
+                resume = json.load(f)
+        except (IOError, ValueError):
+            return 0
+        slide = resume.get("slide", 0)
+        if resume.get("slides") != slide_count or not 0 < slide < slide_count:
+            return 0
+
+        prompt = message(
+            "The last session (participant {0}) stopped at slide {1} of {2} of the demo.\n\n"
+            "Press R to resume the demo from there, or any other key to start from the "
+            "beginning.".format(resume.get("participant_id", "?"), slide + 1, slide_count),
+            blit_txt = False, align = "center"
+        ).render()
         fill()
-        blit(self.x_cross1, registration = 5, location = P.screen_c)
-        blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-        # Right exogenous cues
-        blit(self.cue, registration = 5, location = self.right_probe_position)
-
+        self.textures.draw("demo_resume_prompt", prompt, registration = 5, location = P.screen_c)
         flip()
+        self.textures.release("demo_resume_prompt")
+        while True:
+            for event in pump(True):
+                if event.type == sdl2.SDL_KEYDOWN:
+                    ui_request(event.key.keysym)
+                    return slide if event.key.keysym.sym == sdl2.SDLK_r else 0
+            time.sleep(0.005)
+
+    def save_demo_resume_point(self, slide, slide_count):
+        with open(self.demo_resume_path, "w") as f:
+            json.dump({"slide": slide, "slides": slide_count, "participant_id": P.participant_id}, f)
 
-    def exo_trial_neutral_cue_stimuli(self):
-        # X-cross
-        fill()
-        blit(self.x_cross1, registration = 5, location = P.screen_c)
-        blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-        # Probes
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
+    #######################################################################################
+    # FUNCTIONS DEFINING THE EXOGENOUS CUING TASK STIMULI
+    #######################################################################################
 
-        # Left and right exogenous cue simultaneously (i.e., neutral exogenous cue)
-        blit(self.cue, registration = 5, location = self.left_probe_position)
-        blit(self.cue, registration = 5, location = self.right_probe_position)
+    def trial_start_stimuli(self):
+        # Fixation cross and probes
+        self.present("fixation")
+
+    def display_states(self):
+        # Every distinct screen a trial can show, described as a Scene of named layers.
+        # These are composited once in setup so that each frame is a single blit.
+        probes = [
+            (self.probecircle, self.left_probe_position),
+            (self.probecircle, self.right_probe_position),
+            (self.innercircle, self.left_probe_position),
+            (self.innercircle, self.right_probe_position),
+        ]
+        fixation_cross = [(self.horizontal_cross, P.screen_c), (self.vertical_cross, P.screen_c)]
+        x_cross = [(self.x_cross1, P.screen_c), (self.x_cross2, P.screen_c)]
+        face = [
+            (self.facecircle, P.screen_c),
+            (self.eyecircle, self.left_eye_position),
+            (self.eyecircle, self.right_eye_position),
+            (self.nose, P.screen_c),
+            (self.mouth, self.mouth_position),
+        ]
+
+        def pupils(left_eye_pos, right_eye_pos):
+            return [(self.pupilcircle, left_eye_pos), (self.pupilcircle, right_eye_pos)]
+
+        exo_pre_cue = Scene(probes = probes, fixation = x_cross)
+        gaze_pre_cue = Scene(probes = probes, face = face)
+
+        states = {
+            "fixation": Scene(probes = probes, fixation = fixation_cross),
+
+            # Exogenous cuing displays (the cue replaces the cued probe's outer circle)
+            "exogenous_pre_cue": exo_pre_cue,
+            "exogenous_left_cue": exo_pre_cue.with_layers(
+                probes = probes[1:],
+                cue = [(self.cue, self.left_probe_position)]
+            ),
+            "exogenous_right_cue": exo_pre_cue.with_layers(
+                probes = probes[0:1] + probes[2:],
+                cue = [(self.cue, self.right_probe_position)]
+            ),
+            "exogenous_neutral_cue": exo_pre_cue.with_layers(
+                probes = probes[2:],
+                cue = [(self.cue, self.left_probe_position), (self.cue, self.right_probe_position)]
+            ),
+
+            # Gaze cuing displays
+            "gaze_pre_cue": gaze_pre_cue,
+            "gaze_left_cue": gaze_pre_cue.with_layers(
+                pupils = pupils(self.lefteye_left_pupilcue_position, self.righteye_left_pupilcue_position)
+            ),
+            "gaze_right_cue": gaze_pre_cue.with_layers(
+                pupils = pupils(self.lefteye_right_pupilcue_position, self.righteye_right_pupilcue_position)
+            ),
+            "gaze_neutral_cue": gaze_pre_cue.with_layers(
+                pupils = pupils(self.left_eye_position, self.right_eye_position)
+            ),
+
+            # Detection targets are shown over the x-cross for both cue types
+            "left_target": exo_pre_cue.with_layers(target = [(self.target, self.left_probe_position)]),
+            "right_target": exo_pre_cue.with_layers(target = [(self.target, self.right_probe_position)]),
+
+            # Line motion rating scale
+            "rating_scale": Scene(scale = [
+                (self.motion_rating_message, self.motion_rating_message_position),
+                (self.left_motion_rating_message, self.left_motion_rating_message_position),
+                (self.right_motion_rating_message, self.right_motion_rating_message_position),
+                (self.no_motion_rating_message, self.no_motion_rating_message_position),
+                (self.no_motion_rating_line, self.scale_loc),
+                (self.scale, self.scale_loc),
+            ]),
+        }
 
-        flip()
+        # Static and moving line frames, drawn over the pre-cue display of each cue type. Each
+        # moving line step adds one more segment, so every step is a single pre-rendered frame.
+        rightward_segments = [(self.moving_line_segment, pos) for pos in self.line_segment_positions]
+        leftward_segments = rightward_segments[::-1]
+
+        for cue_type in ["exogenous", "gaze"]:
+            background = states[cue_type + "_pre_cue"]
+            states[cue_type + "_static_line"] = background.with_layers(line = rightward_segments)
+            for step in range(1, len(rightward_segments) + 1):
+                right_id = "{0}_rightward_line_{1}".format(cue_type, step)
+                left_id = "{0}_leftward_line_{1}".format(cue_type, step)
+                states[right_id] = background.with_layers(line = rightward_segments[:step])
+                states[left_id] = background.with_layers(line = leftward_segments[:step])
+
+        return states
+
+    def build_frame_cache(self):
+        # Composite each display state into a full-screen frame on a background thread,
+        # starting with the fixation display needed by the first demo slide. States that
+        # follow each other (e.g. moving line steps) only redraw the regions that differ.
+        self.scenes = self.display_states()
+        self.state_names = list(self.scenes)
+        self.state_ids = {state: i for i, state in enumerate(self.state_names)}
+        renderer = SceneRenderer(self.raster_cache)
+        stimulus_names = {id(value): name for name, value in vars(self).items()}
+        build_start = precise_time()
+
+        def build_frame(i):
+            scene = self.scenes[self.state_names[i]]
+            for layer, stim, location in scene.entries():
+                if id(stim) in stimulus_names:
+                    self.startup_profile.time_stimulus(stimulus_names[id(stim)], renderer.prepare, stim)
+            frame = renderer.render(scene).copy()
+            if i == len(self.state_names) - 1:
+                self.startup_profile.record("frame cache (background)", precise_time() - build_start)
+            return frame
+
+        self.frame_builder = BackgroundBuilder(build_frame, len(self.state_names))
+        self.frame_builder.start()
+
+    def cached_message(self, text, style = "default", align = "left"):
+        # Rasterise a message, or load it from the on-disk cache if it's been drawn before
+        params = ("message", text, style, align, P.default_font_name, P.default_font_size, P.default_color)
+        render = lambda: message(text, style, blit_txt = False, align = align).render()
+        return self.raster_cache.load(params, render)
+
+    def finish_frame_cache(self):
+        # Wait for any frames still being built
+        start = precise_time()
+        frames = self.frame_builder.items()
+        self.startup_profile.record("waiting for frame cache", precise_time() - start)
+
+        # Upload every frame to the GPU once, before the first timed trial
+        start = precise_time()
+        if self.simulating:
+            # Simulated sessions have no textures, so keep the frames indexed by name and by
+            # integer state id (for the compiled trial timelines)
+            self.frame_table = frames
+            self.frame_cache = dict(zip(self.state_names, frames))
+        else:
+            for state_id, frame in enumerate(frames):
+                self.textures.upload(("frame", state_id), frame)
+            self.textures.upload("scale_mark", self.scale_mark.render())
+            for name in ["practice_block_message", "block_start_message", "next_block_message", "next_trial_message"]:
+                self.textures.upload(name, getattr(self, name))
+            fill()
+            # Frames are only drawn from their textures from here on, so free the CPU copies
+            # (about 8 MB each at 1080p)
+            del frames
+            self.frame_builder.release()
+        self.startup_profile.record("frame cache upload", precise_time() - start)
+
+        output_path = os.environ.get("GAZE_ILM_STARTUP_PROFILE_OUTPUT")
+        if not output_path:
+            output_path = os.path.join(P.data_dir, "startup", platform.node() + ".json")
+        self.startup_profile.save(
+            output_path, host = platform.node(), resolution = [P.screen_x, P.screen_y],
+            raster_cache = {"hits": self.raster_cache.hits, "misses": self.raster_cache.misses},
+            textures = self.textures.stats(), refresh_rate = self.refresh_rate,
+            line_motion = self.line_motion, timing_warnings = self.session_plan.warnings
+        )
 
-    def exo_trial_left_target_stimuli(self):
-        # X-cross
-        fill()
-        blit(self.x_cross1, registration = 5, location = P.screen_c)
-        blit(self.x_cross2, registration = 5, location = P.screen_c)
+    def present(self, state, wake_error = None):
+        self.present_frame(self.state_ids[state], wake_error)
 
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
+    def present_frame(self, state_id, wake_error = None):
+        # Frames are opaque and full-screen, so no fill() is needed before the blit
+        if self.simulating:
+            self.simulated_display.flip()
+        else:
+            self.textures.draw(("frame", state_id))
+            flip()
+        self.frame_log.record(self.state_names[state_id], wake_error)
+
+    def compile_session_plan(self):
+        # Real line motion adds segments at a constant rate, so at each refresh rate it's
+        # shown as the number of segments due by the start of each frame. The schedule is
+        # saved with the session plan and the startup profile.
+        self.line_motion = line_motion_schedule(
+            P.line_motion_segments, P.line_motion_duration, self.refresh_rate
+        )
 
-        # Left detection target
-        blit(self.target, registration = 5, location = self.left_probe_position)
-        flip()
+        # The levels are read from the dict the FactorSet is made from, rather than from
+        # the FactorSet itself
+        factors = runpy.run_path(P.ind_vars_file_path)["trial_factors"]
+        self.session_plan = SessionPlan(
+            factor_levels(factors), self.trial_timeline, self.state_ids, self.refresh_rate,
+            initial_state = "fixation"
+        )
+        self.session_trials = []
+        self.session_plan_path = os.path.join(P.data_dir, "plans", "{0}_p{1}_plan.json".format(
+            P.project_name, P.participant_id
+        ))
+        # Save the plan straight away, so there's a record of it even if the session crashes
+        self.save_session_plan()
+
+    def save_session_plan(self):
+        # Write the plan, along with the trials run so far, for auditing
+        self.session_plan.save(
+            self.session_plan_path, self.session_trials, participant_id = P.participant_id,
+            random_seed = P.random_seed, line_motion = self.line_motion
+        )
 
-    def exo_trial_right_target_stimuli(self):
-        # X-cross
+    def run_benchmarks(self):
+        # Time each display routine over a run of frames: compositing every display state
+        # from its stimuli, presenting every pre-rendered state (including each line motion
+        # step), the trial start screen, and redrawing the rating scale
+        frames = P.benchmark_frames
+        routines = [("trial_start_stimuli", self.trial_start_stimuli, None)]
+        # Composite each state onto a blank canvas with one renderer, whose stimuli are
+        # rasterised during the warmup, so only the compositing itself is timed
+        renderer = SceneRenderer(self.raster_cache)
+        blank = Scene()
+        for state, scene in self.scenes.items():
+            routines.append((
+                "composite:" + state, lambda scene=scene: renderer.render(scene),
+                lambda: renderer.render(blank)
+            ))
+        for state in self.scenes:
+            routines.append(("present:" + state, lambda state=state: self.present(state), None))
+
+        # Move the cursor across the scale so that every call redraws the mark
+        scale_xs = np.linspace(self.scale_bounds.p1[0] + 1, self.scale_bounds.p2[0] - 1, frames)
+        scale_positions = iter([])
+        def scale_redraw():
+            mouse_pos(position = (int(next(scale_positions)), self.scale_mark_y))
+            self.scale_drawn_at = None
+            self.scale_callback()
+        routines.append(("scale_callback", scale_redraw, None))
+
+        results = {}
+        self.frame_log.start()
+        for name, routine, reset in routines:
+            scale_positions = iter(np.tile(scale_xs, 2))
+            results[name] = benchmark_routine(routine, frames, reset = reset)
+        self.frame_log.stop()
         fill()
-        blit(self.x_cross1, registration = 5, location = P.screen_c)
-        blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-        # Right detection target
-        blit(self.target, registration = 5, location = self.right_probe_position)
         flip()
 
-    def exo_cuing_task(self):
-        while self.evm.before("x_cross_on"):
-            self.trial_start_stimuli()
-        
-        while self.evm.between("x_cross_on", "cue_onset"):
-            self.exo_trial_pre_cue_stimuli()
-
-        while self.evm.between("cue_onset", "cue_offset"):
-            if self.cue_location == "left":
-                self.exo_trial_left_cue_stimuli()
-            else:
-                if self.cue_location == "right":
-                    self.exo_trial_right_cue_stimuli()
-                else:
-                    self.exo_trial_neutral_cue_stimuli()
-        
-        while self.evm.between("cue_offset", "target_onset"):
-            self.exo_trial_pre_cue_stimuli()
-
-        while self.evm.between("target_onset", "target_offset"):
-            if self.target_location == "left" and self.task_requirement == "detection":
-                self.exo_trial_left_target_stimuli()
-            else:
-                if self.target_location == "right" and self.task_requirement == "detection":
-                    self.exo_trial_right_target_stimuli()
-                else:
-                    if self.task_requirement == "illusory line motion rating":
-                        self.draw_static_line()
-                    else: 
-                        if self.task_requirement == "rightward real line motion rating":
-                            self.draw_right_line()
-                        else:
-                            if self.task_requirement == "leftward real line motion rating":
-                                self.draw_left_line()
+        output_path = os.environ.get("GAZE_ILM_BENCHMARK_OUTPUT")
+        if not output_path:
+            output_path = os.path.join(P.data_dir, "benchmarks", platform.node() + ".json")
+        if not os.path.isdir(os.path.dirname(output_path)):
+            os.makedirs(os.path.dirname(output_path))
+        summary = {
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "refresh_rate": P.refresh_rate,
+            "resolution": [P.screen_x, P.screen_y],
+            "frames": frames,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "routines": results,
+        }
+        with open(output_path, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print("Saved rendering benchmarks to {0}".format(output_path))
 
     #######################################################################################
-    # FUNCTIONS DEFINING GAZE-CUING STIMULI
+    # RUNNING THE CUING TASKS
     #######################################################################################
 
-    def gaze_trial_pre_cue_stimuli(self):
-        # Face without pupils
-        fill()
-        blit(self.facecircle, registration = 5, location = P.screen_c)
-        blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-        blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-        blit(self.nose, registration = 5, location = P.screen_c)
-        blit(self.mouth, registration = 5, location = self.mouth_position)
-
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-        flip()
-
-    def gaze_trial_left_cue_stimuli(self):
-        fill()
-        blit(self.facecircle, registration = 5, location = P.screen_c)
-        blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-        blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-        blit(self.pupilcircle, registration = 5, location = self.lefteye_left_pupilcue_position)
-        blit(self.pupilcircle, registration = 5, location = self.righteye_left_pupilcue_position)
-        blit(self.nose, registration = 5, location = P.screen_c)
-        blit(self.mouth, registration = 5, location = self.mouth_position)
-        
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-        flip()
-
-    def gaze_trial_right_cue_stimuli(self):
-        fill()
-        blit(self.facecircle, registration = 5, location = P.screen_c)
-        blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-        blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-        blit(self.pupilcircle, registration = 5, location = self.lefteye_right_pupilcue_position)
-        blit(self.pupilcircle, registration = 5, location = self.righteye_right_pupilcue_position)
-        blit(self.nose, registration = 5, location = P.screen_c)
-        blit(self.mouth, registration = 5, location = self.mouth_position)
-        
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-        flip()
-
-    def gaze_trial_neutral_cue_stimuli(self):
-        fill()
-        blit(self.facecircle, registration = 5, location = P.screen_c)
-        blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-        blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-        blit(self.pupilcircle, registration = 5, location = self.left_eye_position)
-        blit(self.pupilcircle, registration = 5, location = self.right_eye_position)
-        blit(self.nose, registration = 5, location = P.screen_c)
-        blit(self.mouth, registration = 5, location = self.mouth_position)
-        
-        # Probes
-        blit(self.probecircle, registration = 5, location = self.left_probe_position)
-        blit(self.probecircle, registration = 5, location = self.right_probe_position)
-        blit(self.innercircle, registration = 5, location = self.left_probe_position)
-        blit(self.innercircle, registration = 5, location = self.right_probe_position)
-        flip()
-
-    def gaze_cuing_task(self):
-        while self.evm.before("x_cross_on"):
-            self.trial_start_stimuli()
-        
-        while self.evm.between("x_cross_on", "cue_onset"):
-            self.gaze_trial_pre_cue_stimuli()
-
-        while self.evm.between("cue_onset", "cue_offset"):
-            if self.cue_location == "left":
-                self.gaze_trial_left_cue_stimuli()
-            else:
-                if self.cue_location == "right":
-                    self.gaze_trial_right_cue_stimuli()
-                else:
-                    self.gaze_trial_neutral_cue_stimuli()
-
-        while self.evm.between("cue_offset", "target_onset"):
-            self.gaze_trial_pre_cue_stimuli()
-
-        while self.evm.between("target_onset", "target_offset"):
-            if self.target_location == "left" and self.task_requirement == "detection":
-                self.exo_trial_left_target_stimuli()
-            else:
-                if self.target_location == "right" and self.task_requirement == "detection":
-                    self.exo_trial_right_target_stimuli()
-                else:
-                    if self.task_requirement == "illusory line motion rating":
-                        self.draw_static_line()
-                    else:
-                        if self.task_requirement == "rightward real line motion rating":
-                            self.draw_right_line()
-                        else:
-                            if self.task_requirement == "leftward real line motion rating":
-                                self.draw_left_line()
-
-    #######################################################################################
-        # DRAWING THE LINES: NO MOTION, REAL LEFTWARD MOTION, AND REAL RIGHTWARD MOTION
-    #######################################################################################
-                
-    def draw_static_line(self):
-
-        def static_line():
-            # Static line composed of small lines
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-            blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-            blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-
-        if self.cuing_task_type == "gaze":
-            # Face without pupils
-            fill()
-            blit(self.facecircle, registration = 5, location = P.screen_c)
-            blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-            blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-            blit(self.nose, registration = 5, location = P.screen_c)
-            blit(self.mouth, registration = 5, location = self.mouth_position)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-            # Static line
-            #blit(self.static_line, registration = 5, location = self.static_line_position)
-            static_line()
-            flip()
-        else:
-            if self.cuing_task_type == "exogenous":
-                # X-cross
-                fill()
-                blit(self.x_cross1, registration = 5, location = P.screen_c)
-                blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-                # Probes
-                blit(self.probecircle, registration = 5, location = self.left_probe_position)
-                blit(self.probecircle, registration = 5, location = self.right_probe_position)
-                blit(self.innercircle, registration = 5, location = self.left_probe_position)
-                blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                
-                # Static line
-                #blit(self.static_line, registration = 5, location = self.static_line_position)
-
-                # Static line composed of small lines
-                static_line()
-
-                flip()
-
-    def draw_right_line(self):            
-
-        def gaze_line_stimuli():
-            # Face without pupils
-            blit(self.facecircle, registration = 5, location = P.screen_c)
-            blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-            blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-            blit(self.nose, registration = 5, location = P.screen_c)
-            blit(self.mouth, registration = 5, location = self.mouth_position)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-        def exo_line_stimuli():
-            # X-cross
-            blit(self.x_cross1, registration = 5, location = P.screen_c)
-            blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                    
-
-        if self.task_requirement == "rightward real line motion rating":
-            while self.evm.between("target_onset", "line1"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        flip()
-
-            while self.evm.between("line1", "line2"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        flip()
-
-            while self.evm.between("line2", "line3"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        flip()
-
-            while self.evm.between("line3", "line4"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        flip()
-
-            while self.evm.between("line4", "line5"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        flip()
-
-            while self.evm.between("line5", "line6"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        flip()
-
-            while self.evm.between("line6", "line7"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        flip()
-
-            while self.evm.between("line7", "target_offset"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_1_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        flip()
-
-    def draw_left_line(self):            
-
-        def gaze_line_stimuli():
-            # Face without pupils
-            blit(self.facecircle, registration = 5, location = P.screen_c)
-            blit(self.eyecircle, registration = 5, location = self.left_eye_position)
-            blit(self.eyecircle, registration = 5, location = self.right_eye_position)
-            blit(self.nose, registration = 5, location = P.screen_c)
-            blit(self.mouth, registration = 5, location = self.mouth_position)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-
-        def exo_line_stimuli():
-            # X-cross
-            blit(self.x_cross1, registration = 5, location = P.screen_c)
-            blit(self.x_cross2, registration = 5, location = P.screen_c)
-
-            # Probes
-            blit(self.probecircle, registration = 5, location = self.left_probe_position)
-            blit(self.probecircle, registration = 5, location = self.right_probe_position)
-            blit(self.innercircle, registration = 5, location = self.left_probe_position)
-            blit(self.innercircle, registration = 5, location = self.right_probe_position)
-                    
-
-        if self.task_requirement == "leftward real line motion rating":
-            while self.evm.between("target_onset", "line1"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        flip()
-
-            while self.evm.between("line1", "line2"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        flip()
-
-            while self.evm.between("line2", "line3"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        flip()
-
-            while self.evm.between("line3", "line4"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        flip()
-
-            while self.evm.between("line4", "line5"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        flip()
-
-            while self.evm.between("line5", "line6"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        flip()
-
-            while self.evm.between("line6", "line7"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        flip()
-
-            while self.evm.between("line7", "target_offset"):
-                if self.cuing_task_type == "gaze":
-                    fill()
-                    gaze_line_stimuli()
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                    blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                    blit(self.longer_moving_line, registration = 5, location = self.real_line_1_position)
-                    flip()
-                else:
-                    if self.cuing_task_type == "exogenous":
-                        fill()
-                        exo_line_stimuli()
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_8_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_7_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_6_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_5_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_4_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_3_position)
-                        blit(self.shorter_moving_line, registration = 5, location = self.real_line_2_position)
-                        blit(self.longer_moving_line, registration = 5, location = self.real_line_1_position)
-                        flip()
+    def trial_timeline(self, trial):
+        # The (onset, event, display state) timeline for a combination of factor levels
+        events = trial_events(trial["task_requirement"], self.line_motion, 1000.0 / self.refresh_rate)
+        return [(onset, label, self.event_state(label, trial)) for onset, label in events]
+
+    def event_state(self, event, trial):
+        # The display state that begins at a given trial event (None ends the trial display)
+        cuing_task_type = trial["cuing_task_type"]
+        task_requirement = trial["task_requirement"]
+        pre_cue_state = cuing_task_type + "_pre_cue"
+        if event in ["x_cross_on", "cue_offset"]:
+            return pre_cue_state
+        if event == "cue_onset":
+            return "{0}_{1}_cue".format(cuing_task_type, trial["cue_location"])
+        if event == "target_offset":
+            return None
 
+        # Target onset and the moving line segments
+        if task_requirement == "detection":
+            return trial["target_location"] + "_target"
+        if task_requirement == "illusory line motion rating":
+            return cuing_task_type + "_static_line"
+        direction = task_requirement.split(" ")[0]
+        step = self.line_motion[0] if event == "target_onset" else int(event[len("line"):])
+        return "{0}_{1}_line_{2}".format(cuing_task_type, direction, step)
+
+    def present_plan(self, plan):
+        # Present exactly one pre-composited frame per screen refresh, sleeping until just
+        # before each refresh instead of spinning in the render loop
+        target_frame = plan.event_frames["target_onset"]
+        detection = self.task_requirement == "detection" and not self.simulating
+        listening = False
+        for i, state_id in enumerate(plan.state_ids):
+            # Once listening, input is pumped throughout each wait and again just before
+            # each flip, so keypresses are stamped within about a millisecond of being
+            # made (see EventClock) rather than after the next blocking flip
+            poll = self.poll_input if listening else None
+            wake_error = None
+            if self.frame_log.last_flip is not None:
+                deadline = self.frame_log.last_flip + plan.frame_duration - P.frame_draw_lead
+                wake_error = self.waiter.wait_until(deadline, poll)
+            if self.fixation_monitor and self.fixation_monitor.broken():
+                self.abort_trial()
+            if poll:
+                poll()
+            self.present_frame(state_id, wake_error)
+
+            # Read input after every flip, handing keypresses to klibs so the experimenter's
+            # quit and calibrate keys still work during the trial
+            if listening:
+                self.poll_input()
+            events = pump(True)
+            for e in events:
+                if e.type == sdl2.SDL_KEYDOWN:
+                    ui_request(e.key.keysym)
+
+            # Time detection responses from the flip that first showed the target, and
+            # check for responses made while the target is still on screen
+            if i == target_frame:
+                self.target_onset = self.frame_log.last_flip
+                if detection:
+                    self.keypress_listener.arm(self.target_onset)
+                    listening = True
+            elif listening and not self.early_response:
+                self.early_response = self.keypress_listener.listen(events)
+
+    def poll_input(self):
+        # Read pending input into SDL's queue, noting the precise time any new events are read
+        self.event_clock.pump()
+
+    def abort_trial(self):
+        # Gaze left the fixation region, so end the trial display and have klibs recycle
+        # the trial for later in the block
+        latency = self.fixation_monitor.break_latency
+        self.fixation_break_latencies.append(latency)
+        self.keypress_listener.cleanup()
+        # klibs still runs trial_clean_up, so drop the attempt's flips: otherwise they'd be
+        # saved under the same trial number as the recycled trial's own
+        self.frame_log.discard()
+        self.present("fixation")
+        raise TrialException("Fixation broken (detected {0:.1f} ms after gaze left the fixation region)".format(latency))
 
     #######################################################################################
     # FINALIZING THE BASIC CUING DETECTION TASK
     #######################################################################################
     
     def detection_cuing_task(self):
-        if self.cuing_task_type == "gaze":
-            self.gaze_cuing_task()
-            self.gaze_trial_pre_cue_stimuli()
-        else:
-            if self.cuing_task_type == "exogenous":
-                self.exo_cuing_task()
-                self.exo_trial_pre_cue_stimuli()
+        self.target_onset = None
+        self.early_response = None
+        if hasattr(self.gaze_source, "restart"):
+            self.gaze_source.restart()
+        if self.fixation_monitor:
+            self.fixation_monitor.reset()
+        self.frame_log.start()
+        self.present_plan(self.trial_plan)
+        self.present(self.cuing_task_type + "_pre_cue")
 
     #######################################################################################
 
     def block(self):
-        pass
-
-    def setup_response_collector(self):
-        self.rc.uses(KeyPressResponse) # Specify to record key presses
-        self.rc.terminate_after = [1700, TK_MS] # End the collection loop after 1700 ms
-        #self.rc.display_callback = self.resp_callback # Run the self.resp.callback method every loop
-        self.rc.flip = True # draw the screen at the end of every loop
-        self.rc.keypress_listener.key_map = KeyMap('response', ['z', '/', 'b'], ['left', 'right', 'no motion'], [sdl2.SDLK_z, sdl2.SDLK_SLASH, sdl2.SDLK_b]) # Interpret Z-key presses as "left", /-key presses as "right"
-        self.rc.keypress_listener.interrupts = True # end the collection loop if a valid key is pressed
+        # Commit the previous block's trials and frame logs in a single transaction, and
+        # add its trials to the saved session plan
+        self.data_writer.flush()
+        self.save_session_plan()
+
+    def defer_trial_writes(self):
+        # Route the runtime's per-trial inserts into the primary table through the writer
+        db_insert = self.db.insert
+
+        def staged_insert(data, table = None, *args, **kwargs):
+            if table not in [None, P.primary_table]:
+                return db_insert(data, table, *args, **kwargs)
+            row = dict(data)
+            row.setdefault("participant_id", P.participant_id)
+            columns = sorted(row.keys())
+            values = [str(row[col]) if isinstance(row[col], bool) else row[col] for col in columns]
+            self.data_writer.write(P.primary_table, columns, [values])
+
+        self.db.insert = staged_insert
 
     def trial_prep(self):
 
-        # Define stimulus event timings
-        if self.task_requirement == "detection":
-            events = []
-            events.append([100, "x_cross_on"]) # Add in the x-cross after fixation
-            events.append([events[-1][0] + 400, "cue_onset"]) # Add in the cue
-            events.append([events[-1][0] + 50, "cue_offset"]) # Remove the cue
-            events.append([events[-1][0] + 50, "target_onset"]) # Add in the target
-            events.append([events[-1][0] + 50, "target_offset"]) # Remove the target
-        else:
-            if self.task_requirement == "illusory line motion rating":
-                events = []
-                events.append([100, "x_cross_on"]) # Add in the x-cross after fixation
-                events.append([events[-1][0] + 400, "cue_onset"]) # Add in the cue
-                events.append([events[-1][0] + 50, "cue_offset"]) # Remove the cue
-                events.append([events[-1][0] + 50, "target_onset"]) # Add in the target
-                events.append([events[-1][0] + 1000, "target_offset"]) # Remove the line in line motion trials
-            else:
-                events = []
-                events.append([100, "x_cross_on"]) # Add in the x-cross after fixation
-                events.append([events[-1][0] + 400, "cue_onset"]) # Add in the cue
-                events.append([events[-1][0] + 50, "cue_offset"]) # Remove the cue
-                events.append([events[-1][0] + 50, "target_onset"]) # Add in the target
-                events.append([events[-1][0] + 4, "line1"]) # Start adding the real moving line segments
-                events.append([events[-1][0] + 4, "line2"])
-                events.append([events[-1][0] + 4, "line3"])
-                events.append([events[-1][0] + 4, "line4"])
-                events.append([events[-1][0] + 4, "line5"])
-                events.append([events[-1][0] + 4, "line6"])
-                events.append([events[-1][0] + 4, "line7"])
-                events.append([events[-1][0] + 1004, "target_offset"]) # Remove the line in line motion trials
-                
-        for e in events:
-            self.evm.register_ticket(ET(e[1], e[0]))
+        # Look up the trial's precompiled frame-by-frame timeline
+        row = self.session_plan.row(
+            cuing_task_type = self.cuing_task_type, cue_location = self.cue_location,
+            target_location = self.target_location, task_requirement = self.task_requirement
+        )
+        self.trial_plan = self.session_plan.plans[row]
+        self.session_trials.append((P.block_number, P.trial_number, row))
+
+        # Simulated participants start each trial straight away
+        if self.simulating:
+            return
 
         # If the first trial of the block, display message to start.
         if P.run_practice_blocks and P.block_number == 1 and P.trial_number == 1:
             self.trial_start_stimuli()
             flip()
-            blit(self.practice_block_message, registration = 5, location = self.block_start_message_position)
+            self.textures.draw("practice_block_message", registration = 5, location = self.block_start_message_position)
             flip()
             any_key()
         
         if P.block_number == 2 and P.trial_number == 1:
             self.trial_start_stimuli()
             flip()
-            blit(self.block_start_message, registration = 5, location = self.block_start_message_position)
+            self.textures.draw("block_start_message", registration = 5, location = self.block_start_message_position)
             flip()
             any_key()
 
         if P.block_number > 2 and P.trial_number == 1:
             self.trial_start_stimuli()
             flip()
-            blit(self.next_block_message, registration = 5, location = self.block_start_message_position)
+            self.textures.draw("next_block_message", registration = 5, location = self.block_start_message_position)
             flip()
             any_key()
 
         if P.trial_number > 1:
             self.trial_start_stimuli()
             flip()
-            blit(self.next_trial_message, registration = 5, location = self.next_trial_message_posiition)
+            self.textures.draw("next_trial_message", registration = 5, location = self.next_trial_message_posiition)
             flip()
             any_key()
 
     def trial(self):
+        uploads = self.textures.uploads
         self.detection_cuing_task()
         
-        if self.task_requirement == "detection":
-            flip()
-            self.rc.collect()
-            rt = self.rc.keypress_listener.response(False, True)
-            response = self.rc.keypress_listener.response(True, False)
+        if self.simulating:
+            # Synthetic responses, with the virtual clock moved on to the time of response
+            if self.task_requirement == "detection":
+                response, rt = self.responder.keypress(self.target_location)
+            else:
+                response, rt = self.responder.rating(self.task_requirement)
+            self.clock.wait_until(self.target_onset + max(rt, 0))
+        elif self.task_requirement == "detection":
+            if self.early_response:
+                response, rt = self.early_response
+                self.keypress_listener.cleanup()
+            else:
+                response, rt = self.keypress_listener.collect()
         else:
-            fill()
-            blit(self.scale, 5, self.scale_loc)
-            blit(self.motion_rating_message, registration = 5, location = self.motion_rating_message_position)
-            flip()
+            # Show the rating screen before collection starts, so its first draw and flip
+            # aren't counted in the rating's response time
+            self.draw_rating_scale(None)
             response, rt = self.scale_listener.collect()
             print(response, rt)
 
+        self.frame_log.stop()
+        if self.gaze_file:
+            self.save_gaze_samples()
+        if self.textures.uploads != uploads:
+            print("Warning: {0} texture(s) uploaded during trial {1} of block {2}".format(
+                self.textures.uploads - uploads, P.trial_number, P.block_number
+            ))
+
         return {
             "practice": P.practicing,
             "cue_type": self.cuing_task_type,
@@ -1314,28 +981,73 @@ class gaze_ilm(klibs.Experiment):
             "response": response,
             "block_num": P.block_number,
             "trial_num": P.trial_number * P.block_number,
-            "reaction_time": rt
+            "reaction_time": rt,
+            "target_onset": self.target_onset - self.frame_log.first_flip,
+            "dropped_frames": self.frame_log.missed
         }
 
+    def save_gaze_samples(self):
+        # Append the trial's samples to the session's gaze file and index them by trial
+        samples = self.gaze_buffer.since(self.frame_log.first_flip)
+        if len(samples) == len(self.gaze_buffer.samples):
+            print("Warning: gaze_buffer_size is too small to hold a whole trial of samples")
+        offset, count = self.gaze_file.append(samples)
+        row = (P.participant_id, P.block_number, P.trial_number * P.block_number, self.gaze_filename, offset, count)
+        self.data_writer.write("gaze_index", GAZE_INDEX_COLUMNS, [row])
+
     def trial_clean_up(self):
-        pass
+        # Hand the trial's flip log to the writer thread (aborted trials have an empty log)
+        rows = self.frame_log.rows(P.participant_id, P.block_number, P.trial_number * P.block_number)
+        self.data_writer.write("frames", FrameLog.COLUMNS, rows)
 
     def clean_up(self):
-        pass
+        self.data_writer.close()
+        if self.gaze_source:
+            self.gaze_sampler.stop()
+            print("Gaze sampled at {0:.0f} Hz ({1} Hz requested)".format(
+                self.gaze_sampler.achieved_rate or 0, P.gaze_sample_rate
+            ))
+        if self.gaze_file:
+            self.gaze_file.close()
+        if self.fixation_break_latencies:
+            print("Fixation breaks: {0} trials aborted, detected after {1:.1f} ms on average ({2:.1f} ms max)".format(
+                len(self.fixation_break_latencies), np.mean(self.fixation_break_latencies),
+                np.max(self.fixation_break_latencies)
+            ))
+        textures = self.textures.stats()
+        print("Textures: {0} uploads, {1} resident ({2:.1f} MB)".format(
+            textures["uploads"], textures["resident"], textures["bytes"] / 1048576.0
+        ))
+        # The session finished normally, so the next participant sees the whole demo
+        if not self.simulating and os.path.exists(self.demo_resume_path):
+            os.remove(self.demo_resume_path)
+        self.save_session_plan()
 
     def scale_callback(self):
+        # Only redraw the rating screen when the cursor's x position on the scale changes,
+        # and no more than once per screen refresh
+        # Read pending input into SDL's queue first, so a click is stamped before the flip
+        self.poll_input()
         mouse_x, mouse_y = mouse_pos()
-        scale_mid_y = self.scale_bounds.center[1]
-        fill()
-        blit(self.motion_rating_message, registration = 5, location = self.motion_rating_message_position)
-        blit(self.left_motion_rating_message, registration = 5, location = self.left_motion_rating_message_position)
-        blit(self.right_motion_rating_message, registration = 5, location = self.right_motion_rating_message_position)
-        blit(self.no_motion_rating_message, registration = 5, location = self.no_motion_rating_message_position)
-        blit(self.no_motion_rating_line, registration = 5, location = self.scale_loc)
-        blit(self.scale, 5, self.scale_loc)
-        if (mouse_x, mouse_y) in self.scale_bounds:
-            blit(self.scale_mark, 5, (mouse_x, scale_mid_y))
+        mark_x = mouse_x if (mouse_x, mouse_y) in self.scale_bounds else None
+        now = precise_time()
+        if self.scale_drawn_at is not None:
+            unchanged = mark_x == self.scale_mark_x
+            too_soon = now - self.scale_drawn_at < self.frame_log.frame_duration
+            if unchanged or too_soon:
+                # Idle briefly instead of spinning while waiting for input
+                time.sleep(0.0005)
+                return
+        self.draw_rating_scale(mark_x)
+
+    def draw_rating_scale(self, mark_x):
+        # Draw the pre-composited rating screen, with the mark at the given x position (if any)
+        self.textures.draw(("frame", self.state_ids["rating_scale"]))
+        if mark_x is not None:
+            self.textures.draw("scale_mark", registration = 5, location = (mark_x, self.scale_mark_y))
         flip()
+        self.scale_mark_x = mark_x
+        self.scale_drawn_at = precise_time()
 
 
 REGISTRATION_MAP = {
@@ -1360,6 +1072,1120 @@ def bounds_from_blit(rect, location, registration=5):
     return RectangleBoundary('', (x1, y1), (x2, y2))
 
 
+def stimulus_params(stim):
+    """Returns a description of a Drawbject's type and drawing parameters.
+
+    Only plain attribute values (numbers, strings, and lists or tuples of them) are
+    included, so that any change to a stimulus's size, colour, stroke or rotation
+    changes its description.
+
+    """
+    def plain(value):
+        if isinstance(value, (list, tuple)):
+            return all(plain(v) for v in value)
+        return value is None or isinstance(value, (bool, int, float, str))
+
+    params = [(name, value) for name, value in sorted(vars(stim).items()) if plain(value)]
+    return (type(stim).__name__, params)
+
+
+class RasterCache(object):
+    """A persistent on-disk cache of rasterised stimuli.
+
+    Each entry is stored as a .npy file named by a hash of the display geometry and
+    the stimulus's drawing parameters, so entries drawn for a different screen,
+    viewing distance or set of parameters are never reused. Entries are loaded as
+    read-only memory maps.
+
+    Args:
+        path (str): The folder in which to store cached entries. If None, nothing
+            is cached and every stimulus is rasterised as normal.
+        geometry (tuple): The display geometry values to include in every key
+            (e.g. resolution, pixels per inch, and viewing distance).
+
+    Attributes:
+        hits (int): The number of stimuli loaded from the cache.
+        misses (int): The number of stimuli rasterised and added to the cache.
+
+    """
+    def __init__(self, path, geometry):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._geometry = repr(geometry)
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, params):
+        """Returns the cache key for a stimulus's parameters on the current display."""
+        return hashlib.sha1((self._geometry + repr(params)).encode("utf-8")).hexdigest()
+
+    def load(self, params, render):
+        """Returns the cached pixels for a stimulus, rasterising and saving them if needed.
+
+        Args:
+            params: A description of the stimulus (see :func:`stimulus_params`).
+            render (callable): A function returning the stimulus's pixels as an
+                RGBA array, called if the stimulus isn't in the cache.
+
+        """
+        if not self.path:
+            return render()
+        path = os.path.join(self.path, self.key(params) + ".npy")
+        if os.path.exists(path):
+            try:
+                pixels = np.load(path, mmap_mode="r")
+                self.hits += 1
+                return pixels
+            except (IOError, ValueError):
+                pass # Rebuild damaged entries
+        pixels = np.ascontiguousarray(render())
+        # Write to a temporary file first so an interrupted write can't leave a bad entry
+        tmp_path = "{0}.{1}.tmp".format(path, threading.current_thread().ident)
+        with open(tmp_path, "wb") as f:
+            np.save(f, pixels)
+        os.replace(tmp_path, path)
+        self.misses += 1
+        return pixels
+
+
+def premultiply(pixels):
+    """Returns a copy of an RGBA pixel array with its colour channels premultiplied by alpha."""
+    alpha = pixels[:, :, 3:4].astype(np.uint16)
+    premultiplied = np.empty(pixels.shape, dtype=np.uint8)
+    premultiplied[:, :, 0:3] = (pixels[:, :, 0:3] * alpha + 127) // 255
+    premultiplied[:, :, 3:4] = alpha
+    return premultiplied
+
+
+class TextureCache(object):
+    """Keeps pixel arrays on the GPU as persistent textures that can be redrawn cheaply.
+
+    Each texture is uploaded once, with premultiplied alpha, and every later draw only
+    binds it and draws a quad, instead of re-uploading the pixels as :func:`blit`
+    does. Textures are identified by any hashable key.
+
+    Attributes:
+        uploads (int): The total number of texture uploads so far.
+
+    """
+    def __init__(self):
+        self.uploads = 0
+        self._textures = {}
+
+    def upload(self, key, pixels):
+        """Uploads an RGBA pixel array as a texture, if one with the key isn't already loaded."""
+        if key in self._textures:
+            return
+        height, width = pixels.shape[0:2]
+        texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glTexImage2D(
+            GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, width, height, 0, GL.GL_RGBA,
+            GL.GL_UNSIGNED_BYTE, premultiply(np.asarray(pixels))
+        )
+        self._textures[key] = (texture, width, height)
+        self.uploads += 1
+
+    def draw(self, key, pixels=None, registration=7, location=(0, 0)):
+        """Draws a texture to the screen, uploading the given pixels first if needed.
+
+        Args:
+            key: The key of the texture to draw.
+            pixels (:obj:`numpy.ndarray`, optional): The pixels to upload if the
+                texture isn't loaded yet.
+            registration (int, optional): The corner or side of the texture to align
+                with the location, as for :func:`blit`.
+            location (tuple, optional): The (x, y) pixel coordinates to draw at.
+
+        """
+        if key not in self._textures:
+            self.upload(key, pixels)
+        texture, width, height = self._textures[key]
+        x_offset, y_offset = REGISTRATION_MAP[registration]
+        x1 = int(location[0]) + int(width * x_offset)
+        y1 = int(location[1]) + int(height * y_offset)
+        x2, y2 = x1 + width, y1 + height
+
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE, GL.GL_REPLACE)
+        GL.glBlendFunc(GL.GL_ONE, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0, 0)
+        GL.glVertex2f(x1, y1)
+        GL.glTexCoord2f(1, 0)
+        GL.glVertex2f(x2, y1)
+        GL.glTexCoord2f(1, 1)
+        GL.glVertex2f(x2, y2)
+        GL.glTexCoord2f(0, 1)
+        GL.glVertex2f(x1, y2)
+        GL.glEnd()
+        # Restore the blending used by klibs for everything else
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+
+    def release(self, key):
+        """Deletes a texture from the GPU, if it's loaded."""
+        if key in self._textures:
+            texture, width, height = self._textures.pop(key)
+            GL.glDeleteTextures([texture])
+
+    def stats(self):
+        """Returns the number of uploads so far, and the number and total size of loaded textures."""
+        return {
+            "uploads": self.uploads,
+            "resident": len(self._textures),
+            "bytes": sum(width * height * 4 for texture, width, height in self._textures.values()),
+        }
+
+
+class Scene(object):
+    """A display described as named layers of stimuli.
+
+    Layers are always drawn in the order given by :attr:`LAYERS`, regardless of
+    the order they are specified in. Scenes are immutable: use :meth:`with_layers`
+    to derive a new scene that adds, replaces, or removes layers.
+
+    Args:
+        **layers: Lists of ``(stimulus, location)`` tuples for each layer, where
+            each stimulus is a Drawbject or NumpySurface drawn centred at the
+            given location.
+
+    Raises:
+        ValueError: If a layer name is not in :attr:`LAYERS`.
+
+    """
+    LAYERS = ["probes", "fixation", "face", "pupils", "cue", "target", "line", "scale", "text"]
+
+    def __init__(self, **layers):
+        for name in layers.keys():
+            if name not in self.LAYERS:
+                raise ValueError("Unknown scene layer '{0}'.".format(name))
+        self.layers = {name: tuple(entries) for name, entries in layers.items() if entries}
+
+    def with_layers(self, **layers):
+        """Returns a copy of the scene with the given layers replaced.
+
+        Passing an empty list for a layer removes it from the new scene.
+
+        """
+        new_layers = dict(self.layers)
+        new_layers.update(layers)
+        return Scene(**new_layers)
+
+    def entries(self):
+        """Returns a list of ``(layer, stimulus, location)`` tuples in draw order."""
+        entries = []
+        for name in self.LAYERS:
+            for stim, location in self.layers.get(name, ()):
+                entries.append((name, stim, tuple(location)))
+        return entries
+
+
+class SceneRenderer(object):
+    """Composites scenes onto a persistent full-screen canvas.
+
+    Each call to :meth:`render` diffs the new scene against the previous one and
+    only clears and redraws the rectangles covered by stimuli that were added or
+    removed, e.g. a single segment appearing during real line motion. The
+    rendered pixels of each stimulus are cached, so each is only rasterised once.
+
+    Args:
+        raster_cache (:obj:`RasterCache`, optional): An on-disk cache to load
+            stimulus pixels from (and save them to) instead of always rasterising them.
+
+    """
+    def __init__(self, raster_cache=None):
+        self.canvas = np.zeros((P.screen_y, P.screen_x, 4), dtype=np.uint8)
+        self.canvas[:, :] = P.default_fill_color
+        self.dirty = []
+        self.raster_cache = raster_cache
+        self._scene = Scene()
+        self._rendered = {}
+
+    def _pixels(self, stim):
+        # Keep a reference to each stimulus so its id can't be reused by another
+        if id(stim) not in self._rendered:
+            if isinstance(stim, np.ndarray):
+                pixels = stim
+            elif self.raster_cache:
+                pixels = self.raster_cache.load(stimulus_params(stim), stim.render)
+            else:
+                pixels = stim.render()
+            self._rendered[id(stim)] = (stim, pixels)
+        return self._rendered[id(stim)][1]
+
+    def prepare(self, stim):
+        """Rasterises a stimulus ahead of time, so later renders can reuse its pixels."""
+        return self._pixels(stim)
+
+    def _bounds(self, stim, location):
+        height, width = self._pixels(stim).shape[0:2]
+        x_offset, y_offset = REGISTRATION_MAP[5]
+        x1 = int(location[0]) + int(width * x_offset)
+        y1 = int(location[1]) + int(height * y_offset)
+        return (x1, y1, x1 + width, y1 + height)
+
+    def render(self, scene):
+        """Updates the canvas to show the given scene.
+
+        Args:
+            scene (:obj:`Scene`): The scene to render.
+
+        Returns:
+            :obj:`numpy.ndarray`: The canvas, as an RGBA pixel array the size of
+            the screen. This array is reused by later renders, so it should be
+            copied if it needs to be kept.
+
+        """
+        # Entries are compared by stimulus identity, since stimuli such as rasterised
+        # messages are pixel arrays (which can't be hashed or compared by value)
+        entries = scene.entries()
+        old = {(layer, id(stim), location): stim for layer, stim, location in self._scene.entries()}
+        new = {(layer, id(stim), location): stim for layer, stim, location in entries}
+        changed = set(old) ^ set(new)
+        self.dirty = [
+            self._bounds(new[key] if key in new else old[key], key[2]) for key in changed
+        ]
+        for rect in self.dirty:
+            x1, y1, x2, y2 = rect
+            self.canvas[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)] = P.default_fill_color
+            for layer, stim, location in entries:
+                sx1, sy1, sx2, sy2 = self._bounds(stim, location)
+                if sx1 < x2 and x1 < sx2 and sy1 < y2 and y1 < sy2:
+                    blend_onto(self.canvas, self._pixels(stim), location, clip=rect)
+        self._scene = scene
+        return self.canvas
+
+
+def blend_onto(canvas, content, location, registration=5, clip=None):
+    x_offset, y_offset = REGISTRATION_MAP[registration]
+    height, width = content.shape[0:2]
+    x1 = int(location[0]) + int(width * x_offset)
+    y1 = int(location[1]) + int(height * y_offset)
+    # Clip the content to the edges of the canvas and the clip rectangle, if any
+    cx1, cy1, cx2, cy2 = clip if clip else (0, 0, canvas.shape[1], canvas.shape[0])
+    cx1, cy1 = max(x1, cx1, 0), max(y1, cy1, 0)
+    cx2, cy2 = min(x1 + width, cx2, canvas.shape[1]), min(y1 + height, cy2, canvas.shape[0])
+    if cx1 >= cx2 or cy1 >= cy2:
+        return
+    src = content[cy1-y1:cy2-y1, cx1-x1:cx2-x1].astype(np.uint16)
+    dst = canvas[cy1:cy2, cx1:cx2]
+    alpha = src[:, :, 3:4]
+    blended = src[:, :, :3] * alpha + dst[:, :, :3].astype(np.uint16) * (255 - alpha)
+    dst[:, :, :3] = (blended + 127) // 255
+
+
+def trial_events(task_requirement, line_motion=None, frame_duration=None):
+    """Returns the ``(onset, event)`` timings (in ms) for a trial's task requirement.
+
+    For real line motion trials, ``line_motion`` is the number of segments to show
+    on each frame (see :func:`line_motion_schedule`) and ``frame_duration`` is the
+    duration of a frame (in ms). Each frame that adds segments gets a 'lineN' event,
+    where N is the number of segments shown.
+
+    """
+    events = []
+    events.append([100, "x_cross_on"]) # Add in the x-cross after fixation
+    events.append([events[-1][0] + 400, "cue_onset"]) # Add in the cue
+    events.append([events[-1][0] + 50, "cue_offset"]) # Remove the cue
+    events.append([events[-1][0] + 50, "target_onset"]) # Add in the target
+    if task_requirement == "detection":
+        events.append([events[-1][0] + 50, "target_offset"]) # Remove the target
+    elif task_requirement == "illusory line motion rating":
+        events.append([events[-1][0] + 1000, "target_offset"]) # Remove the line in line motion trials
+    else:
+        motion_onset = events[-1][0]
+        for frame in range(1, len(line_motion)):
+            if line_motion[frame] != line_motion[frame - 1]:
+                onset = motion_onset + frame * frame_duration
+                events.append([onset, "line{0}".format(line_motion[frame])]) # Add the real moving line segments
+        full_line_onset = motion_onset + (len(line_motion) - 1) * frame_duration
+        events.append([full_line_onset + P.line_motion_hold, "target_offset"]) # Remove the line in line motion trials
+    return events
+
+
+def factor_levels(factors):
+    """Returns the unique levels of each trial factor, in the order given.
+
+    Repeated levels and ``(level, count)`` weights only change how often a level is
+    drawn, so each level is listed once.
+
+    Args:
+        factors (dict): The levels of each factor, as given to the experiment's
+            FactorSet.
+
+    """
+    levels = []
+    for name, values in factors.items():
+        unique = []
+        for value in values:
+            if isinstance(value, tuple):
+                value = value[0]
+            if value not in unique:
+                unique.append(value)
+        levels.append((name, unique))
+    return levels
+
+
+class BackgroundBuilder(threading.Thread):
+    """Builds a sequence of items (e.g. demo slides or frames) on a background thread.
+
+    Items are built in order, so the first item is usually ready almost
+    immediately and later items are built while earlier ones are in use.
+    Once built, every item is kept (until :meth:`release` is called), so moving
+    back and forth through them doesn't require rebuilding anything.
+
+    Args:
+        build (callable): A function taking an item index and returning the
+            built item.
+        count (int): The number of items to build.
+
+    """
+    def __init__(self, build, count):
+        super(BackgroundBuilder, self).__init__()
+        self.daemon = True
+        self._build = build
+        self._items = [None] * count
+        self._ready = [threading.Event() for i in range(count)]
+        self._error = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def run(self):
+        try:
+            for i in range(len(self._items)):
+                self._items[i] = self._build(i)
+                self._ready[i].set()
+        except Exception as e:
+            # Hand the error to the main thread instead of leaving it waiting
+            self._error = e
+            for ready in self._ready:
+                ready.set()
+
+    def item(self, i):
+        """Returns a built item, waiting for it to be built if needed."""
+        self._ready[i].wait()
+        if self._error:
+            raise self._error
+        return self._items[i]
+
+    def items(self):
+        """Returns every item, waiting for them all to be built if needed."""
+        return [self.item(i) for i in range(len(self._items))]
+
+    def release(self):
+        """Frees every built item (and anything the build function holds on to).
+
+        Waits for building to finish first. Items can't be retrieved afterwards.
+
+        """
+        self.join()
+        self._items = [None] * len(self._items)
+        self._build = None
+
+
+class StartupProfile(object):
+    """Records how long each stage of startup takes.
+
+    Stage times are measured between consecutive calls to :meth:`mark`, and the
+    time taken to first render each stimulus is recorded separately. Times are
+    in milliseconds on the :func:`precise_time` clock.
+
+    Attributes:
+        stages (list): The ``(stage, duration)`` of each stage, in order.
+        stimuli (dict): The time taken to first render each named stimulus.
+        first_frame (float): The wall-clock time (from :func:`time.time`) at which
+            the first frame was shown, or None if it hasn't been yet.
+
+    """
+    def __init__(self):
+        self.stages = []
+        self.stimuli = {}
+        self.first_frame = None
+        self._started = precise_time()
+        self._last = self._started
+
+    def mark(self, stage):
+        """Records the time taken by a stage, since the previous mark."""
+        now = precise_time()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def record(self, stage, duration):
+        """Records the time taken by a stage that was timed separately (e.g. on another thread)."""
+        self.stages.append((stage, duration))
+
+    def time_stimulus(self, name, render, stim):
+        """Renders a stimulus, recording the time taken the first time it's rendered."""
+        if name in self.stimuli:
+            return render(stim)
+        start = precise_time()
+        result = render(stim)
+        self.stimuli[name] = precise_time() - start
+        return result
+
+    def mark_first_frame(self):
+        """Records the time at which the first frame was shown."""
+        if self.first_frame is None:
+            self.first_frame = time.time()
+            self.mark("first frame")
+
+    def save(self, path, **info):
+        """Writes the profile to a JSON file, along with any additional values."""
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        profile = {
+            "stages": [[stage, duration] for stage, duration in self.stages],
+            "stimuli": self.stimuli,
+            "first_frame": self.first_frame,
+            "total": self._last - self._started,
+        }
+        profile.update(info)
+        with open(path, "w") as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+
+
+class SessionPlan(object):
+    """A precompiled table of the frame-by-frame timeline of every possible trial.
+
+    Every combination of factor levels is assigned an integer row, with each level
+    stored as an integer code, and its timeline is compiled once into a
+    :obj:`FramePlan` whose display states are integer ids. Preparing a trial is then a
+    lookup of its row, and presenting it is a walk over an array of state ids.
+
+    Args:
+        factors (list): The ``(name, levels)`` of each trial factor.
+        timeline (callable): A function taking a dict of factor levels and returning
+            the trial's ``(onset, label, state)`` events (see :obj:`FramePlan`).
+        state_ids (dict): The integer id of each display state.
+        refresh_rate (float): The refresh rate of the display (in Hz).
+        initial_state (str): The display state shown at the start of each trial.
+
+    Attributes:
+        factors (list): The name of each factor, in column order.
+        levels (dict): The levels of each factor, indexed by their integer codes.
+        codes (:obj:`numpy.ndarray`): The level code of each factor for each row.
+        plans (list): The compiled :obj:`FramePlan` for each row.
+        warnings (list): Descriptions of any timings that couldn't be honoured.
+
+    """
+    def __init__(self, factors, timeline, state_ids, refresh_rate, initial_state):
+        self.factors = [name for name, levels in factors]
+        self.levels = dict(factors)
+        self.refresh_rate = refresh_rate
+        self._codes = {
+            name: {level: code for code, level in enumerate(levels)} for name, levels in factors
+        }
+        sizes = [len(levels) for name, levels in factors]
+        self._strides = [int(np.prod(sizes[i + 1:])) for i in range(len(sizes))]
+        self.codes = np.array(list(itertools.product(*[range(n) for n in sizes])), dtype=np.int16)
+
+        self.plans = []
+        self.warnings = []
+        for row_codes in self.codes:
+            trial = {name: self.levels[name][code] for name, code in zip(self.factors, row_codes)}
+            events = timeline(trial)
+            plan = FramePlan(events, refresh_rate, initial_state)
+            plan.state_ids = np.array([state_ids[state] for state in plan.states], dtype=np.int16)
+            self.plans.append(plan)
+            for warning in plan.warnings:
+                if warning not in self.warnings:
+                    self.warnings.append(warning)
+        self._state_names = sorted(state_ids, key=state_ids.get)
+
+    def row(self, **levels):
+        """Returns the row of the plan for a given set of factor levels."""
+        return sum(self._codes[name][levels[name]] * stride for name, stride in zip(self.factors, self._strides))
+
+    def save(self, path, trials=None, **info):
+        """Writes the plan, and any timing warnings, to a JSON file for auditing.
+
+        Args:
+            path (str): The path of the file to write.
+            trials (list, optional): The ``(block, trial, row)`` of each trial run.
+            **info: Any additional values to record (e.g. the random seed).
+
+        """
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        plan = {
+            "factors": self.factors,
+            "levels": self.levels,
+            "refresh_rate": self.refresh_rate,
+            "states": self._state_names,
+            "rows": [
+                {
+                    "codes": codes.tolist(),
+                    "state_ids": p.state_ids.tolist(),
+                    "event_frames": p.event_frames,
+                }
+                for codes, p in zip(self.codes, self.plans)
+            ],
+            "trials": [list(t) for t in trials] if trials else [],
+            "warnings": self.warnings,
+        }
+        plan.update(info)
+        with open(path, "w") as f:
+            json.dump(plan, f)
+
+
+def benchmark_routine(routine, frames, warmup=5, reset=None):
+    """Calls a display routine repeatedly and summarizes how long each call takes.
+
+    Args:
+        routine (callable): The routine to time, taking no arguments.
+        frames (int): The number of timed calls.
+        warmup (int, optional): The number of untimed calls to make first.
+        reset (callable, optional): A function to call before each call of the
+            routine, outside of the timing (e.g. to undo the previous call's work).
+
+    Returns:
+        dict: The mean frame rate (``fps``) and the mean, median, 95th and 99th
+        percentile, and maximum per-call latency (in ms).
+
+    """
+    for i in range(warmup):
+        if reset:
+            reset()
+        routine()
+    latencies = np.empty(frames)
+    for i in range(frames):
+        if reset:
+            reset()
+        start = precise_time()
+        routine()
+        latencies[i] = precise_time() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "fps": 1000.0 / latencies.mean() if latencies.mean() > 0 else None,
+        "mean": float(latencies.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(latencies.max()),
+    }
+
+
+def precise_time():
+    """Returns the current time (in ms) on the high-resolution performance counter.
+
+    This is the clock used for all flip, wait and response timestamps.
+
+    """
+    return time.perf_counter() * 1000
+
+
+class VirtualClock(object):
+    """A simulated clock that jumps straight to deadlines instead of waiting for them.
+
+    Calling the clock returns the current virtual time in milliseconds, so it can be
+    used anywhere :func:`precise_time` is, and its :meth:`wait_until` method can
+    stand in for :meth:`HybridWaiter.wait_until`.
+
+    """
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def wait_until(self, deadline, poll=None, poll_interval=1.0):
+        """Advances the clock to the given time, if it isn't already past it.
+
+        If a ``poll`` function is given, it's called at each ``poll_interval`` (in ms)
+        on the way, as :meth:`HybridWaiter.wait_until` would while waiting.
+
+        Returns:
+            float: The wake-up error, which is always zero.
+
+        """
+        if poll:
+            while True:
+                poll()
+                if self.time + poll_interval >= deadline:
+                    break
+                self.time += poll_interval
+        self.time = max(self.time, deadline)
+        return 0.0
+
+
+class SimulatedDisplay(object):
+    """A stand-in for a vsync-locked display, driven by a :obj:`VirtualClock`.
+
+    Each flip advances the clock to the next refresh, occasionally missing one or
+    more refreshes at random to simulate dropped frames.
+
+    Args:
+        clock (:obj:`VirtualClock`): The clock to advance.
+        refresh_rate (float): The simulated refresh rate (in Hz).
+        drop_rate (float, optional): The probability of missing each refresh deadline.
+
+    """
+    def __init__(self, clock, refresh_rate, drop_rate=0.0):
+        self.clock = clock
+        self.frame_duration = 1000.0 / refresh_rate
+        self.drop_rate = drop_rate
+
+    def flip(self):
+        """Advances the clock to the refresh at which the next frame would appear."""
+        next_refresh = (int(self.clock.time / self.frame_duration) + 1) * self.frame_duration
+        while random.random() < self.drop_rate:
+            next_refresh += self.frame_duration
+        self.clock.wait_until(next_refresh)
+
+
+class SyntheticResponder(object):
+    """A simulated participant that produces keypress and scale responses.
+
+    Args:
+        detection_rt (tuple): The ``(mean, sd)`` of detection response times (in ms).
+        error_rate (float): The probability of responding to the wrong side.
+        rating_rt (tuple): The ``(mean, sd)`` of scale response times (in ms).
+        ratings (dict): The ``(mean, sd)`` of scale ratings (from 0 for leftward to
+            1 for rightward motion) for each line motion task requirement.
+        timeout (float, optional): The detection response timeout (in ms). Slower
+            simulated responses are recorded as misses.
+
+    """
+    def __init__(self, detection_rt, error_rate, rating_rt, ratings, timeout=None):
+        self.detection_rt = detection_rt
+        self.error_rate = error_rate
+        self.rating_rt = rating_rt
+        self.ratings = ratings
+        self.timeout = timeout
+
+    def keypress(self, target_location):
+        """Returns a simulated ``(response, rt)`` for a detection target."""
+        rt = max(random.gauss(*self.detection_rt), 1.0)
+        if self.timeout and rt > self.timeout:
+            return (NO_RESPONSE, -1)
+        response = target_location
+        if random.random() < self.error_rate:
+            response = "left" if target_location == "right" else "right"
+        return (response, rt)
+
+    def rating(self, task_requirement):
+        """Returns a simulated ``(rating, rt)`` for a line motion trial."""
+        rating = min(max(random.gauss(*self.ratings[task_requirement]), 0.0), 1.0)
+        rt = max(random.gauss(*self.rating_rt), 1.0)
+        return (rating, rt)
+
+
+class FrameLog(object):
+    """A lightweight log of the time and display state of every flip in a trial.
+
+    Timestamps are taken from the high-resolution performance counter right after
+    each flip returns and are kept in memory until the end of the trial, so that
+    logging adds no I/O to the render loop.
+
+    Args:
+        refresh_rate (float): The refresh rate of the display (in Hz), used to
+            count the number of refresh deadlines missed between flips.
+        clock (callable, optional): A function returning the current time in ms.
+            Defaults to :func:`precise_time`.
+
+    """
+    COLUMNS = [
+        "participant_id", "block_num", "trial_num", "frame", "state", "flip_time", "missed",
+        "wake_error",
+    ]
+
+    def __init__(self, refresh_rate, clock=None):
+        self.frame_duration = 1000.0 / refresh_rate
+        self._clock = clock if clock else precise_time
+        self._recording = False
+        self._states = []
+        self._times = []
+        self._wake_errors = []
+
+    def start(self):
+        """Clears the log and starts recording flips."""
+        self._states = []
+        self._times = []
+        self._wake_errors = []
+        self._recording = True
+
+    def stop(self):
+        """Stops recording flips, keeping the existing log."""
+        self._recording = False
+
+    def discard(self):
+        """Stops recording flips and clears the log (e.g. for an aborted trial)."""
+        self._states = []
+        self._times = []
+        self._wake_errors = []
+        self._recording = False
+
+    def record(self, state, wake_error=None):
+        """Records a flip showing the given display state, if recording.
+
+        Args:
+            state (str): The display state shown by the flip.
+            wake_error (float, optional): How late (in ms) the render loop woke up
+                for this frame, if it waited for it.
+
+        """
+        if self._recording:
+            self._times.append(self._clock())
+            self._states.append(state)
+            self._wake_errors.append(wake_error)
+
+    @property
+    def first_flip(self):
+        """float: The time (in ms) of the first flip in the log, or None."""
+        return self._times[0] if self._times else None
+
+    @property
+    def last_flip(self):
+        """float: The time (in ms) of the most recent flip in the log, or None."""
+        return self._times[-1] if self._times else None
+
+    def _missed(self, i):
+        # The number of refresh deadlines missed between flip i-1 and flip i
+        if i == 0:
+            return 0
+        interval = self._times[i] - self._times[i - 1]
+        return max(0, int(round(interval / self.frame_duration)) - 1)
+
+    @property
+    def missed(self):
+        """int: The total number of refresh deadlines missed during the log."""
+        return sum(self._missed(i) for i in range(len(self._times)))
+
+    def rows(self, participant_id, block_num, trial_num):
+        """Returns the log as a list of rows for the 'frames' table.
+
+        Flip times are in milliseconds relative to the first flip of the log.
+
+        """
+        if not self._times:
+            return []
+        t0 = self._times[0]
+        return [
+            (participant_id, block_num, trial_num, i, state, t - t0, self._missed(i), err)
+            for i, (state, t, err) in enumerate(zip(self._states, self._times, self._wake_errors))
+        ]
+
+
+GAZE_INDEX_COLUMNS = ["participant_id", "block_num", "trial_num", "file", "byte_offset", "sample_count"]
+
+
+class GazeRingBuffer(object):
+    """A fixed-size buffer holding the most recent gaze samples.
+
+    Samples are written by a single thread (see :obj:`GazeSampler`) and can be read
+    from any other. Once the buffer is full, the oldest samples are overwritten.
+
+    Args:
+        size (int): The number of samples to keep.
+
+    """
+    def __init__(self, size):
+        self.samples = np.zeros(size, dtype=GAZE_SAMPLE)
+        self.count = 0
+
+    def append(self, timestamp, x, y, pupil=np.nan, flags=0):
+        """Adds a gaze sample to the buffer."""
+        self.samples[self.count % len(self.samples)] = (timestamp, x, y, pupil, flags)
+        self.count += 1
+
+    def latest(self, n):
+        """Returns (a copy of) the most recent n samples, oldest first."""
+        count = self.count
+        n = min(n, count, len(self.samples))
+        return self.samples[np.arange(count - n, count) % len(self.samples)]
+
+    def since(self, timestamp):
+        """Returns (a copy of) every sample still in the buffer taken at or after a given time."""
+        samples = self.latest(len(self.samples))
+        return samples[samples["time"] >= timestamp]
+
+
+class GazeSampler(threading.Thread):
+    """Polls a gaze source at a fixed rate on a background thread, filling a ring buffer.
+
+    The thread sleeps between samples rather than spinning, since a spinning thread
+    would hold the GIL and delay the render loop. The achieved rate is therefore
+    limited by the OS sleep granularity: about 1 ms on Windows while SDL holds the
+    system timer at 1 ms resolution (so 500 to 1000 Hz in practice), and
+    well under 1 ms on Linux and macOS. Every sample is stamped with the time it was
+    taken, and the rate actually achieved is reported by :attr:`achieved_rate`.
+
+    Args:
+        source (callable): A function returning the current gaze position as an
+            ``(x, y)`` or ``(x, y, pupil)`` tuple in pixels, or None if no gaze
+            position is available (recorded as a sample flagged as missing).
+        buffer (:obj:`GazeRingBuffer`): The buffer to add samples to.
+        rate (float, optional): The sampling rate (in Hz).
+
+    """
+    def __init__(self, source, buffer, rate=1000.0):
+        super(GazeSampler, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.buffer = buffer
+        self.interval = 1.0 / rate
+        self.sample_count = 0
+        self._started = None
+        self._stopped = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        next_sample = self._started = time.perf_counter()
+        while not self._stopping.is_set():
+            sample = self.source()
+            if sample is None:
+                self.buffer.append(precise_time(), np.nan, np.nan, flags=MISSING)
+            else:
+                self.buffer.append(precise_time(), *sample)
+            self.sample_count += 1
+            next_sample += self.interval
+            delay = next_sample - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.perf_counter()
+        self._stopped = time.perf_counter()
+
+    @property
+    def achieved_rate(self):
+        """float: The mean number of samples taken per second, or None before sampling."""
+        if self._started is None:
+            return None
+        elapsed = (self._stopped or time.perf_counter()) - self._started
+        return self.sample_count / elapsed if elapsed > 0 else None
+
+    def stop(self):
+        """Stops sampling and waits for the thread to finish."""
+        self._stopping.set()
+        self.join()
+
+
+class MouseGazeSource(object):
+    """A simulated eye tracker that reports the mouse cursor as the gaze position.
+
+    The cursor is read from the desktop-wide mouse state, which SDL queries from the
+    OS directly, rather than the window's mouse state, which only changes when the
+    main thread pumps events (and so wouldn't move during the cue period of a trial).
+    The window's position is read once, on the main thread, when the source is made.
+
+    Args:
+        scale (tuple, optional): The ``(x, y)`` factors converting window coordinates
+            to drawing pixels (e.g. on high-DPI displays).
+
+    """
+    def __init__(self, scale=(1.0, 1.0)):
+        x, y = ctypes.c_int(0), ctypes.c_int(0)
+        sdl2.SDL_GetWindowPosition(sdl2.SDL_GL_GetCurrentWindow(), ctypes.byref(x), ctypes.byref(y))
+        self.origin = (x.value, y.value)
+        self.scale = scale
+
+    def __call__(self):
+        x, y = ctypes.c_int(0), ctypes.c_int(0)
+        sdl2.SDL_GetGlobalMouseState(ctypes.byref(x), ctypes.byref(y))
+        return ((x.value - self.origin[0]) * self.scale[0], (y.value - self.origin[1]) * self.scale[1])
+
+
+class TraceGazeSource(object):
+    """A simulated eye tracker that replays a scripted gaze trace on each trial.
+
+    The trace is a .npy or comma-separated text file with one row per sample,
+    giving the time (in ms from the start of the trial) and the horizontal and
+    vertical gaze position (in degrees from the screen centre). Each position is
+    reported until the time of the next one.
+
+    Args:
+        path (str): The path of the trace file.
+        ppd (float): The number of pixels per degree of visual angle.
+        centre (tuple): The (x, y) pixel coordinates of the screen centre.
+
+    """
+    def __init__(self, path, ppd, centre):
+        trace = np.load(path) if path.endswith(".npy") else np.loadtxt(path, delimiter=",", ndmin=2)
+        self.times = trace[:, 0]
+        self.x = centre[0] + trace[:, 1] * ppd
+        self.y = centre[1] + trace[:, 2] * ppd
+        self._start = precise_time()
+
+    def restart(self):
+        """Starts replaying the trace from the beginning."""
+        self._start = precise_time()
+
+    def __call__(self):
+        i = np.searchsorted(self.times, precise_time() - self._start, side="right") - 1
+        if i < 0:
+            return None
+        return (self.x[i], self.y[i])
+
+
+class FixationMonitor(object):
+    """Checks whether gaze has left a circular fixation region.
+
+    Each check tests the latest window of samples in a :obj:`GazeRingBuffer` at once.
+    Fixation counts as broken when every sample in the window is outside the region,
+    so single noisy samples are ignored (as are missing samples).
+
+    Args:
+        buffer (:obj:`GazeRingBuffer`): The buffer gaze is being sampled into.
+        centre (tuple): The (x, y) pixel coordinates of the centre of the region.
+        radius (float): The radius of the region (in pixels).
+        window (int): The number of consecutive samples outside the region that
+            count as a break in fixation.
+
+    Attributes:
+        break_latency (float): The time (in ms) between the first sample of the most
+            recent break and its detection, or None if fixation hasn't been broken.
+
+    """
+    def __init__(self, buffer, centre, radius, window):
+        self.buffer = buffer
+        self.centre = centre
+        self.radius = radius
+        self.window = window
+        self.break_latency = None
+        self._since = precise_time()
+
+    def reset(self):
+        """Ignores any samples taken before now (e.g. at the start of a trial)."""
+        self._since = precise_time()
+        self.break_latency = None
+
+    def broken(self):
+        """Returns True if every sample in the latest window is outside the region."""
+        samples = self.buffer.latest(self.window)
+        samples = samples[samples["time"] >= self._since]
+        if len(samples) < self.window:
+            return False
+        dx = samples["x"] - self.centre[0]
+        dy = samples["y"] - self.centre[1]
+        if not np.all(dx * dx + dy * dy > self.radius * self.radius):
+            return False
+        self.break_latency = precise_time() - samples["time"][0]
+        return True
+
+
+class HybridWaiter(object):
+    """Waits for deadlines by sleeping until shortly before them and then spinning.
+
+    Sleeping for most of a wait keeps the CPU free for the compositor and the
+    display driver, while spinning for the final fraction of a millisecond
+    avoids the coarse wake-up granularity of the OS scheduler.
+
+    Args:
+        spin_threshold (float): How long (in ms) before a deadline to stop
+            sleeping and start spinning.
+
+    """
+    def __init__(self, spin_threshold):
+        self.spin_threshold = spin_threshold
+
+    def wait_until(self, deadline, poll=None, poll_interval=1.0):
+        """Waits until the given performance counter time.
+
+        Args:
+            deadline (float): The time to wait until, in milliseconds on the
+                :func:`time.perf_counter` clock.
+            poll (callable, optional): A function to call about every
+                ``poll_interval`` ms while sleeping (e.g. to pump input events, so
+                they're stamped while waiting instead of after the next flip).
+            poll_interval (float, optional): How often (in ms) to call ``poll``.
+
+        Returns:
+            float: The wake-up error, i.e. how late (in ms) the wait ended
+            relative to the deadline.
+
+        """
+        while True:
+            if poll:
+                poll()
+            remaining = deadline - precise_time()
+            if remaining <= self.spin_threshold:
+                break
+            nap = remaining - self.spin_threshold
+            time.sleep((min(nap, poll_interval) if poll else nap) / 1000.0)
+        while precise_time() < deadline:
+            pass
+        return precise_time() - deadline
+
+
+def queued_events():
+    """Returns the number of events waiting in SDL's event queue."""
+    return sdl2.SDL_PeepEvents(None, 0, sdl2.SDL_PEEKEVENT, sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT)
+
+
+class EventClock(object):
+    """Timestamps SDL input events on the :func:`precise_time` clock.
+
+    SDL stamps each event with its tick count (in whole milliseconds) when a pump of
+    the event queue reads it from the OS. Pumping the queue with :meth:`pump` also
+    records the precise time of every pump that reads new events, so events read by
+    those pumps are timed to well under a millisecond. Events read by any other pump
+    (e.g. klibs' own) are timed by converting their tick timestamps instead, to the
+    millisecond. Either way, events are timed from when they're read, so the queue
+    should be pumped often (e.g. throughout each wait for the next frame).
+
+    Args:
+        ticks (callable, optional): A function returning the SDL tick count (in ms).
+            Defaults to :func:`sdl2.SDL_GetTicks`.
+        clock (callable, optional): A function returning the current time in ms.
+            Defaults to :func:`precise_time`.
+        pump_events (callable, optional): A function reading pending input into the
+            event queue. Defaults to :func:`sdl2.SDL_PumpEvents`.
+        queued (callable, optional): A function returning the number of events in
+            the queue. Defaults to :func:`queued_events`.
+
+    """
+    def __init__(self, ticks=None, clock=None, pump_events=None, queued=None):
+        self._ticks = ticks if ticks else sdl2.SDL_GetTicks
+        self._clock = clock if clock else precise_time
+        self._pump_events = pump_events if pump_events else sdl2.SDL_PumpEvents
+        self._queued = queued if queued else queued_events
+        self._pumps = []
+        self.offset = None
+
+    def sync(self):
+        """Measures the offset between the SDL tick clock and the precise clock.
+
+        The offset is measured at the start of a tick (waiting at most a couple of
+        milliseconds for one), so converted timestamps mark the start of the
+        millisecond in which each event was read. The times of earlier pumps are
+        forgotten, so this should be called after the queue is flushed.
+
+        """
+        ticks = self._ticks()
+        give_up = time.perf_counter() + 0.002
+        while self._ticks() == ticks and time.perf_counter() < give_up:
+            pass
+        self.offset = self._clock() - self._ticks()
+        self._pumps = []
+
+    def pump(self):
+        """Reads pending input into the event queue, recording when any new events were read."""
+        queued = self._queued()
+        start = self._ticks()
+        self._pump_events()
+        read_at = self._clock()
+        if self._queued() > queued:
+            # Only recent pumps are needed to time the events still waiting in the queue
+            self._pumps.append((start, self._ticks(), read_at))
+            del self._pumps[:-64]
+
+    def __call__(self, event):
+        """Returns the time of an SDL event (in ms on the precise clock)."""
+        timestamp = event.common.timestamp
+        for start, end, read_at in self._pumps:
+            if start <= timestamp <= end:
+                return read_at
+        if self.offset is None:
+            self.sync()
+        return timestamp + self.offset
+
+
 class ScaleListener(BaseResponseListener):
     """A convenience class for collecting continuous scale responses.
 
@@ -1376,11 +2202,14 @@ class ScaleListener(BaseResponseListener):
             color response. Defaults to None (no timeout).
         loop_callback (callable, optional): An optional function or method to be
             called every time the collection loop checks for new input.
+        event_clock (:obj:`EventClock`, optional): The clock used to time clicks
+            from when they're read.
 
     """
-    def __init__(self, bounds, start_pos=None, timeout=None, loop_callback=None):
+    def __init__(self, bounds, start_pos=None, timeout=None, loop_callback=None, event_clock=None):
         super(ScaleListener, self).__init__(timeout, loop_callback)
         self.default_response = (None, -1)
+        self._event_clock = event_clock if event_clock else EventClock()
         self._cursor_was_hidden = False
         self._start_pos = start_pos if start_pos else P.screen_c
         if not isinstance(bounds, RectangleBoundary):
@@ -1388,7 +2217,7 @@ class ScaleListener(BaseResponseListener):
         self._bounds = bounds
 
     def _timestamp(self):
-        return sdl2.SDL_GetTicks()
+        return precise_time()
         
     def _get_scale_pos(self, cursor_pos):
         if not pos in self._bounds:
@@ -1411,6 +2240,7 @@ class ScaleListener(BaseResponseListener):
         mouse_pos(position=self._start_pos)
         # Clear any existing events in the queue and set the response start time
         flush()
+        self._event_clock.sync()
         self._loop_start = self._timestamp()
 
     def listen(self, q):
@@ -1428,6 +2258,8 @@ class ScaleListener(BaseResponseListener):
             clicked, otherwise None.
 
         """
+        # Clicks are timed from when they were read from the OS, on the same clock as the
+        # flips, so time spent redrawing the scale between checks isn't added to the RT
         for e in q:
             if e.type == sdl2.SDL_MOUSEBUTTONUP:
                 # First, ensure mouse click was within the scale boundary
@@ -1437,7 +2269,7 @@ class ScaleListener(BaseResponseListener):
                 # Next, calculate where the click was relative to the scale
                 x1 = self._bounds.p1[0]
                 resp = (pos[0] - x1) / self._bounds.width
-                rt = e.button.timestamp - self._loop_start
+                rt = self._event_clock(e) - self._loop_start
                 return (resp, rt)
         return None
 
@@ -1454,4 +2286,92 @@ class ScaleListener(BaseResponseListener):
         """
         self._loop_start = None
         if self._cursor_was_hidden:
-            sdl2.ext.hide_cursor()
\ No newline at end of file
+            sdl2.ext.hide_cursor()
+
+
+class TimedKeypressListener(BaseResponseListener):
+    """A keypress listener that timestamps responses with the performance counter.
+
+    Unlike the default keypress listener, which measures response times from the
+    time of the first keypress event against a start time on SDL's tick clock,
+    this listener times each event on the same high-resolution
+    monotonic clock as the trial's flip timestamps (see :obj:`EventClock`), so
+    response times can be measured from a stimulus onset flip.
+
+    Args:
+        keymap (dict): A dict mapping SDL keycodes (e.g. ``sdl2.SDLK_z``) to the
+            response values to record for them.
+        timeout (float, optional): The maximum duration (in seconds) to wait for a
+            keypress response. Defaults to None (no timeout).
+        loop_callback (callable, optional): An optional function or method to be
+            called every time the collection loop checks for new input.
+        event_clock (:obj:`EventClock`, optional): The clock used to time keypresses
+            from when they're read.
+
+    """
+    def __init__(self, keymap, timeout=None, loop_callback=None, event_clock=None):
+        super(TimedKeypressListener, self).__init__(timeout, loop_callback)
+        self.default_response = (NO_RESPONSE, -1)
+        self._keymap = keymap
+        self._armed_at = None
+        self._event_clock = event_clock if event_clock else EventClock()
+
+    def _timestamp(self):
+        return precise_time()
+
+    def arm(self, start_time):
+        """Starts the response timer at a given time, ahead of response collection.
+
+        Any input already in the queue is discarded. Until :meth:`cleanup` is
+        called, :meth:`init` keeps the given start time instead of resetting it,
+        so keypresses made between arming and collection are still timed (and
+        collected) relative to ``start_time``.
+
+        Args:
+            start_time (float): The time (in ms on the :func:`time.perf_counter`
+                clock) to measure response times from, e.g. a stimulus onset flip.
+
+        """
+        flush()
+        self._event_clock.sync()
+        self._armed_at = start_time
+        self._loop_start = start_time
+
+    def init(self):
+        """Initializes the listener for response collection.
+
+        Only needs to be called manually if using :meth:`listen` directly in a
+        custom collection loop.
+
+        """
+        # Unless armed, clear any existing events in the queue and set the start time
+        if self._armed_at is None:
+            flush()
+            self._event_clock.sync()
+            self._loop_start = self._timestamp()
+
+    def listen(self, q):
+        """Checks a queue of input events for mapped keypress responses.
+
+        Args:
+            q (list): A list of input events to check for keypress responses.
+
+        Returns:
+            tuple or None: A ``(response, rt)`` tuple if a mapped key has been
+            pressed, otherwise None.
+
+        """
+        for e in q:
+            if e.type == sdl2.SDL_KEYDOWN and e.key.keysym.sym in self._keymap:
+                return (self._keymap[e.key.keysym.sym], self._event_clock(e) - self._loop_start)
+        return None
+
+    def cleanup(self):
+        """Performs any necessary cleanup after response collection.
+
+        Only needs to be called manually if using :meth:`listen` directly in a
+        custom collection loop.
+
+        """
+        self._loop_start = None
+        self._armed_at = None
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Fixtures shared by the tests."""
+
+import os
+import sqlite3
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_FILE = os.path.join(PROJECT_DIR, "ExpAssets", "Config", "gaze_ilm_schema.sql")
+
+TRIAL_COLUMNS = [
+    "practice", "participant_id", "cue_type", "task_requirement", "cue_location",
+    "target_location", "response", "block_num", "trial_num", "reaction_time", "target_onset",
+    "dropped_frames",
+]
+
+
+def trial_row(participant_id, trial_num, block_num=1):
+    """Returns the values of a trials row (in the order of :data:`TRIAL_COLUMNS`)."""
+    cue_location = ["left", "right", "neutral"][trial_num % 3]
+    return [
+        "False", participant_id, ["gaze", "exogenous"][trial_num % 2], "detection", cue_location,
+        ["left", "right"][trial_num % 2], "left", block_num, trial_num, 300.0 + trial_num, 600.0, 0,
+    ]
+
+
+@pytest.fixture
+def project_db(tmp_path):
+    """Returns a function that creates a project database with some data in it.
+
+    The function takes the database's path (relative to the test's temporary folder),
+    the userhashes of its participants, and the number of trials (each with two frames)
+    to add for each participant. Each participant can also be given a gaze sample file
+    name, indexed for each of their trials.
+
+    """
+    def create(path, userhashes, trials=3, gaze_files=None):
+        path = str(tmp_path / path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        db = sqlite3.connect(path)
+        with open(SCHEMA_FILE) as f:
+            db.executescript(f.read())
+        for i, userhash in enumerate(userhashes):
+            participant_id = db.execute(
+                "INSERT INTO participants (userhash, gender, age, handedness, created) "
+                "VALUES (?, ?, ?, ?, ?)", (userhash, ["female", "male"][i % 2], 20 + i, "right", "2026-10-18")
+            ).lastrowid
+            for trial_num in range(1, trials + 1):
+                db.execute("INSERT INTO trials ({0}) VALUES ({1})".format(
+                    ", ".join(TRIAL_COLUMNS), ", ".join("?" * len(TRIAL_COLUMNS))
+                ), trial_row(participant_id, trial_num))
+                for frame in range(2):
+                    db.execute(
+                        "INSERT INTO frames (participant_id, block_num, trial_num, frame, state, flip_time, missed) "
+                        "VALUES (?, 1, ?, ?, 'fixation', ?, 0)", (participant_id, trial_num, frame, frame * 16.7)
+                    )
+                if gaze_files:
+                    db.execute(
+                        "INSERT INTO gaze_index (participant_id, block_num, trial_num, file, byte_offset, sample_count) "
+                        "VALUES (?, 1, ?, ?, ?, 10)", (participant_id, trial_num, gaze_files[i], (trial_num - 1) * 10)
+                    )
+        db.commit()
+        db.close()
+        return path
+
+    return create
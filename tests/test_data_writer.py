@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Tests for the DataWriter's batched commits and crash recovery from its journal."""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+from data_writer import DataWriter
+from conftest import TRIAL_COLUMNS, trial_row
+
+
+def trial_nums(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in db.execute("SELECT trial_num FROM trials ORDER BY id")]
+    finally:
+        db.close()
+
+
+def journal_entries(writer):
+    with open(writer.journal_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_rows_are_committed_on_close_and_the_journal_emptied(project_db):
+    db_path = project_db("gaze_ilm.db", ["a"], trials=0)
+    writer = DataWriter(db_path)
+    writer.start()
+    writer.write("trials", TRIAL_COLUMNS, [trial_row(1, 1), trial_row(1, 2)])
+    writer.write("trials", TRIAL_COLUMNS, [])
+    writer.close()
+    assert trial_nums(db_path) == [1, 2]
+    assert journal_entries(writer) == []
+
+
+def test_a_flush_commits_rows_without_closing(project_db):
+    db_path = project_db("gaze_ilm.db", ["a"], trials=0)
+    writer = DataWriter(db_path)
+    writer.start()
+    writer.write("trials", TRIAL_COLUMNS, [trial_row(1, 1)])
+    writer.flush()
+    writer.write("trials", TRIAL_COLUMNS, [trial_row(1, 2)])
+    writer.close()
+    assert trial_nums(db_path) == [1, 2]
+
+
+def test_a_full_batch_is_committed_without_a_flush(project_db):
+    db_path = project_db("gaze_ilm.db", ["a"], trials=0)
+    writer = DataWriter(db_path, batch_size=2)
+    writer.start()
+    writer.write("trials", TRIAL_COLUMNS, [trial_row(1, 1), trial_row(1, 2)])
+    give_up = time.time() + 5
+    while trial_nums(db_path) != [1, 2] and time.time() < give_up:
+        time.sleep(0.01)
+    assert trial_nums(db_path) == [1, 2]
+    writer.close()
+
+
+def test_journaled_rows_are_replayed_once_on_the_next_launch(project_db):
+    # A crashed session left trials 1 and 2 committed, but still in the journal along
+    # with trial 3, and was cut off partway through journaling trial 4
+    db_path = project_db("gaze_ilm.db", ["a"], trials=2)
+    writer = DataWriter(db_path)
+    with open(writer.journal_path, "w") as f:
+        f.write(json.dumps({"table": "trials", "columns": TRIAL_COLUMNS, "rows": [trial_row(1, 2)]}) + "\n")
+        f.write(json.dumps({"table": "trials", "columns": TRIAL_COLUMNS, "rows": [trial_row(1, 3)]}) + "\n")
+        f.write(json.dumps({"table": "trials", "columns": TRIAL_COLUMNS, "rows": [trial_row(1, 4)]})[:40])
+
+    writer.start()
+    writer.close()
+    assert trial_nums(db_path) == [1, 2, 3]
+    assert journal_entries(writer) == []
+
+    # Replaying again (e.g. after another crash) adds nothing
+    writer = DataWriter(db_path)
+    writer.start()
+    writer.close()
+    assert trial_nums(db_path) == [1, 2, 3]
+
+
+def test_existing_rows_are_only_skipped_by_their_own_natural_key(project_db):
+    # Frame 1 of trial 1 was committed before the crash, so only frame 2 is replayed
+    db_path = project_db("gaze_ilm.db", ["a"], trials=1)
+    writer = DataWriter(db_path)
+    columns = ["participant_id", "block_num", "trial_num", "frame", "state", "flip_time", "missed"]
+    with open(writer.journal_path, "w") as f:
+        f.write(json.dumps({"table": "frames", "columns": columns, "rows": [
+            [1, 1, 1, 1, "fixation", 16.7, 0], [1, 1, 1, 2, "fixation", 33.4, 0],
+        ]}) + "\n")
+    writer.start()
+    writer.close()
+    db = sqlite3.connect(db_path)
+    frames = [row[0] for row in db.execute("SELECT frame FROM frames WHERE trial_num = 1 ORDER BY frame")]
+    db.close()
+    assert frames == [0, 1, 2]
+
+
+def test_rows_that_cant_be_committed_are_kept_in_the_journal(project_db):
+    db_path = project_db("gaze_ilm.db", ["a"], trials=0)
+    writer = DataWriter(db_path)
+    writer.start()
+    # The trials table requires every column, so this row can't be inserted
+    writer.write("trials", ["participant_id", "block_num", "trial_num"], [[1, 1, 1]])
+    writer.close()
+    assert trial_nums(db_path) == []
+    assert journal_entries(writer) == [
+        {"table": "trials", "columns": ["participant_id", "block_num", "trial_num"], "rows": [[1, 1, 1]]}
+    ]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Tests for the columnar export of a project database and the batch export of stations."""
+
+import os
+import sys
+import json
+import sqlite3
+import subprocess
+
+import numpy as np
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS_DIR = os.path.join(PROJECT_DIR, "tools")
+sys.path.insert(0, TOOLS_DIR)
+
+from export_columnar import export_database, table_columns, PYARROW_AVAILABLE
+from batch_export import find_databases, station_name, id_remapping
+
+FORMATS = [
+    "numpy",
+    pytest.param("parquet", marks=pytest.mark.skipif(not PYARROW_AVAILABLE, reason="needs pyarrow")),
+]
+
+
+def load_table(path):
+    """Returns an exported table as a dict of columns, with factors decoded to their levels."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return {name: np.array(values) for name, values in pq.read_table(path).to_pydict().items()}
+    array = np.load(path)
+    with open(os.path.splitext(path)[0] + "_levels.json") as f:
+        levels = json.load(f)
+    columns = {}
+    for name in array.dtype.names:
+        values = array[name]
+        columns[name] = np.array(levels[name])[values] if name in levels else values
+    return columns
+
+
+def test_column_kinds_follow_the_schema(project_db):
+    db = sqlite3.connect(project_db("gaze_ilm.db", ["a"]))
+    kinds = dict(table_columns(db, "trials"))
+    participant_kinds = dict(table_columns(db, "participants"))
+    db.close()
+    assert kinds["id"] == "int"
+    assert kinds["reaction_time"] == "float"
+    assert kinds["cue_type"] == "factor"
+    assert kinds["response"] == "str"
+    assert participant_kinds["gender"] == "factor"
+    assert "created" not in participant_kinds
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_export_matches_the_database(project_db, tmp_path, fmt):
+    db_path = project_db("gaze_ilm.db", ["a", "b"], trials=4)
+    outputs = export_database(db_path, str(tmp_path / "out"), fmt, batch_size=3)
+    participants = load_table(outputs["participants"])
+    trials = load_table(outputs["trials"])
+    assert "created" not in participants
+    assert list(participants["id"]) == [1, 2]
+    assert list(trials["id"]) == list(range(1, 9))
+    assert list(trials["participant_id"]) == [1] * 4 + [2] * 4
+    assert list(trials["cue_type"]) == ["exogenous", "gaze"] * 4
+    assert list(trials["cue_location"]) == ["right", "neutral", "left", "right"] * 2
+    assert np.allclose(trials["reaction_time"], [301, 302, 303, 304] * 2)
+
+
+def test_stations_are_found_in_sorted_order_and_named_by_folder(project_db, tmp_path):
+    paths = [
+        project_db(os.path.join("b", "ExpAssets", "gaze_ilm.db"), ["b1"]),
+        project_db(os.path.join("a", "ExpAssets", "gaze_ilm.db"), ["a1"]),
+        project_db(os.path.join("a", "ExpAssets", "other.db"), ["a2"]),
+    ]
+    found = find_databases(str(tmp_path))
+    assert found == sorted(paths[:2])
+    assert [station_name(path, str(tmp_path)) for path in found] == ["a__ExpAssets", "b__ExpAssets"]
+
+
+def test_participant_ids_are_remapped_in_every_table():
+    offsets = {"participants": 10, "trials": 200}
+    assert id_remapping("participants", offsets) == {"id": ("station_participant_id", 10)}
+    assert id_remapping("trials", offsets) == {
+        "id": ("station_id", 200), "participant_id": ("station_participant_id", 10),
+    }
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_batch_export_merges_stations_with_unique_ids(project_db, tmp_path, fmt):
+    project_db(os.path.join("stations", "a", "gaze_ilm.db"), ["a1", "a2"], trials=3)
+    project_db(os.path.join("stations", "b", "gaze_ilm.db"), ["b1", "b2", "b3"], trials=2)
+    out_dir = tmp_path / "merged"
+    subprocess.check_call([
+        sys.executable, os.path.join(TOOLS_DIR, "batch_export.py"), str(tmp_path / "stations"),
+        "-o", str(out_dir), "--format", fmt, "--jobs", "2",
+    ], stdout=subprocess.DEVNULL)
+
+    extension = ".parquet" if fmt == "parquet" else ".npy"
+    participants = load_table(str(out_dir / ("participants" + extension)))
+    trials = load_table(str(out_dir / ("trials" + extension)))
+
+    assert list(participants["id"]) == [1, 2, 3, 4, 5]
+    assert list(participants["station"]) == ["a"] * 2 + ["b"] * 3
+    assert list(participants["station_participant_id"]) == [1, 2, 1, 2, 3]
+
+    assert list(trials["id"]) == list(range(1, 13))
+    assert list(trials["station_id"]) == list(range(1, 7)) + list(range(1, 7))
+    assert list(trials["station"]) == ["a"] * 6 + ["b"] * 6
+    assert list(trials["participant_id"]) == [1, 1, 1, 2, 2, 2, 3, 3, 4, 4, 5, 5]
+    assert list(trials["station_participant_id"]) == [1, 1, 1, 2, 2, 2, 1, 1, 2, 2, 3, 3]
+    # Factors keep their levels across stations
+    assert list(trials["cue_type"]) == ["exogenous", "gaze", "exogenous"] * 2 + ["exogenous", "gaze"] * 3
+
+
+def test_batch_export_fails_if_a_station_fails(project_db, tmp_path):
+    project_db(os.path.join("stations", "a", "gaze_ilm.db"), ["a1"])
+    broken = tmp_path / "stations" / "b" / "gaze_ilm.db"
+    broken.parent.mkdir(parents=True)
+    broken.write_bytes(b"not a database")
+    result = subprocess.run([
+        sys.executable, os.path.join(TOOLS_DIR, "batch_export.py"), str(tmp_path / "stations"),
+        "-o", str(tmp_path / "merged"), "--format", "numpy", "--jobs", "1",
+    ], stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 1
+    assert "1 of 2 databases passed validation" in result.stdout
+    assert len(np.load(str(tmp_path / "merged" / "trials.npy"))) == 3
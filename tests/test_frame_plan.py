@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Tests for the frame plans and line motion schedules trials are presented from."""
+
+import os
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+from frame_plan import FramePlan, line_motion_schedule
+
+REFRESH_RATES = [60.0, 75.0, 100.0, 120.0, 144.0, 165.0, 240.0]
+
+# The display events of a detection trial: a 400 ms pre-cue, then a 50 ms cue, a 50 ms
+# gap and a 50 ms target
+DETECTION_EVENTS = [
+    (100, "x_cross_on", "pre_cue"),
+    (500, "cue_onset", "cue"),
+    (550, "cue_offset", "pre_cue"),
+    (600, "target_onset", "target"),
+    (650, "target_offset", None),
+]
+
+
+def frame_counts(plan):
+    # The number of frames each event's state is shown for
+    labels = sorted(plan.event_frames, key=plan.event_frames.get)
+    return {
+        label: plan.event_frames[after] - plan.event_frames[label]
+        for label, after in zip(labels, labels[1:])
+    }
+
+
+@pytest.mark.parametrize("refresh_rate", REFRESH_RATES)
+def test_equal_durations_get_equal_frame_counts(refresh_rate):
+    counts = frame_counts(FramePlan(DETECTION_EVENTS, refresh_rate, "fixation"))
+    assert counts["cue_onset"] == counts["cue_offset"] == counts["target_onset"]
+    assert counts["cue_onset"] == round(50 * refresh_rate / 1000.0)
+
+
+@pytest.mark.parametrize("refresh_rate", REFRESH_RATES)
+def test_states_follow_the_event_frames(refresh_rate):
+    plan = FramePlan(DETECTION_EVENTS, refresh_rate, "fixation")
+    assert len(plan) == plan.event_frames["target_offset"]
+    assert plan.event_frames["trial_start"] == 0
+    for onset, label, state in DETECTION_EVENTS[:-1]:
+        assert plan.states[plan.event_frames[label]] == state
+    assert plan.states[0] == "fixation"
+    assert plan.states[-1] == "target"
+
+
+def test_whole_frame_durations_have_no_warnings():
+    plan = FramePlan(DETECTION_EVENTS, 60.0, "fixation")
+    assert plan.warnings == []
+    assert frame_counts(plan) == {
+        "trial_start": 6, "x_cross_on": 24, "cue_onset": 3, "cue_offset": 3, "target_onset": 3,
+    }
+
+
+def test_durations_that_are_not_whole_frames_are_warned_about():
+    # 50 ms is 7.2 refreshes at 144 Hz, so it's shown for 7 (48.6 ms)
+    plan = FramePlan(DETECTION_EVENTS, 144.0, "fixation")
+    assert frame_counts(plan)["cue_onset"] == 7
+    assert "'cue_onset' will be shown for 48.6 ms instead of 50 ms at 144.0 Hz." in plan.warnings
+
+
+def test_states_shorter_than_a_refresh_are_dropped_with_a_warning():
+    events = [
+        (100, "x_cross_on", "pre_cue"), (150, "flash", "cue"), (155, "flash_offset", "pre_cue"),
+        (200, "target_offset", None),
+    ]
+    plan = FramePlan(events, 60.0, "fixation")
+    assert "cue" not in plan.states
+    assert plan.event_frames["flash"] == plan.event_frames["flash_offset"]
+    assert any(w.startswith("'flash' (5 ms) is shorter than one refresh") for w in plan.warnings)
+
+
+def test_durations_are_rounded_rather_than_onsets():
+    # Rounding each onset (to frames 2, 2, 4 and 4) would show 'a' and 'c' for no frames
+    # and 'b' for two, but rounding durations shows each of these 10 ms states for one
+    events = [(15, "a", "a"), (25, "b", "b"), (35, "c", "c"), (45, "end", None)]
+    plan = FramePlan(events, 100.0, "fixation")
+    assert frame_counts(plan) == {"trial_start": 2, "a": 1, "b": 1, "c": 1}
+
+
+@pytest.mark.parametrize("refresh_rate", REFRESH_RATES)
+def test_line_motion_schedule_adds_every_segment_in_order(refresh_rate):
+    schedule = line_motion_schedule(10, 100.0, refresh_rate)
+    assert schedule[0] == 1
+    assert schedule[-1] == 10
+    assert all(a <= b for a, b in zip(schedule, schedule[1:]))
+    assert schedule.count(10) == 1
+
+
+@pytest.mark.parametrize("refresh_rate", REFRESH_RATES)
+def test_line_motion_takes_the_same_time_at_any_refresh_rate(refresh_rate):
+    # The full line is shown on the first frame to start at or after the motion duration
+    frame_duration = 1000.0 / refresh_rate
+    schedule = line_motion_schedule(10, 100.0, refresh_rate)
+    full_line_onset = (len(schedule) - 1) * frame_duration
+    assert 100.0 <= full_line_onset < 100.0 + frame_duration
+    # Every frame shows the segments due by the time it starts
+    for frame, shown in enumerate(schedule):
+        assert shown == min(int(frame * frame_duration / (100.0 / 9)) + 1, 10)
+
+
+def test_line_motion_schedule_at_60hz():
+    assert line_motion_schedule(10, 100.0, 60.0) == [1, 2, 4, 5, 7, 8, 10]
+
+
+@pytest.mark.parametrize("segments, duration", [(10, 0.0), (1, 100.0)])
+def test_instant_line_motion_is_a_single_frame(segments, duration):
+    assert line_motion_schedule(segments, duration, 60.0) == [segments]
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Tests for the incremental merge of station databases into a master database."""
+
+import os
+import sys
+import sqlite3
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, "tools"))
+
+from merge_stations import open_master, merge_source, station_folder
+from conftest import TRIAL_COLUMNS, trial_row
+
+
+def rows(db_path, query):
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute(query).fetchall()
+    finally:
+        db.close()
+
+
+def write_gaze_file(db_path, name):
+    # Gaze files are named relative to the 'Data' folder next to the station's database
+    path = os.path.join(os.path.dirname(db_path), "Data", name)
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(os.urandom(64))
+    with open(os.path.splitext(path)[0] + ".json", "w") as f:
+        f.write("{}")
+    return path
+
+
+def test_new_rows_are_merged_once_and_remapped(project_db, tmp_path):
+    station_a = project_db(os.path.join("a", "ExpAssets", "gaze_ilm.db"), ["a1", "a2"], trials=2)
+    station_b = project_db(os.path.join("b", "ExpAssets", "gaze_ilm.db"), ["b1"], trials=3)
+    master_path = str(tmp_path / "master" / "gaze_ilm.db")
+    data_dir = str(tmp_path / "master" / "Data")
+    master = open_master(master_path)
+    try:
+        assert merge_source(master, station_a, data_dir) == {
+            "participants": 2, "duplicates": 0, "trials": 4, "frames": 8, "gaze_index": 0,
+        }
+        assert merge_source(master, station_b, data_dir)["trials"] == 3
+        # Nothing is new the second time round
+        assert merge_source(master, station_a, data_dir) == {
+            "participants": 0, "duplicates": 0, "trials": 0, "frames": 0, "gaze_index": 0,
+        }
+    finally:
+        master.close()
+
+    assert rows(master_path, "SELECT id, userhash FROM participants ORDER BY id") == [
+        (1, "a1"), (2, "a2"), (3, "b1"),
+    ]
+    assert rows(master_path, "SELECT participant_id, trial_num FROM trials ORDER BY id") == [
+        (1, 1), (1, 2), (2, 1), (2, 2), (3, 1), (3, 2), (3, 3),
+    ]
+    assert rows(master_path, "SELECT COUNT(*) FROM frames WHERE participant_id = 3") == [(6,)]
+
+
+def test_rows_added_after_a_merge_are_merged_next_time(project_db, tmp_path):
+    station = project_db(os.path.join("a", "ExpAssets", "gaze_ilm.db"), ["a1"], trials=2)
+    master_path = str(tmp_path / "master.db")
+    master = open_master(master_path)
+    try:
+        merge_source(master, station, str(tmp_path / "Data"))
+        # The session carries on after the first merge, and a new participant starts
+        db = sqlite3.connect(station)
+        db.execute("INSERT INTO trials ({0}) VALUES ({1})".format(
+            ", ".join(TRIAL_COLUMNS), ", ".join("?" * len(TRIAL_COLUMNS))
+        ), trial_row(1, 3))
+        db.execute(
+            "INSERT INTO participants (userhash, gender, age, handedness, created) "
+            "VALUES ('a2', 'female', 30, 'left', '2026-10-18')"
+        )
+        db.execute("INSERT INTO trials ({0}) VALUES ({1})".format(
+            ", ".join(TRIAL_COLUMNS), ", ".join("?" * len(TRIAL_COLUMNS))
+        ), trial_row(2, 1))
+        db.commit()
+        db.close()
+        copied = merge_source(master, station, str(tmp_path / "Data"))
+    finally:
+        master.close()
+
+    assert copied["participants"] == 1
+    assert copied["trials"] == 2
+    assert rows(master_path, "SELECT participant_id, trial_num FROM trials ORDER BY id") == [
+        (1, 1), (1, 2), (1, 3), (2, 1),
+    ]
+
+
+def test_participants_already_in_the_master_are_matched_by_userhash(project_db, tmp_path):
+    # The same participant ran a session on both stations
+    station_a = project_db(os.path.join("a", "ExpAssets", "gaze_ilm.db"), ["shared"], trials=1)
+    station_b = project_db(os.path.join("b", "ExpAssets", "gaze_ilm.db"), ["other", "shared"], trials=1)
+    master_path = str(tmp_path / "master.db")
+    master = open_master(master_path)
+    try:
+        merge_source(master, station_a, str(tmp_path / "Data"))
+        copied = merge_source(master, station_b, str(tmp_path / "Data"))
+    finally:
+        master.close()
+
+    assert copied["participants"] == 1
+    assert copied["duplicates"] == 1
+    assert rows(master_path, "SELECT p.userhash FROM trials t JOIN participants p ON p.id = t.participant_id ORDER BY t.id") == [
+        ("shared",), ("other",), ("shared",),
+    ]
+
+
+def test_gaze_files_are_copied_into_a_folder_for_each_station(project_db, tmp_path):
+    # Every station names its gaze files the same way
+    name = os.path.join("gaze", "gaze_ilm_p1_gaze.bin")
+    station_a = project_db(os.path.join("a", "ExpAssets", "gaze_ilm.db"), ["a1"], trials=2, gaze_files=[name])
+    station_b = project_db(os.path.join("b", "ExpAssets", "gaze_ilm.db"), ["b1"], trials=2, gaze_files=[name])
+    contents = {}
+    for station in [station_a, station_b]:
+        with open(write_gaze_file(station, name), "rb") as f:
+            contents[station] = f.read()
+
+    master_path = str(tmp_path / "master.db")
+    data_dir = str(tmp_path / "Data")
+    master = open_master(master_path)
+    try:
+        for station in [station_a, station_b]:
+            assert merge_source(master, station, data_dir)["gaze_index"] == 2
+    finally:
+        master.close()
+
+    folders = [station_folder(os.path.abspath(station)) for station in [station_a, station_b]]
+    assert folders[0] != folders[1]
+    assert [os.path.basename(folder).split("-")[0] for folder in folders] == ["a", "b"]
+    indexed = rows(master_path, "SELECT participant_id, file, byte_offset FROM gaze_index ORDER BY id")
+    assert indexed == [
+        (1, os.path.join(folders[0], name), 0), (1, os.path.join(folders[0], name), 10),
+        (2, os.path.join(folders[1], name), 0), (2, os.path.join(folders[1], name), 10),
+    ]
+    for station, folder in zip([station_a, station_b], folders):
+        with open(os.path.join(data_dir, folder, name), "rb") as f:
+            assert f.read() == contents[station]
+        assert os.path.exists(os.path.join(data_dir, folder, "gaze", "gaze_ilm_p1_gaze.json"))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Checks that detection response times don't depend on how long frames take to draw.
+
+A detection trial's plan is presented with gaze_ilm.present_plan on a simulated
+display driven by a virtual clock, with each frame taking a set time to draw before
+its flip. Keypresses are made at set times during the target and only reach the
+event queue (and get their SDL tick timestamp) when it's pumped, as with a real
+display.
+
+These tests need the experiment's runtime dependencies (klibs, PySDL2 and PyOpenGL).
+
+"""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("klibs")
+pytest.importorskip("sdl2")
+pytest.importorskip("OpenGL")
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+import sdl2
+import experiment
+from experiment import (
+    EventClock, FrameLog, FramePlan, SimulatedDisplay, TimedKeypressListener, VirtualClock,
+    trial_events,
+)
+
+REFRESH_RATE = 60.0
+FRAME_DRAW_LEAD = 3.0 # ms
+DRAW_TIMES = [0.2, 1.0, 2.5] # ms, all within the draw lead
+PRESS_DELAYS = [4.0, 9.5, 14.0, 15.5, 16.2, 21.0, 27.5, 31.0] # ms after target onset, while listening in present_plan
+
+
+class SimulatedInput(object):
+    """Keypresses made at set times, which are only read (and stamped) when pumped."""
+
+    def __init__(self, clock, presses):
+        self.clock = clock
+        self.presses = sorted(presses)
+        self.queue = []
+
+    def ticks(self):
+        # SDL's millisecond tick clock, started at the same time as the virtual clock
+        return int(self.clock.time)
+
+    def pump_events(self):
+        while self.presses and self.presses[0] <= self.clock.time:
+            self.presses.pop(0)
+            event = sdl2.SDL_Event()
+            event.type = sdl2.SDL_KEYDOWN
+            event.key.timestamp = self.ticks()
+            event.key.keysym.sym = sdl2.SDLK_z
+            self.queue.append(event)
+
+    def pump(self, return_events=False):
+        self.pump_events()
+        events, self.queue = self.queue, []
+        return events if return_events else None
+
+    def flush(self):
+        self.pump()
+
+
+def run_detection_trial(monkeypatch, draw_time, press_delay=None, target_onset=None):
+    clock = VirtualClock()
+    display = SimulatedDisplay(clock, REFRESH_RATE)
+    presses = [target_onset + press_delay] if press_delay is not None else []
+    simulated_input = SimulatedInput(clock, presses)
+    monkeypatch.setattr(experiment, "pump", simulated_input.pump)
+    monkeypatch.setattr(experiment, "flush", simulated_input.flush)
+    monkeypatch.setattr(experiment.P, "frame_draw_lead", FRAME_DRAW_LEAD, raising=False)
+
+    events = [(onset, label, label) for onset, label in trial_events("detection")]
+    events[-1] = (events[-1][0], events[-1][1], None)
+    plan = FramePlan(events, REFRESH_RATE, "fixation")
+    plan.state_ids = list(range(len(plan)))
+
+    exp = experiment.gaze_ilm.__new__(experiment.gaze_ilm)
+    exp.simulating = False
+    exp.task_requirement = "detection"
+    exp.fixation_monitor = None
+    exp.waiter = clock
+    exp.frame_log = FrameLog(REFRESH_RATE, clock = clock)
+    exp.event_clock = EventClock(
+        ticks = simulated_input.ticks, clock = clock, pump_events = simulated_input.pump_events,
+        queued = lambda: len(simulated_input.queue)
+    )
+    exp.keypress_listener = TimedKeypressListener({sdl2.SDLK_z: "left"}, event_clock = exp.event_clock)
+    exp.early_response = None
+
+    def present_frame(state_id, wake_error = None):
+        clock.time += draw_time
+        display.flip()
+        exp.frame_log.record(state_id, wake_error)
+
+    exp.present_frame = present_frame
+    exp.frame_log.start()
+    exp.present_plan(plan)
+    return exp.target_onset, exp.early_response
+
+
+def test_target_onset_is_independent_of_draw_time(monkeypatch):
+    onsets = [run_detection_trial(monkeypatch, draw_time)[0] for draw_time in DRAW_TIMES]
+    assert max(onsets) - min(onsets) < 1e-9
+
+
+def test_response_time_is_independent_of_draw_time(monkeypatch):
+    target_onset, response = run_detection_trial(monkeypatch, DRAW_TIMES[0])
+    assert response is None
+
+    for delay in PRESS_DELAYS:
+        rts = []
+        for draw_time in DRAW_TIMES:
+            onset, response = run_detection_trial(monkeypatch, draw_time, delay, target_onset)
+            assert response is not None and response[0] == "left"
+            rts.append(response[1])
+        # The same keypress gets the same RT however long frames take to draw...
+        assert max(rts) - min(rts) < 1e-9
+        # ...and is late by at most the draw lead (the blocking part of a flip), rather
+        # than by up to a whole refresh or the tick clock's millisecond resolution
+        assert 0.0 <= rts[0] - delay <= FRAME_DRAW_LEAD
+
+
+def test_keypresses_are_passed_to_ui_request(monkeypatch):
+    # Keys pressed at any point in the trial (e.g. the experimenter's quit keys) reach klibs
+    requests = []
+    monkeypatch.setattr(experiment, "ui_request", lambda keysym: requests.append(keysym.sym))
+    target_onset, response = run_detection_trial(monkeypatch, DRAW_TIMES[0])
+    for delay in [-400.0, -45.0, 10.0]:
+        run_detection_trial(monkeypatch, DRAW_TIMES[0], delay, target_onset)
+    assert requests == [sdl2.SDLK_z] * 3
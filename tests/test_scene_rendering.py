@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Checks that every trial display composites correctly, with and without the raster cache.
+
+Each scene from gaze_ilm.display_states is rendered in turn by one SceneRenderer, as
+when the frame cache is built, and compared with the same scene rendered from scratch.
+Messages go through gaze_ilm.cached_message, so with the cache on they're the read-only
+pixel arrays loaded from disk, and with it off they're freshly rendered arrays.
+
+These tests need the experiment's runtime dependencies (klibs, PySDL2 and PyOpenGL).
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("klibs")
+pytest.importorskip("sdl2")
+pytest.importorskip("OpenGL")
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+import experiment
+from experiment import RasterCache, SceneRenderer
+
+SCREEN = (320, 240)
+CENTRE = (160, 120)
+
+
+class Stimulus(object):
+    """A solid rectangle standing in for a Drawbject or rendered message."""
+
+    def __init__(self, width, height, color):
+        self.width = width
+        self.height = height
+        self.color = color
+
+    def render(self):
+        pixels = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        pixels[:, :] = self.color + (255,)
+        return pixels
+
+
+def offset(dx, dy):
+    return (CENTRE[0] + dx, CENTRE[1] + dy)
+
+
+def make_experiment(monkeypatch, cache_path):
+    for name, value in [
+        ("screen_x", SCREEN[0]), ("screen_y", SCREEN[1]), ("screen_c", CENTRE),
+        ("default_fill_color", (45, 45, 45, 255)), ("default_font_name", "Hind-Medium"),
+        ("default_font_size", 23), ("default_color", (255, 255, 255, 255)),
+    ]:
+        monkeypatch.setattr(experiment.P, name, value, raising=False)
+    monkeypatch.setattr(
+        experiment, "message", lambda text, style, blit_txt, align: Stimulus(4 * len(text), 10, (255, 255, 255))
+    )
+
+    exp = experiment.gaze_ilm.__new__(experiment.gaze_ilm)
+    exp.raster_cache = RasterCache(cache_path, (SCREEN, 90, 57))
+    exp.probecircle = Stimulus(20, 20, (255, 255, 255))
+    exp.innercircle = Stimulus(14, 14, (45, 45, 45))
+    exp.left_probe_position, exp.right_probe_position = offset(-100, -40), offset(100, -40)
+    exp.horizontal_cross = Stimulus(20, 3, (255, 255, 255))
+    exp.vertical_cross = Stimulus(3, 20, (255, 255, 255))
+    exp.x_cross1 = Stimulus(16, 16, (255, 255, 255))
+    exp.x_cross2 = Stimulus(16, 16, (250, 250, 250))
+    exp.cue = Stimulus(20, 20, (255, 255, 255))
+    exp.facecircle = Stimulus(44, 44, (255, 255, 255))
+    exp.eyecircle = Stimulus(12, 12, (255, 255, 255))
+    exp.pupilcircle = Stimulus(4, 4, (0, 0, 0))
+    exp.nose = Stimulus(3, 4, (0, 0, 0))
+    exp.mouth = Stimulus(8, 3, (0, 0, 0))
+    exp.left_eye_position, exp.right_eye_position = offset(-9, -9), offset(9, -9)
+    exp.mouth_position = offset(0, 10)
+    exp.lefteye_left_pupilcue_position, exp.lefteye_right_pupilcue_position = offset(-14, -9), offset(-4, -9)
+    exp.righteye_left_pupilcue_position, exp.righteye_right_pupilcue_position = offset(4, -9), offset(14, -9)
+    exp.target = Stimulus(9, 9, (255, 255, 255))
+    exp.moving_line_segment = Stimulus(20, 3, (255, 255, 255))
+    exp.line_segment_positions = [offset(-90 + 20 * i, -40) for i in range(10)]
+    exp.motion_rating_message = exp.cached_message("Rate the how much and what direction the line may have moved:")
+    exp.motion_rating_message_position = CENTRE
+    exp.left_motion_rating_message = exp.cached_message("Left")
+    exp.left_motion_rating_message_position = offset(-100, 40)
+    exp.right_motion_rating_message = exp.cached_message("Right")
+    exp.right_motion_rating_message_position = offset(100, 40)
+    exp.no_motion_rating_message = exp.cached_message("No motion")
+    exp.no_motion_rating_message_position = offset(0, 80)
+    exp.no_motion_rating_line = Stimulus(40, 3, (255, 255, 255))
+    exp.scale = Stimulus(170, 40, (200, 200, 200))
+    exp.scale_loc = offset(0, 40)
+    return exp
+
+
+def render_every_scene(exp):
+    # Scenes are rendered in order by one renderer, as in gaze_ilm.build_frame_cache
+    renderer = SceneRenderer(exp.raster_cache)
+    frames = {}
+    for state, scene in exp.display_states().items():
+        frames[state] = renderer.render(scene).copy()
+        expected = SceneRenderer(exp.raster_cache).render(scene)
+        assert np.array_equal(frames[state], expected), state
+    return frames
+
+
+def test_every_scene_renders_without_the_raster_cache(monkeypatch):
+    exp = make_experiment(monkeypatch, None)
+    assert isinstance(exp.motion_rating_message, np.ndarray)
+    render_every_scene(exp)
+
+
+def test_every_scene_renders_from_the_raster_cache(monkeypatch, tmp_path):
+    # The first launch fills the cache, and the second loads everything from it
+    uncached = render_every_scene(make_experiment(monkeypatch, str(tmp_path)))
+    exp = make_experiment(monkeypatch, str(tmp_path))
+    assert isinstance(exp.motion_rating_message, np.memmap)
+    cached = render_every_scene(exp)
+    assert exp.raster_cache.misses == 0
+    for state in uncached:
+        assert np.array_equal(cached[state], uncached[state]), state
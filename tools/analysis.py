@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Vectorized summaries of cueing effects and illusory line motion ratings.
+
+Loads exported trial data (from tools/export_columnar.py) into NumPy arrays and
+computes, with grouped reductions rather than per-row loops:
+
+  * mean and median detection RT for valid, invalid and neutral cues, per cue type
+  * detection error rates (response vs. target_location) for the same conditions
+  * mean scale rating for each line motion task_requirement, by cue side
+
+Each summary is computed per participant and for each condition pooled across
+participants. Cue validity is derived from cue_location and target_location:
+'neutral' if the cue was neutral, 'valid' if the cue and target were on the same
+side, and 'invalid' otherwise.
+
+Usage:
+    python tools/analysis.py [ExpAssets/Data/columnar/trials.npy] [-o OUTPUT_DIR]
+                             [--min-rt MS] [--max-rt MS] [--sd-trim SD]
+                             [--include-practice]
+
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+try:
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+DEFAULT_TRIALS = os.path.join("ExpAssets", "Data", "columnar", "trials.npy")
+DETECTION = "detection"
+
+
+def load_trials(path):
+    """Loads exported trial data into a dict of NumPy arrays.
+
+    Factor columns are decoded to string arrays.
+
+    Args:
+        path (str): The path of a 'trials.npy' or 'trials.parquet' export.
+
+    Returns:
+        dict: A 1-D array for each column of the trials table, by column name.
+
+    """
+    if path.endswith(".parquet"):
+        if not PYARROW_AVAILABLE:
+            raise RuntimeError("Loading Parquet files requires the 'pyarrow' package.")
+        table = pq.read_table(path)
+        trials = {}
+        for name in table.column_names:
+            col = table.column(name).combine_chunks()
+            if hasattr(col, "dictionary"):
+                levels = np.asarray(col.dictionary.to_pylist(), dtype=str)
+                trials[name] = levels[col.indices.to_numpy(zero_copy_only=False)]
+            else:
+                trials[name] = col.to_numpy(zero_copy_only=False)
+        return trials
+
+    arr = np.load(path, mmap_mode="r")
+    levels_path = os.path.splitext(path)[0] + "_levels.json"
+    levels = {}
+    if os.path.exists(levels_path):
+        with open(levels_path, "r") as f:
+            levels = json.load(f)
+    trials = {}
+    for name in arr.dtype.names:
+        if name in levels:
+            trials[name] = np.asarray(levels[name], dtype=str)[arr[name]]
+        else:
+            trials[name] = np.asarray(arr[name])
+    return trials
+
+
+def cue_validity(cue_location, target_location):
+    """Derives the validity of each trial's cue from its cue and target locations.
+
+    Returns:
+        :obj:`numpy.ndarray`: 'neutral', 'valid', or 'invalid' for each trial.
+
+    """
+    validity = np.where(cue_location == target_location, "valid", "invalid")
+    return np.where(cue_location == "neutral", "neutral", validity)
+
+
+def parse_ratings(response):
+    """Converts recorded scale responses to floats, with NaN for non-responses."""
+    try:
+        return np.asarray(response).astype(np.float64)
+    except ValueError:
+        pass # Some trials have no rating, so convert them one at a time
+
+    def _to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+    return np.asarray([_to_float(v) for v in response], dtype=np.float64)
+
+
+def group_indices(keys):
+    """Assigns each row to a group formed by the unique combinations of the keys.
+
+    Args:
+        keys (list): A list of equal-length 1-D arrays to group by.
+
+    Returns:
+        tuple: A ``(group_keys, group_idx)`` tuple, where ``group_keys`` is a list
+        with the value of each key for every group, and ``group_idx`` gives the
+        group of each row.
+
+    """
+    uniques = []
+    codes = []
+    for k in keys:
+        u, inv = np.unique(k, return_inverse=True)
+        uniques.append(u)
+        codes.append(inv.reshape(-1))
+    groups, group_idx = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    group_keys = [uniques[i][groups[:, i]] for i in range(len(keys))]
+    return group_keys, group_idx.reshape(-1)
+
+
+def grouped_stats(keys, values):
+    """Computes the count, mean, median and SD of values within each group.
+
+    NaN values are ignored.
+
+    Args:
+        keys (list): A list of equal-length 1-D arrays to group by.
+        values (:obj:`numpy.ndarray`): The values to summarize.
+
+    Returns:
+        tuple: A ``(group_keys, stats)`` tuple, where ``stats`` is a dict with
+        'n', 'mean', 'median' and 'sd' arrays containing one value per group.
+
+    """
+    keep = ~np.isnan(values)
+    keys = [k[keep] for k in keys]
+    values = values[keep]
+    if not len(values):
+        empty = np.zeros(0)
+        return [k[:0] for k in keys], {"n": empty, "mean": empty, "median": empty, "sd": empty}
+
+    group_keys, idx = group_indices(keys)
+    n_groups = len(group_keys[0])
+    n = np.bincount(idx, minlength=n_groups)
+    mean = np.bincount(idx, weights=values, minlength=n_groups) / n
+    sq = np.bincount(idx, weights=values ** 2, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sd = np.sqrt(np.maximum(sq - n * mean ** 2, 0) / (n - 1))
+
+    # Medians from the middle one or two values of each group in sorted order
+    sorted_values = values[np.lexsort((values, idx))]
+    starts = np.cumsum(n) - n
+    median = (sorted_values[starts + (n - 1) // 2] + sorted_values[starts + n // 2]) / 2.0
+
+    return group_keys, {"n": n, "mean": mean, "median": median, "sd": sd}
+
+
+def trim_rts(rt, groups, min_rt=None, max_rt=None, sd_trim=None):
+    """Flags reaction times to keep after absolute and SD-based trimming.
+
+    Args:
+        rt (:obj:`numpy.ndarray`): The reaction time of each trial (in ms).
+        groups (list): Arrays defining the cells within which to apply SD trimming
+            (e.g. participant, cue type and cue validity).
+        min_rt (float, optional): Trials with faster RTs are excluded.
+        max_rt (float, optional): Trials with slower RTs are excluded.
+        sd_trim (float, optional): Trials more than this many SDs from the mean of
+            their cell (after absolute trimming) are excluded.
+
+    Returns:
+        :obj:`numpy.ndarray`: A boolean mask of the trials to keep.
+
+    """
+    keep = ~np.isnan(rt) & (rt >= 0)
+    if min_rt is not None:
+        keep &= rt >= min_rt
+    if max_rt is not None:
+        keep &= rt <= max_rt
+    if sd_trim is not None and keep.any():
+        kept = np.where(keep, rt, np.nan)
+        group_keys, idx = group_indices(groups)
+        n = np.bincount(idx, weights=keep, minlength=len(group_keys[0]))
+        total = np.bincount(idx, weights=np.where(keep, rt, 0), minlength=len(group_keys[0]))
+        sq = np.bincount(idx, weights=np.where(keep, rt, 0) ** 2, minlength=len(group_keys[0]))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / n
+            sd = np.sqrt(np.maximum(sq - n * mean ** 2, 0) / (n - 1))
+            keep &= ~(np.abs(kept - mean[idx]) > sd_trim * sd[idx])
+    return keep
+
+
+def summarize(trials, min_rt=100, max_rt=1500, sd_trim=None, include_practice=False):
+    """Computes the cueing and line motion summaries for a set of trials.
+
+    Args:
+        trials (dict): Trial data, as returned by :func:`load_trials`.
+        min_rt (float, optional): The fastest detection RT (in ms) to include.
+        max_rt (float, optional): The slowest detection RT (in ms) to include.
+        sd_trim (float, optional): If provided, detection RTs more than this many
+            SDs from their participant/condition mean are also excluded.
+        include_practice (bool, optional): Whether to include practice trials.
+
+    Returns:
+        dict: Summary tables by name, each a dict of equal-length column arrays.
+
+    """
+    keep = np.ones(len(trials["id"]), dtype=bool)
+    if not include_practice:
+        keep &= trials["practice"].astype(str) != "True"
+    trials = {name: col[keep] for name, col in trials.items()}
+
+    participant = trials["participant_id"]
+    cue_type = trials["cue_type"].astype(str)
+    task = trials["task_requirement"].astype(str)
+    cue_loc = trials["cue_location"].astype(str)
+    target_loc = trials["target_location"].astype(str)
+    response = trials["response"].astype(str)
+    validity = cue_validity(cue_loc, target_loc)
+    rt = trials["reaction_time"].astype(np.float64)
+
+    tables = {}
+    detection = task == DETECTION
+
+    # Error rates across all detection trials
+    errors = (response != target_loc).astype(np.float64)
+    for level, keys in [("participant", [participant]), ("condition", [])]:
+        group_cols = keys + [cue_type, validity]
+        group_keys, stats = grouped_stats([k[detection] for k in group_cols], errors[detection])
+        names = ["participant_id"] * len(keys) + ["cue_type", "cue_validity"]
+        table = dict(zip(names, group_keys))
+        table.update({"n_trials": stats["n"], "error_rate": stats["mean"]})
+        tables["errors_by_" + level] = table
+
+    # RTs for correct, trimmed detection trials
+    correct = detection & (response == target_loc)
+    cells = [participant[correct], cue_type[correct], validity[correct]]
+    trimmed = np.zeros(len(rt), dtype=bool)
+    trimmed[correct] = trim_rts(rt[correct], cells, min_rt, max_rt, sd_trim)
+    for level, keys in [("participant", [participant]), ("condition", [])]:
+        group_cols = keys + [cue_type, validity]
+        group_keys, stats = grouped_stats([k[trimmed] for k in group_cols], rt[trimmed])
+        names = ["participant_id"] * len(keys) + ["cue_type", "cue_validity"]
+        table = dict(zip(names, group_keys))
+        table.update({
+            "n_trials": stats["n"], "mean_rt": stats["mean"], "median_rt": stats["median"],
+            "sd_rt": stats["sd"],
+        })
+        tables["rts_by_" + level] = table
+
+    # Scale ratings for line motion trials, by the side of the cue
+    rating_trials = ~detection
+    ratings = parse_ratings(response[rating_trials])
+    for level, keys in [("participant", [participant]), ("condition", [])]:
+        group_cols = keys + [cue_type, task, cue_loc]
+        group_keys, stats = grouped_stats([k[rating_trials] for k in group_cols], ratings)
+        names = ["participant_id"] * len(keys) + ["cue_type", "task_requirement", "cue_location"]
+        table = dict(zip(names, group_keys))
+        table.update({"n_trials": stats["n"], "mean_rating": stats["mean"], "sd_rating": stats["sd"]})
+        tables["ratings_by_" + level] = table
+
+    return tables
+
+
+def write_csv(path, table):
+    """Writes a summary table (a dict of equal-length columns) to a CSV file."""
+    names = list(table.keys())
+    with open(path, "w") as f:
+        f.write(",".join(names) + "\n")
+        for row in zip(*[table[name] for name in names]):
+            f.write(",".join([str(v) for v in row]) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trials", nargs="?", default=DEFAULT_TRIALS, help="an exported trials file")
+    parser.add_argument("-o", "--output", default=None, help="a folder to write CSV summaries to")
+    parser.add_argument("--min-rt", type=float, default=100)
+    parser.add_argument("--max-rt", type=float, default=1500)
+    parser.add_argument("--sd-trim", type=float, default=None)
+    parser.add_argument("--include-practice", action="store_true")
+    args = parser.parse_args()
+
+    trials = load_trials(args.trials)
+    tables = summarize(trials, args.min_rt, args.max_rt, args.sd_trim, args.include_practice)
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for name, table in tables.items():
+        if args.output:
+            write_csv(os.path.join(args.output, name + ".csv"), table)
+        elif name.endswith("_by_condition"):
+            print("\n{0}:".format(name))
+            print("  ".join(table.keys()))
+            for row in zip(*table.values()):
+                print("  ".join([str(v) for v in row]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Exports every project database under a folder in parallel and merges the results.
+
+Each station's project database is found by searching the folder recursively,
+exported with tools/export_columnar.py on a process pool, and validated (row counts
+match the database, and every trial belongs to an exported participant). The
+per-database exports are then merged into a single dataset in the same format,
+with a 'station' column naming the source database. Row ids and participant ids are
+remapped so that they're unique across stations, with the originals kept in
+'station_id' and 'station_participant_id' (for the participants table, whose ids
+are the participant ids, only the latter). Databases that fail to export are
+reported and left out of the merged dataset, and the command exits with an error.
+
+Databases are always merged in sorted path order, and factor levels are combined
+in that order, so the merged dataset is identical however the workers are scheduled.
+
+Usage:
+    python tools/batch_export.py ROOT_DIR [-o OUTPUT_DIR] [--jobs N]
+                                 [--format {parquet,numpy}] [--pattern NAME]
+
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from export_columnar import export_database, EXPORT_TABLES, PYARROW_AVAILABLE
+
+if PYARROW_AVAILABLE:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+
+DEFAULT_OUTPUT = os.path.join("ExpAssets", "Data", "batch_export")
+DEFAULT_PATTERN = "gaze_ilm.db"
+
+
+def find_databases(root, pattern=DEFAULT_PATTERN):
+    """Returns the sorted paths of every project database under a folder."""
+    found = []
+    for folder, subfolders, files in os.walk(root):
+        subfolders.sort()
+        for name in files:
+            if name == pattern:
+                found.append(os.path.join(folder, name))
+    return sorted(found)
+
+
+def station_name(db_path, root):
+    """Returns a name for a station's database, based on its path relative to the root."""
+    relative = os.path.relpath(os.path.dirname(db_path), root)
+    if relative == os.curdir:
+        relative = os.path.splitext(os.path.basename(db_path))[0]
+    return relative.replace(os.sep, "__")
+
+
+def _exported_rows(path):
+    if path.endswith(".parquet"):
+        return pq.ParquetFile(path).metadata.num_rows
+    return len(np.load(path, mmap_mode="r"))
+
+
+def export_and_validate(db_path, out_dir, fmt):
+    """Exports one database and checks the export against it (run in a worker process).
+
+    Returns:
+        dict: The exported file for each table, the number of rows exported from
+        each table, any validation errors, and the time taken (in seconds).
+
+    """
+    start = time.perf_counter()
+    outputs = export_database(db_path, out_dir, fmt)
+    errors = []
+    counts = {}
+    db = sqlite3.connect("file:{0}?mode=ro".format(db_path), uri=True)
+    try:
+        for table, path in outputs.items():
+            expected = db.execute("SELECT COUNT(*) FROM {0}".format(table)).fetchone()[0]
+            counts[table] = _exported_rows(path)
+            if counts[table] != expected:
+                errors.append("{0}: exported {1} rows, expected {2}".format(table, counts[table], expected))
+        orphans = db.execute(
+            "SELECT COUNT(*) FROM trials WHERE participant_id NOT IN (SELECT id FROM participants)"
+        ).fetchone()[0]
+        if orphans:
+            errors.append("trials: {0} rows with no matching participant".format(orphans))
+        max_ids = {
+            table: db.execute("SELECT MAX(id) FROM {0}".format(table)).fetchone()[0] or 0
+            for table in outputs
+        }
+    finally:
+        db.close()
+    return {
+        "outputs": outputs,
+        "counts": counts,
+        "errors": errors,
+        "max_ids": max_ids,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def id_remapping(table, offsets):
+    """Returns how to remap a table's id columns for one station.
+
+    Args:
+        table (str): The name of the table.
+        offsets (dict): The station's id offset for each table.
+
+    Returns:
+        dict: The ``(original_column, offset)`` for each id column, where
+        ``original_column`` is the column the station's own ids are kept in.
+
+    """
+    if table == "participants":
+        return {"id": ("station_participant_id", offsets["participants"])}
+    return {
+        "id": ("station_id", offsets[table]),
+        "participant_id": ("station_participant_id", offsets["participants"]),
+    }
+
+
+def _merged_dtype(arrays, extra):
+    """Returns a structured dtype wide enough for every array's string columns."""
+    fields = []
+    for name in arrays[0].dtype.names:
+        types = [a.dtype[name] for a in arrays]
+        if types[0].kind == "U":
+            fields.append((name, "U{0}".format(max(t.itemsize // 4 for t in types))))
+        else:
+            fields.append((name, types[0]))
+    return np.dtype(fields + extra)
+
+
+def merge_numpy(table, sources, out_path):
+    """Merges per-station .npy exports of a table, recoding factors to shared levels.
+
+    Args:
+        table (str): The name of the table being merged.
+        sources (list): ``(station, path, remapping)`` for each station, in merge
+            order, where ``remapping`` is from :func:`id_remapping`.
+        out_path (str): The path of the merged .npy file.
+
+    """
+    arrays, station_levels = [], []
+    for station, path, remapping in sources:
+        arrays.append(np.load(path, mmap_mode="r"))
+        with open(os.path.splitext(path)[0] + "_levels.json") as f:
+            station_levels.append(json.load(f))
+    width = max(len(station) for station, path, remapping in sources)
+    originals = [(original, np.int64) for original, offset in sources[0][2].values()]
+    dtype = _merged_dtype(arrays, [("station", "U{0}".format(width))] + originals)
+
+    # Factor levels are combined in merge order, so codes don't depend on scheduling
+    levels = {}
+    for station_level in station_levels:
+        for name, values in station_level.items():
+            merged = levels.setdefault(name, [])
+            merged.extend([v for v in values if v not in merged])
+
+    total = sum(len(a) for a in arrays)
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=dtype, shape=(total,))
+    start = 0
+    for (station, path, remapping), array, station_level in zip(sources, arrays, station_levels):
+        end = start + len(array)
+        for name in array.dtype.names:
+            if name in station_level:
+                recode = np.array([levels[name].index(v) for v in station_level[name]], dtype=np.int16)
+                out[name][start:end] = recode[array[name]] if len(recode) else array[name]
+            else:
+                out[name][start:end] = array[name]
+        out["station"][start:end] = station
+        for column, (original, offset) in remapping.items():
+            out[original][start:end] = array[column]
+            out[column][start:end] = array[column] + offset
+        start = end
+    out.flush()
+    del out
+    with open(os.path.splitext(out_path)[0] + "_levels.json", "w") as f:
+        json.dump(levels, f, indent=2)
+    return out_path
+
+
+def merge_parquet(table, sources, out_path):
+    """Merges per-station Parquet exports of a table (see :func:`merge_numpy`)."""
+    tables = []
+    for station, path, remapping in sources:
+        t = pq.read_table(path)
+        t = t.append_column("station", pa.array([station] * len(t), pa.string()))
+        for column, (original, offset) in remapping.items():
+            ids = t.column(column)
+            t = t.append_column(original, ids)
+            remapped = pa.array(np.asarray(ids.to_numpy(zero_copy_only=False)) + offset, pa.int64())
+            t = t.set_column(t.schema.get_field_index(column), column, remapped)
+        tables.append(t)
+    merged = pa.concat_tables(tables).unify_dictionaries()
+    pq.write_table(merged, out_path)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("root", help="the folder to search for project databases")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="the output folder")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="the number of worker processes")
+    parser.add_argument("--format", choices=["parquet", "numpy"], default=None)
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN, help="the file name of the project databases")
+    args = parser.parse_args()
+
+    fmt = args.format or ("parquet" if PYARROW_AVAILABLE else "numpy")
+    databases = find_databases(args.root, args.pattern)
+    if not databases:
+        print("No '{0}' databases found under {1}".format(args.pattern, args.root))
+        sys.exit(1)
+    stations = [station_name(path, args.root) for path in databases]
+    print("Exporting {0} databases with {1} workers".format(len(databases), args.jobs))
+
+    start = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(export_and_validate, path, os.path.join(args.output, "stations", station), fmt): i
+            for i, (path, station) in enumerate(zip(databases, stations))
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = {"outputs": None, "counts": {}, "errors": ["export failed: {0!r}".format(e)],
+                              "max_ids": {}, "seconds": 0.0}
+            print("[{0}/{1}] {2}: {3} participants, {4} trials ({5:.2f} s){6}".format(
+                done, len(databases), stations[i], results[i]["counts"].get("participants", 0),
+                results[i]["counts"].get("trials", 0), results[i]["seconds"],
+                "" if not results[i]["errors"] else " - " + "; ".join(results[i]["errors"])
+            ))
+
+    # Merge in discovery order, offsetting each station's ids in each table past the last's.
+    # Databases that couldn't be exported are left out, but still reported as failures
+    exported = [i for i in range(len(databases)) if results[i]["outputs"]]
+    offsets, totals = {}, dict.fromkeys(EXPORT_TABLES, 0)
+    for i in exported:
+        offsets[i] = dict(totals)
+        for table in EXPORT_TABLES:
+            totals[table] += results[i]["max_ids"][table]
+    merge = merge_parquet if fmt == "parquet" else merge_numpy
+    extension = ".parquet" if fmt == "parquet" else ".npy"
+    for table in EXPORT_TABLES if exported else []:
+        sources = [
+            (stations[i], results[i]["outputs"][table], id_remapping(table, offsets[i])) for i in exported
+        ]
+        path = merge(table, sources, os.path.join(args.output, table + extension))
+        print("Merged '{0}' to {1}".format(table, path))
+
+    failed = [stations[i] for i in range(len(databases)) if results[i]["errors"]]
+    print("Done in {0:.2f} s ({1} of {2} databases passed validation)".format(
+        time.perf_counter() - start, len(databases) - len(failed), len(databases)
+    ))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
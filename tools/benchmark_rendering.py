@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the experiment's display routines and checks them against a baseline.
+
+The experiment is launched in benchmark mode, which builds the stimuli and frame
+cache as usual and then times every display routine over a run of frames: compositing
+each display state onto a blank canvas from its (already rasterised) stimuli, presenting each pre-rendered state (including
+every step of the moving lines), the trial start screen, and redrawing the rating
+scale. The frame rate and latency percentiles for each routine are saved to a JSON
+file, then compared with the saved baseline for the machine.
+
+A routine counts as a regression if its mean or 95th percentile latency is more than
+the threshold (10% by default) slower than the baseline. The script exits with a
+non-zero status if any routine regressed, so it can be used as a pre-deployment check.
+
+The benchmarks time texture draws and vsync'd flips, so they must be run on the
+testing machine's own display and GPU: there's no headless mode, as SDL's dummy
+video driver has no OpenGL context and a software one would say nothing about the
+lab hardware.
+
+Usage:
+    python tools/benchmark_rendering.py [--baseline PATH] [--save-baseline]
+                                        [--threshold FRACTION]
+
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(PROJECT_DIR, "ExpAssets", "Data", "benchmarks")
+COMPARED_STATS = ["mean", "p95"]
+
+
+def run_benchmarks(output_path, screen_size=21.5):
+    env = dict(os.environ)
+    env["GAZE_ILM_BENCHMARK"] = "1"
+    env["GAZE_ILM_BENCHMARK_OUTPUT"] = output_path
+    cmd = ["klibs", "run", str(screen_size), "-d"]
+    return subprocess.call(cmd, cwd=PROJECT_DIR, env=env)
+
+
+def find_regressions(results, baseline, threshold):
+    """Returns (routine, stat, baseline, current) for each routine that got slower."""
+    regressions = []
+    for name, stats in sorted(results["routines"].items()):
+        if name not in baseline["routines"]:
+            continue
+        for stat in COMPARED_STATS:
+            old = baseline["routines"][name][stat]
+            if old > 0 and stats[stat] > old * (1 + threshold):
+                regressions.append((name, stat, old, stats[stat]))
+    return regressions
+
+
+def main():
+    host = socket.gethostname()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARK_DIR, "baseline_" + host + ".json"),
+        help="the baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+        help="the fraction by which a routine can slow down before it counts as a regression")
+    parser.add_argument("--screen-size", type=float, default=21.5,
+        help="the diagonal size of the screen, in inches")
+    args = parser.parse_args()
+
+    output_path = os.path.join(BENCHMARK_DIR, host + ".json")
+    status = run_benchmarks(output_path, args.screen_size)
+    if status != 0:
+        sys.exit(status)
+    with open(output_path) as f:
+        results = json.load(f)
+
+    for name, stats in sorted(results["routines"].items()):
+        print("{0:<40} {1:>8.1f} fps   mean {2:6.2f} ms   p95 {3:6.2f} ms   p99 {4:6.2f} ms".format(
+            name, stats["fps"] or 0, stats["mean"], stats["p95"], stats["p99"]))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to {0}".format(args.baseline))
+        return
+    if not os.path.exists(args.baseline):
+        print("No baseline found at {0} (save one with --save-baseline)".format(args.baseline))
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, stat, old, new in regressions:
+        print("REGRESSION: {0} {1} latency {2:.2f} ms -> {3:.2f} ms".format(name, stat, old, new))
+    if regressions:
+        sys.exit(1)
+    print("No regressions beyond {0:.0%} of the baseline".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Streams the trials and participants tables to typed, columnar data files.
+
+Tables are read from the project database in fixed-size cursor batches and written
+incrementally, so memory use stays flat regardless of the size of the database.
+If pyarrow is available, each table is written to a Parquet file. Otherwise, each
+table is written to a structured NumPy array (.npy) that is filled in place through
+a memory map.
+
+Factor columns (e.g. cue_type, task_requirement, cue_location, target_location) are
+dictionary-encoded: in Parquet as dictionary columns, and in NumPy as integer codes
+with the code-to-level mapping saved alongside in a '<table>_levels.json' file.
+
+Usage:
+    python tools/export_columnar.py [path/to/project.db] [-o OUTPUT_DIR]
+                                    [--format {parquet,numpy}] [--batch-size N]
+
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+DEFAULT_DB = os.path.join("ExpAssets", "gaze_ilm.db")
+DEFAULT_OUTPUT = os.path.join("ExpAssets", "Data", "columnar")
+EXPORT_TABLES = ["participants", "trials"]
+EXCLUDE_COLUMNS = ["created"]
+FACTOR_COLUMNS = [
+    "practice", "cue_type", "task_requirement", "cue_location", "target_location",
+    "gender", "handedness",
+]
+
+
+def table_columns(db, table, exclude=EXCLUDE_COLUMNS, factors=FACTOR_COLUMNS):
+    """Gets the names and export types of the columns of a database table.
+
+    Args:
+        db (:obj:`sqlite3.Connection`): The database to read from.
+        table (str): The name of the table.
+        exclude (list, optional): Columns to leave out of the export.
+        factors (list, optional): Columns to dictionary-encode as factors.
+
+    Returns:
+        list: A list of ``(name, kind)`` tuples, where kind is one of 'int',
+        'float', 'str', or 'factor'.
+
+    """
+    columns = []
+    for cid, name, decltype, notnull, default, pk in db.execute("PRAGMA table_info({0})".format(table)):
+        if name in exclude:
+            continue
+        decltype = decltype.lower()
+        if name in factors:
+            kind = "factor"
+        elif "int" in decltype:
+            kind = "int"
+        elif "real" in decltype or "floa" in decltype or "doub" in decltype:
+            kind = "float"
+        else:
+            kind = "str"
+        columns.append((name, kind))
+    return columns
+
+
+def iter_batches(db, table, columns, batch_size):
+    """Yields the rows of a table in batches of at most ``batch_size`` rows."""
+    names = ", ".join([name for name, kind in columns])
+    cursor = db.execute("SELECT {0} FROM {1} ORDER BY id".format(names, table))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def _as_str(value):
+    return None if value is None else str(value)
+
+
+def export_parquet(db, table, columns, path, batch_size):
+    """Streams a table to a Parquet file, one row group per batch."""
+    arrow_types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "str": pa.string(),
+        "factor": pa.dictionary(pa.int32(), pa.string()),
+    }
+    schema = pa.schema([(name, arrow_types[kind]) for name, kind in columns])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in iter_batches(db, table, columns, batch_size):
+            arrays = []
+            for i, (name, kind) in enumerate(columns):
+                values = [row[i] for row in rows]
+                if kind == "factor":
+                    arrays.append(pa.array([_as_str(v) for v in values], pa.string()).dictionary_encode())
+                elif kind == "str":
+                    arrays.append(pa.array([_as_str(v) for v in values], pa.string()))
+                else:
+                    arrays.append(pa.array(values, arrow_types[kind]))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+    return path
+
+
+def export_numpy(db, table, columns, path, batch_size):
+    """Streams a table into a memory-mapped structured NumPy array.
+
+    Integer columns use -1 and float columns use NaN for missing values. Factor
+    columns are stored as int16 codes, with their levels written to a JSON file
+    next to the array.
+
+    """
+    n = db.execute("SELECT COUNT(*) FROM {0}".format(table)).fetchone()[0]
+    dtype = []
+    for name, kind in columns:
+        if kind == "int":
+            dtype.append((name, np.int64))
+        elif kind == "float":
+            dtype.append((name, np.float64))
+        elif kind == "factor":
+            dtype.append((name, np.int16))
+        else:
+            q = "SELECT MAX(LENGTH({0})) FROM {1}".format(name, table)
+            dtype.append((name, "U{0}".format(db.execute(q).fetchone()[0] or 1)))
+
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.dtype(dtype), shape=(n,))
+    levels = {name: {} for name, kind in columns if kind == "factor"}
+    start = 0
+    for rows in iter_batches(db, table, columns, batch_size):
+        end = start + len(rows)
+        for i, (name, kind) in enumerate(columns):
+            values = [row[i] for row in rows]
+            if kind == "factor":
+                codes = levels[name]
+                for v in values:
+                    if _as_str(v) not in codes:
+                        codes[_as_str(v)] = len(codes)
+                out[name][start:end] = [codes[_as_str(v)] for v in values]
+            elif kind == "int":
+                out[name][start:end] = [-1 if v is None else v for v in values]
+            elif kind == "float":
+                out[name][start:end] = [np.nan if v is None else v for v in values]
+            else:
+                out[name][start:end] = ["" if v is None else str(v) for v in values]
+        start = end
+    out.flush()
+    del out
+
+    levels_path = os.path.splitext(path)[0] + "_levels.json"
+    with open(levels_path, "w") as f:
+        json.dump({name: sorted(codes, key=codes.get) for name, codes in levels.items()}, f, indent=2)
+    return path
+
+
+def export_database(db_path, out_dir, fmt=None, batch_size=10000, tables=EXPORT_TABLES):
+    """Exports the participants and trials tables of a project database.
+
+    Args:
+        db_path (str): The path of the project database.
+        out_dir (str): The folder to write the exported files to.
+        fmt (str, optional): Either 'parquet' or 'numpy'. Defaults to 'parquet'
+            if pyarrow is installed, otherwise 'numpy'.
+        batch_size (int, optional): The number of rows to read per batch.
+        tables (list, optional): The names of the tables to export.
+
+    Returns:
+        dict: The path of the exported file for each table.
+
+    """
+    if fmt is None:
+        fmt = "parquet" if PYARROW_AVAILABLE else "numpy"
+    if fmt == "parquet" and not PYARROW_AVAILABLE:
+        raise RuntimeError("Parquet export requires the 'pyarrow' package.")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    db = sqlite3.connect("file:{0}?mode=ro".format(db_path), uri=True)
+    outputs = {}
+    try:
+        for table in tables:
+            columns = table_columns(db, table)
+            if fmt == "parquet":
+                path = os.path.join(out_dir, table + ".parquet")
+                outputs[table] = export_parquet(db, table, columns, path, batch_size)
+            else:
+                path = os.path.join(out_dir, table + ".npy")
+                outputs[table] = export_numpy(db, table, columns, path, batch_size)
+    finally:
+        db.close()
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("database", nargs="?", default=DEFAULT_DB, help="the project database")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="the output folder")
+    parser.add_argument("--format", choices=["parquet", "numpy"], default=None)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    outputs = export_database(args.database, args.output, args.format, args.batch_size)
+    for table, path in outputs.items():
+        print("Exported '{0}' to {1}".format(table, path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Incrementally merges station databases into a single master project database.
+
+For each source database, the master database records the highest id merged so far
+from each table (its high-water marks). On each run, only rows above those marks are
+copied, so the time a merge takes depends on how much data is new rather than on how
+much has been collected in total:
+
+  * new participants are matched to the master database by userhash, and are only
+    inserted if they aren't already there (e.g. from a previous merge, or because
+    the same participant ran on another station)
+  * the mapping from each source's participant ids to master ids is kept in the
+    master database, so rows for participants merged in an earlier run (e.g. trials
+    from a session that was in progress) are remapped correctly
+  * trials, frames and gaze_index rows are copied with a single INSERT ... SELECT per
+    table, remapping participant_id through that mapping
+  * every station names its gaze sample files the same way, so the files referenced
+    by new gaze_index rows are copied (with their headers) into a folder for the
+    station under the master's data folder, 'stations/<station>/', and the rows'
+    'file' paths are prefixed to match
+
+Each source is merged in one transaction along with its new high-water marks, so an
+interrupted merge never copies rows twice. Sources can be database files or folders
+to search for project databases. If the master database doesn't exist, it's created
+from ExpAssets/Config/gaze_ilm_schema.sql.
+
+Each station's data folder is taken to be the 'Data' folder next to its database (as
+in a klibs project's ExpAssets folder), and likewise for the master database unless
+--data-dir is given.
+
+Usage:
+    python tools/merge_stations.py MASTER_DB SOURCE [SOURCE ...] [--pattern NAME]
+                                   [--data-dir MASTER_DATA_DIR]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import sqlite3
+import argparse
+
+from batch_export import find_databases, DEFAULT_PATTERN
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_FILE = os.path.join(PROJECT_DIR, "ExpAssets", "Config", "gaze_ilm_schema.sql")
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+from gaze_samples import header_path
+
+# Tables with a participant_id column that are copied after the participants table
+CHILD_TABLES = ["trials", "frames", "gaze_index"]
+
+MERGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS merge_marks (
+    source text not null,
+    table_name text not null,
+    last_id integer not null,
+    merged text not null,
+    PRIMARY KEY (source, table_name)
+);
+CREATE TABLE IF NOT EXISTS merge_participants (
+    source text not null,
+    source_id integer not null,
+    master_id integer not null references participants(id),
+    PRIMARY KEY (source, source_id)
+);
+CREATE INDEX IF NOT EXISTS participants_userhash ON participants(userhash);
+"""
+
+
+def open_master(path, schema_file=SCHEMA_FILE):
+    """Opens the master database, creating it from the project schema if needed."""
+    new = not os.path.exists(path)
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    db = sqlite3.connect("file:{0}".format(path), uri=True, isolation_level=None)
+    if new:
+        with open(schema_file) as f:
+            db.executescript(f.read())
+    db.executescript(MERGE_SCHEMA)
+    return db
+
+
+def _columns(db, table, schema="main"):
+    return [row[1] for row in db.execute("PRAGMA {0}.table_info({1})".format(schema, table))]
+
+
+def _has_table(db, table, schema):
+    q = "SELECT COUNT(*) FROM {0}.sqlite_master WHERE type = 'table' AND name = ?".format(schema)
+    return db.execute(q, (table,)).fetchone()[0] > 0
+
+
+def default_data_dir(db_path):
+    """Returns the data folder of a project database (the 'Data' folder next to it)."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "Data")
+
+
+def station_folder(source):
+    """Returns the folder (relative to the master's data folder) for a station's files.
+
+    The folder is named after the station's project folder, with a short hash of the
+    source key so that stations with the same folder name don't collide.
+
+    """
+    project = os.path.basename(os.path.dirname(os.path.dirname(source))) or "station"
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:8]
+    return os.path.join("stations", "{0}-{1}".format(project, digest))
+
+
+def copy_gaze_files(files, source_data_dir, master_data_dir, folder):
+    """Copies gaze sample files (and their headers) into a station's folder in the master.
+
+    Returns:
+        list: The files that couldn't be found in the source data folder.
+
+    """
+    missing = []
+    for name in files:
+        src = os.path.join(source_data_dir, name)
+        dst = os.path.join(master_data_dir, folder, name)
+        if not os.path.exists(src):
+            missing.append(name)
+            continue
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        shutil.copyfile(src, dst)
+        if os.path.exists(header_path(src)):
+            shutil.copyfile(header_path(src), header_path(dst))
+    return missing
+
+
+def merge_source(db, source_path, master_data_dir, source=None, source_data_dir=None):
+    """Copies the rows added to a source database since its last merge into the master.
+
+    Args:
+        db (:obj:`sqlite3.Connection`): The master database (from :func:`open_master`).
+        source_path (str): The path of the source database.
+        master_data_dir (str): The master's data folder, which gaze sample files are
+            copied into.
+        source (str, optional): The key the source's high-water marks are stored under.
+            Defaults to the source database's absolute path.
+        source_data_dir (str, optional): The folder the source's gaze sample file names
+            are relative to. Defaults to the 'Data' folder next to the source database.
+
+    Returns:
+        dict: The number of rows copied from each table, plus the number of new
+        participants that were already in the master database ('duplicates').
+
+    """
+    if source is None:
+        source = os.path.abspath(source_path)
+    if source_data_dir is None:
+        source_data_dir = default_data_dir(source_path)
+    folder = station_folder(source)
+    marks = dict(db.execute("SELECT table_name, last_id FROM merge_marks WHERE source = ?", (source,)))
+    copied = {}
+
+    db.execute("ATTACH DATABASE ? AS src", ("file:{0}?mode=ro".format(source_path),))
+    try:
+        db.execute("BEGIN")
+        # Participants are matched on userhash before being inserted
+        columns = [c for c in _columns(db, "participants", "src") if c != "id" and c in _columns(db, "participants")]
+        rows = db.execute(
+            "SELECT id, {0} FROM src.participants WHERE id > ? ORDER BY id".format(", ".join(columns)),
+            (marks.get("participants", 0),)
+        ).fetchall()
+        hash_col = columns.index("userhash") + 1
+        insert = "INSERT INTO participants ({0}) VALUES ({1})".format(", ".join(columns), ", ".join("?" * len(columns)))
+        mapping, duplicates = [], 0
+        for row in rows:
+            match = db.execute("SELECT id FROM participants WHERE userhash = ?", (row[hash_col],)).fetchone()
+            if match is None:
+                master_id = db.execute(insert, row[1:]).lastrowid
+            else:
+                master_id = match[0]
+                duplicates += 1
+            mapping.append((source, row[0], master_id))
+        db.executemany("INSERT OR REPLACE INTO merge_participants VALUES (?, ?, ?)", mapping)
+        copied["participants"] = len(rows) - duplicates
+        copied["duplicates"] = duplicates
+        new_marks = {"participants": rows[-1][0] if rows else marks.get("participants", 0)}
+
+        for table in CHILD_TABLES:
+            if not (_has_table(db, table, "src") and _has_table(db, table, "main")):
+                continue
+            last_id = marks.get(table, 0)
+            master_columns = _columns(db, table)
+            columns = [c for c in _columns(db, table, "src") if c != "id" and c in master_columns]
+            selected = ["m.master_id" if c == "participant_id" else "s." + c for c in columns]
+            params = []
+            if table == "gaze_index":
+                # Gaze files are moved into the station's folder in the master's data folder
+                selected[columns.index("file")] = "? || s.file"
+                params.append(folder + os.sep)
+                files = [row[0] for row in db.execute(
+                    "SELECT DISTINCT file FROM src.gaze_index WHERE id > ?", (last_id,)
+                )]
+                for name in copy_gaze_files(files, source_data_dir, master_data_dir, folder):
+                    print("Warning: gaze file '{0}' not found in {1}".format(name, source_data_dir))
+            cursor = db.execute(
+                "INSERT INTO main.{0} ({1}) SELECT {2} FROM src.{0} s "
+                "JOIN merge_participants m ON m.source = ? AND m.source_id = s.participant_id "
+                "WHERE s.id > ? ORDER BY s.id".format(table, ", ".join(columns), ", ".join(selected)),
+                params + [source, last_id]
+            )
+            copied[table] = cursor.rowcount
+            top = db.execute("SELECT MAX(id) FROM src.{0}".format(table)).fetchone()[0]
+            new_marks[table] = max(last_id, top or 0)
+
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        db.executemany(
+            "INSERT OR REPLACE INTO merge_marks VALUES (?, ?, ?, ?)",
+            [(source, table, last_id, now) for table, last_id in new_marks.items()]
+        )
+        db.execute("COMMIT")
+    except Exception:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    finally:
+        db.execute("DETACH DATABASE src")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("master", help="the master database to merge into")
+    parser.add_argument("sources", nargs="+", help="station databases, or folders to search for them")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN, help="the file name of the project databases")
+    parser.add_argument("--data-dir", default=None,
+        help="the master's data folder (defaults to the 'Data' folder next to the master database)")
+    args = parser.parse_args()
+
+    sources = []
+    for path in args.sources:
+        sources += find_databases(path, args.pattern) if os.path.isdir(path) else [path]
+    master = os.path.abspath(args.master)
+    sources = [path for path in sources if os.path.abspath(path) != master]
+    if not sources:
+        print("No source databases to merge")
+        sys.exit(1)
+
+    data_dir = args.data_dir or default_data_dir(args.master)
+    db = open_master(args.master)
+    start = time.perf_counter()
+    try:
+        for path in sources:
+            t = time.perf_counter()
+            copied = merge_source(db, path, data_dir)
+            print("{0}: {1} new participants ({2} already merged), {3} ({4:.2f} s)".format(
+                path, copied.pop("participants"), copied.pop("duplicates"),
+                ", ".join("{0} {1}".format(n, table) for table, n in copied.items()),
+                time.perf_counter() - t
+            ))
+    finally:
+        db.close()
+    print("Merged {0} databases in {1:.2f} s".format(len(sources), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Vectorized saccade detection for recorded gaze samples.
+
+Reads the per-session gaze sample files written by the experiment (see
+ExpAssets/Resources/code/gaze_samples.py) and detects saccades over a whole session
+at once, using the saccadic_velocity_threshold, saccadic_acceleration_threshold and
+saccadic_motion_threshold values from ExpAssets/Config/gaze_ilm_params.py:
+
+  * gaze positions are converted to degrees from the screen centre, and velocity
+    and acceleration (in deg/s and deg/s^2) are computed by differencing smoothed
+    positions, never across trial boundaries or missing samples
+  * samples above the velocity threshold, or the acceleration threshold, are
+    grouped into runs, and runs moving less than the motion threshold are dropped
+  * each saccade is checked for being directed toward the cued probe, and trials
+    containing such a saccade are flagged
+
+Sessions can be processed in parallel on a process pool.
+
+Usage:
+    python tools/saccades.py [ExpAssets/gaze_ilm.db] [-o OUTPUT_DIR] [--jobs N]
+
+"""
+
+import os
+import sys
+import time
+import runpy
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, "ExpAssets", "Resources", "code"))
+
+from gaze_samples import MISSING, map_samples, read_header
+from analysis import write_csv
+
+
+DEFAULT_DB = os.path.join("ExpAssets", "gaze_ilm.db")
+DEFAULT_DATA_DIR = os.path.join("ExpAssets", "Data")
+PARAMS_FILE = os.path.join(PROJECT_DIR, "ExpAssets", "Config", "gaze_ilm_params.py")
+
+# Probe positions (in degrees from the screen centre, y down) as drawn in the experiment
+PROBE_POSITIONS = {"left": (-2.5, -1.1), "right": (2.5, -1.1)}
+TOWARD_CUE_ANGLE = 45.0 # max angle (in degrees) between a saccade and the cued probe's direction
+
+
+def load_thresholds(params_file=PARAMS_FILE):
+    """Returns the saccade velocity, acceleration and motion thresholds from the params file."""
+    params = runpy.run_path(params_file)
+    return (
+        params["saccadic_velocity_threshold"],
+        params["saccadic_acceleration_threshold"],
+        params["saccadic_motion_threshold"],
+    )
+
+
+def smooth(values, width, breaks):
+    """Moving average of a 1D array, restarting at each break so segments don't mix."""
+    if width <= 1:
+        return values
+    out = np.empty_like(values)
+    kernel = np.ones(width) / width
+    bounds = np.concatenate([[0], breaks, [len(values)]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        segment = values[start:end]
+        if len(segment) >= width:
+            padded = np.pad(segment, (width // 2, width - 1 - width // 2), mode="edge")
+            out[start:end] = np.convolve(padded, kernel, mode="valid")
+        else:
+            out[start:end] = segment
+    return out
+
+
+def runs(mask):
+    """Returns the start and end (exclusive) indices of each run of True values."""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def detect_saccades(samples, trial_starts, ppd, centre, velocity_threshold,
+                    acceleration_threshold, motion_threshold, smoothing=3):
+    """Detects saccades in a session of gaze samples.
+
+    Args:
+        samples (:obj:`numpy.ndarray`): The session's gaze samples, in trial order.
+        trial_starts (:obj:`numpy.ndarray`): The index of the first sample of each trial.
+        ppd (float): The number of pixels per degree of visual angle.
+        centre (tuple): The (x, y) pixel coordinates of the screen centre.
+        velocity_threshold (float): The velocity (deg/s) above which gaze is in a saccade.
+        acceleration_threshold (float): The acceleration (deg/s^2) above which gaze
+            is in a saccade.
+        motion_threshold (float): The smallest amplitude (deg) counted as a saccade.
+        smoothing (int, optional): The width (in samples) of the moving average applied
+            to positions before differencing.
+
+    Returns:
+        dict: Equal-length arrays describing each saccade: 'trial' (index into
+        ``trial_starts``), 'onset' and 'offset' (sample times, ms), 'start_x',
+        'start_y', 'end_x', 'end_y' (deg), 'amplitude' (deg) and 'peak_velocity'
+        (deg/s).
+
+    """
+    n = len(samples)
+    x = (samples["x"].astype(np.float64) - centre[0]) / ppd
+    y = (samples["y"].astype(np.float64) - centre[1]) / ppd
+    t = samples["time"].astype(np.float64)
+    missing = ((samples["flags"] & MISSING) > 0) | np.isnan(x) | np.isnan(y)
+
+    # Positions are smoothed within each trial, and differences are invalid across trial
+    # boundaries or next to missing samples
+    breaks = np.asarray(trial_starts[1:], dtype=np.int64)
+    xs = smooth(x, smoothing, breaks)
+    ys = smooth(y, smoothing, breaks)
+    invalid = np.zeros(n, dtype=bool)
+    invalid[trial_starts] = True
+    invalid[1:] |= missing[1:] | missing[:-1]
+
+    dt = np.diff(t, prepend=np.nan) / 1000.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        velocity = np.hypot(np.diff(xs, prepend=np.nan), np.diff(ys, prepend=np.nan)) / dt
+        velocity[invalid] = np.nan
+        acceleration = np.abs(np.diff(velocity, prepend=np.nan)) / dt
+        in_saccade = (velocity > velocity_threshold) | (acceleration > acceleration_threshold)
+    in_saccade[invalid] = False
+
+    onsets, offsets = runs(in_saccade)
+    # A saccade starts from the last sample before the velocity rises
+    starts = np.maximum(onsets - 1, 0)
+    ends = offsets - 1
+    trial = np.searchsorted(trial_starts, starts, side="right") - 1
+    amplitude = np.hypot(xs[ends] - xs[starts], ys[ends] - ys[starts])
+    # Peak velocity within each run (the reduction bounds alternate onset, offset, ...)
+    bounds = np.empty(2 * len(onsets), dtype=np.int64)
+    bounds[0::2], bounds[1::2] = onsets, offsets
+    padded_velocity = np.append(np.nan_to_num(velocity), 0)
+    peak_velocity = np.maximum.reduceat(padded_velocity, bounds)[0::2] if len(onsets) else np.zeros(0)
+
+    keep = amplitude >= motion_threshold
+    return {
+        "trial": trial[keep],
+        "onset": t[starts][keep],
+        "offset": t[ends][keep],
+        "start_x": xs[starts][keep],
+        "start_y": ys[starts][keep],
+        "end_x": xs[ends][keep],
+        "end_y": ys[ends][keep],
+        "amplitude": amplitude[keep],
+        "peak_velocity": peak_velocity[keep],
+    }
+
+
+def toward_cue(saccades, cue_location):
+    """Returns whether each saccade was directed toward the cued probe.
+
+    Args:
+        saccades (dict): Saccades from :func:`detect_saccades`.
+        cue_location (:obj:`numpy.ndarray`): The cue location ('left', 'right' or
+            'neutral') of each trial, indexed by the saccades' 'trial' values.
+
+    """
+    cues = np.asarray(cue_location)[saccades["trial"]]
+    probe_x = np.select([cues == "left", cues == "right"], [PROBE_POSITIONS["left"][0], PROBE_POSITIONS["right"][0]], np.nan)
+    probe_y = np.where(cues == "neutral", np.nan, PROBE_POSITIONS["left"][1])
+    sx = saccades["end_x"] - saccades["start_x"]
+    sy = saccades["end_y"] - saccades["start_y"]
+    px = probe_x - saccades["start_x"]
+    py = probe_y - saccades["start_y"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cosine = (sx * px + sy * py) / (np.hypot(sx, sy) * np.hypot(px, py))
+    return np.nan_to_num(cosine, nan=-1.0) >= np.cos(np.radians(TOWARD_CUE_ANGLE))
+
+
+def analyze_session(db_path, data_dir, gaze_file, thresholds):
+    """Detects saccades in one session's gaze file and flags trials with saccades toward the cue.
+
+    Returns:
+        tuple: The session's saccades (see :func:`detect_saccades`, with participant,
+        block and trial numbers and a 'toward_cue' column added), its per-trial
+        flags, and the time taken (in seconds).
+
+    """
+    start = time.perf_counter()
+    db = sqlite3.connect(db_path)
+    try:
+        index = db.execute(
+            "SELECT g.participant_id, g.block_num, g.trial_num, g.byte_offset, g.sample_count, t.cue_location "
+            "FROM gaze_index g LEFT JOIN trials t ON t.participant_id = g.participant_id "
+            "AND t.block_num = g.block_num AND t.trial_num = g.trial_num "
+            "WHERE g.file = ? ORDER BY g.byte_offset", (gaze_file,)
+        ).fetchall()
+    finally:
+        db.close()
+
+    path = os.path.join(data_dir, gaze_file)
+    header = read_header(path)
+    participant, block, trial_num, offsets, counts, cue_location = [np.asarray(c) for c in zip(*index)]
+    samples = map_samples(path, int(offsets[0]), int(counts.sum()))
+    trial_starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+    saccades = detect_saccades(samples, trial_starts, header["ppd"], header["screen_c"], *thresholds)
+    saccades["toward_cue"] = toward_cue(saccades, cue_location.astype(str))
+    flagged = np.zeros(len(index), dtype=bool)
+    flagged[saccades["trial"][saccades["toward_cue"]]] = True
+
+    trial_idx = saccades.pop("trial")
+    saccades = dict(
+        [("participant_id", participant[trial_idx]), ("block_num", block[trial_idx]),
+         ("trial_num", trial_num[trial_idx])] + list(saccades.items())
+    )
+    trials = {
+        "participant_id": participant, "block_num": block, "trial_num": trial_num,
+        "cue_location": cue_location,
+        "saccades": np.bincount(trial_idx, minlength=len(index)),
+        "saccade_toward_cue": flagged,
+    }
+    return saccades, trials, time.perf_counter() - start
+
+
+def concatenate(tables):
+    """Joins a list of tables (dicts of equal-length columns) end to end."""
+    return {name: np.concatenate([table[name] for table in tables]) for name in tables[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("database", nargs="?", default=DEFAULT_DB, help="the project database")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="the folder gaze file paths are relative to")
+    parser.add_argument("-o", "--output", default=None, help="a folder to write saccades.csv and trial_flags.csv to")
+    parser.add_argument("--jobs", type=int, default=1, help="the number of sessions to process in parallel")
+    args = parser.parse_args()
+
+    thresholds = load_thresholds()
+    db = sqlite3.connect(args.database)
+    gaze_files = [row[0] for row in db.execute("SELECT DISTINCT file FROM gaze_index ORDER BY file")]
+    db.close()
+    if not gaze_files:
+        print("No gaze samples found in {0}".format(args.database))
+        return
+
+    jobs = [(args.database, args.data_dir, f, thresholds) for f in gaze_files]
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(analyze_session, *zip(*jobs)))
+    else:
+        results = [analyze_session(*job) for job in jobs]
+
+    for gaze_file, (saccades, trials, elapsed) in zip(gaze_files, results):
+        print("{0}: {1} saccades, {2} of {3} trials with saccades toward the cue ({4:.2f} s)".format(
+            gaze_file, len(saccades["onset"]), trials["saccade_toward_cue"].sum(),
+            len(trials["trial_num"]), elapsed
+        ))
+    if args.output:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        write_csv(os.path.join(args.output, "saccades.csv"), concatenate([r[0] for r in results]))
+        write_csv(os.path.join(args.output, "trial_flags.csv"), concatenate([r[1] for r in results]))
+
+
+if __name__ == "__main__":
+    main()
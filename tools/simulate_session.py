@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Runs full sessions of the experiment with a simulated participant.
+
+Each run goes through the complete setup, trial_prep, trial and clean_up lifecycle
+using a virtual clock that jumps straight to each frame deadline and synthetic
+keypress and scale responses, so a whole session finishes in seconds. The task demo
+and between-trial prompts are skipped.
+
+klibs opens its window and OpenGL context at launch even though simulated trials
+draw nothing, so a display is needed: on Windows and macOS the session briefly opens
+a window on the desktop, and on Linux machines without one (e.g. a CI runner) it is
+run under a virtual X server with xvfb-run, whose software OpenGL is enough for
+startup. SDL's dummy video driver can't be used, as it provides no OpenGL context.
+
+The simulated refresh rate, frame-drop rate, and response distributions are set by
+the 'simulated_*' variables in ExpAssets/Config/gaze_ilm_params.py. Trials and frame
+logs are written to a copy of the project database ('gaze_ilm_simulation.db') so
+the real data are never touched. After each run, the number of trials it wrote to
+that database is checked, so a run that exits early doesn't pass silently.
+
+Usage:
+    python tools/simulate_session.py [--runs N] [--screen-size INCHES]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import subprocess
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIMULATION_DB = os.path.join(PROJECT_DIR, "ExpAssets", "gaze_ilm_simulation.db")
+
+
+def display_command():
+    """Returns the command prefix needed to give the session a display, if any."""
+    linux = sys.platform.startswith("linux")
+    if not linux or os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"):
+        return []
+    if shutil.which("xvfb-run"):
+        return ["xvfb-run", "-a", "-s", "-screen 0 1920x1080x24"]
+    print("No display available: install Xvfb (xvfb-run) to simulate sessions on this machine")
+    sys.exit(1)
+
+
+def simulated_trials(since):
+    """Returns the number of trials the latest simulated session wrote.
+
+    The simulation database is a fresh copy of the project database made by each
+    session, so only a copy made since the given (epoch) time is counted, and only
+    the trials of its newest participant (the simulated one).
+
+    """
+    if not os.path.exists(SIMULATION_DB) or os.path.getmtime(SIMULATION_DB) < since:
+        return 0
+    db = sqlite3.connect(SIMULATION_DB)
+    try:
+        return db.execute(
+            "SELECT COUNT(*) FROM trials WHERE participant_id = (SELECT MAX(id) FROM participants)"
+        ).fetchone()[0]
+    finally:
+        db.close()
+
+
+def simulate_session(screen_size=21.5):
+    env = dict(os.environ)
+    env["SDL_AUDIODRIVER"] = "dummy"
+    env["GAZE_ILM_SIMULATE"] = "1"
+    cmd = display_command() + ["klibs", "run", str(screen_size), "-d"]
+    return subprocess.call(cmd, cwd=PROJECT_DIR, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=1, help="the number of sessions to run")
+    parser.add_argument("--screen-size", type=float, default=21.5,
+        help="the diagonal size of the (simulated) screen, in inches")
+    args = parser.parse_args()
+
+    for run in range(args.runs):
+        started = time.time()
+        start = time.perf_counter()
+        status = simulate_session(args.screen_size)
+        elapsed = time.perf_counter() - start
+        trials = simulated_trials(started)
+        print("Run {0}/{1}: exit status {2}, {3} trials written ({4:.1f} s)".format(
+            run + 1, args.runs, status, trials, elapsed
+        ))
+        if status != 0:
+            sys.exit(status)
+        if trials == 0:
+            print("The session exited without writing any trials")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Profiles the experiment's startup on this machine, up to the first frame of the demo.
+
+The experiment is launched with Python's import-time profiling enabled
+(PYTHONPROFILEIMPORTTIME) and in startup-profiling mode, in which it exits as soon
+as the first demo slide has been shown and the remaining frames have been built in
+the background. The report combines:
+
+  - the time taken to import each module (the slowest by cumulative time),
+  - the time taken by each stage of setup, and to first render each stimulus,
+  - the time-to-first-frame, measured from launch.
+
+Each run is appended to 'ExpAssets/Data/startup/<hostname>_history.jsonl' so that
+time-to-first-frame can be tracked on each testing machine.
+
+Usage:
+    python tools/startup_profile.py [--top N] [--screen-size INCHES]
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_DIR = os.path.join(PROJECT_DIR, "ExpAssets", "Data", "startup")
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def parse_import_times(stderr):
+    """Returns (module, self_ms, cumulative_ms, depth) for each import in -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            depth = (len(indent) - 1) // 2
+            imports.append((module, int(self_us) / 1000.0, int(cumulative_us) / 1000.0, depth))
+    return imports
+
+
+def profile_startup(output_path, screen_size=21.5):
+    env = dict(os.environ)
+    env["PYTHONPROFILEIMPORTTIME"] = "1"
+    env["GAZE_ILM_PROFILE_STARTUP"] = "1"
+    env["GAZE_ILM_STARTUP_PROFILE_OUTPUT"] = output_path
+    cmd = ["klibs", "run", str(screen_size), "-d"]
+    launched = time.time()
+    proc = subprocess.Popen(cmd, cwd=PROJECT_DIR, env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    stderr = proc.communicate()[1]
+    # Pass through anything that wasn't import profiling (e.g. tracebacks)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            print(line, file=sys.stderr)
+    return proc.returncode, launched, parse_import_times(stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--top", type=int, default=15, help="the number of slowest imports to list")
+    parser.add_argument("--screen-size", type=float, default=21.5,
+        help="the diagonal size of the screen, in inches")
+    args = parser.parse_args()
+
+    host = socket.gethostname()
+    output_path = os.path.join(STARTUP_DIR, host + ".json")
+    status, launched, imports = profile_startup(output_path, args.screen_size)
+    if status != 0:
+        sys.exit(status)
+    with open(output_path) as f:
+        profile = json.load(f)
+    if profile["first_frame"] is not None:
+        profile["time_to_first_frame"] = (profile["first_frame"] - launched) * 1000
+    profile["imports"] = [list(i) for i in imports]
+    profile["launched"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(launched))
+    with open(output_path, "w") as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+
+    print("Slowest imports (cumulative):")
+    for module, self_ms, cumulative_ms, depth in sorted(imports, key=lambda i: -i[2])[:args.top]:
+        print("  {0:<40} {1:8.1f} ms".format(module, cumulative_ms))
+    print("Setup stages:")
+    for stage, duration in profile["stages"]:
+        print("  {0:<40} {1:8.1f} ms".format(stage, duration))
+    print("Stimulus rendering:")
+    for name, duration in sorted(profile["stimuli"].items(), key=lambda s: -s[1]):
+        print("  {0:<40} {1:8.1f} ms".format(name, duration))
+    if "time_to_first_frame" in profile:
+        print("Time to first frame: {0:.0f} ms".format(profile["time_to_first_frame"]))
+
+    history = {
+        "launched": profile["launched"],
+        "time_to_first_frame": profile.get("time_to_first_frame"),
+        "import_total": sum(i[1] for i in imports),
+        "setup_total": profile["total"],
+    }
+    with open(os.path.join(STARTUP_DIR, host + "_history.jsonl"), "a") as f:
+        f.write(json.dumps(history) + "\n")
+
+
+if __name__ == "__main__":
+    main()